@@ -0,0 +1,121 @@
+"""
+Benchmark for the bigram counting step of the phrase extractor.
+
+Compares the old self-join of the token stream, which materializes the
+full ngrams table before grouping, with the LEAD window used by
+phrases_extractor.extract_phrases_pmi_duckdb. Every variant runs in a
+fresh process, so the reported peak memory (max RSS) is its own.
+"""
+
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import duckdb
+import ir_datasets
+
+
+VARIANTS = {
+    "selfjoin": """
+        CREATE OR REPLACE TABLE fts_main_documents.ngrams AS
+        SELECT t1.tokenid AS w1, t2.tokenid AS w2,
+               t1.docid AS doc_id
+        FROM fts_main_documents.tokens t1
+        JOIN fts_main_documents.tokens t2
+        ON t1.docid = t2.docid AND t2.pos = t1.pos + 1;
+        CREATE OR REPLACE TABLE fts_main_documents.ngram_freq AS
+        SELECT w1, w2, COUNT(*) AS freq,
+               COUNT(DISTINCT doc_id) AS doc_freq
+        FROM fts_main_documents.ngrams
+        GROUP BY w1, w2
+        HAVING COUNT(*) >= {min_freq};
+        DROP TABLE fts_main_documents.ngrams;
+    """,
+    "lead": """
+        CREATE OR REPLACE TABLE fts_main_documents.ngram_freq AS
+        SELECT w1, w2, COUNT(*) AS freq,
+               COUNT(DISTINCT docid) AS doc_freq
+        FROM (
+            SELECT docid, tokenid AS w1,
+                   LEAD(tokenid) OVER (PARTITION BY docid ORDER BY pos) AS w2
+            FROM fts_main_documents.tokens
+        )
+        WHERE w2 IS NOT NULL
+        GROUP BY w1, w2
+        HAVING COUNT(*) >= {min_freq};
+    """,
+}
+
+
+def prepare(db_name, dataset):
+    """ Insert the dataset and create the token stream once. """
+    import phrase_index
+
+    if dataset == 'custom':
+        import ze_eval
+        ir_dataset = ze_eval.ir_dataset_test()
+    else:
+        ir_dataset = ir_datasets.load(dataset)
+    con = duckdb.connect(db_name)
+    phrase_index.insert_dataset(con, ir_dataset, logging=False)
+    con.sql("CREATE SCHEMA IF NOT EXISTS fts_main_documents;")
+    phrase_index.create_tokenizer_duckdb(con)
+    phrase_index.create_token_stream(con)
+    tokens = con.sql("SELECT COUNT(*) FROM fts_main_documents.tokens").fetchall()[0][0]
+    con.close()
+    return tokens
+
+
+def peak_rss():
+    """ Peak resident set size in kB of this process only (ru_maxrss survives exec) """
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1])
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_variant(db_name, variant, min_freq, memory_limit=None):
+    """ Run one variant; prints: seconds, number of n-grams, peak RSS in kB """
+    con = duckdb.connect(db_name)
+    if memory_limit:
+        con.sql(f"SET memory_limit = '{memory_limit}'")
+    start = time.perf_counter()
+    con.sql(VARIANTS[variant].format(min_freq=min_freq))
+    elapsed = time.perf_counter() - start
+    count = con.sql("SELECT COUNT(*) FROM fts_main_documents.ngram_freq").fetchall()[0][0]
+    con.sql("DROP TABLE fts_main_documents.ngram_freq")
+    con.close()
+    print(elapsed, count, peak_rss())
+
+
+def benchmark(db_name, dataset, min_freq=2, memory_limit=None):
+    if os.path.exists(db_name):
+        raise ValueError(f"File {db_name} already exists.")
+    tokens = prepare(db_name, dataset)
+    print(f"{dataset}: {tokens} tokens, min_freq={min_freq}, memory_limit={memory_limit}")
+    for variant in VARIANTS:
+        command = [sys.executable, __file__, db_name, '--variant', variant, '--min-freq', str(min_freq)]
+        if memory_limit:
+            command += ['--memory-limit', memory_limit]
+        result = subprocess.run(command, capture_output=True, text=True, check=True)
+        (elapsed, count, peak) = result.stdout.split()
+        print(f"{variant:>10}: {float(elapsed):.2f}s, peak RSS {int(peak) / 1024:.0f} MB, {count} n-grams")
+    os.remove(db_name)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark bigram counting of the phrase extractor.")
+    parser.add_argument('db', help='temporary database file name')
+    parser.add_argument('--dataset', type=str, default='cranfield', help='ir_datasets name (e.g., cranfield, msmarco-passage)')
+    parser.add_argument('--min-freq', type=int, default=2, help='Minimum frequency for phrases')
+    parser.add_argument('--memory-limit', type=str, default=None, help='DuckDB memory_limit for the variants (e.g., 1GB)')
+    parser.add_argument('--variant', choices=list(VARIANTS), help='run a single variant on an existing database (internal)')
+    args = parser.parse_args()
+    if args.variant:
+        run_variant(args.db, args.variant, args.min_freq, args.memory_limit)
+    else:
+        benchmark(args.db, args.dataset, args.min_freq, args.memory_limit)
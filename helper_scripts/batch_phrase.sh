@@ -9,6 +9,9 @@ RESULTS_BASE="results_new_postings"
 DATASET="cranfield"
 QUERY="cran"
 INDEXER="phrase_index.py"
+# Phrase statistics are counted once per dataset and reused for all thresholds;
+# the lowest MIN_FREQ should come first
+STATS_CACHE="phrase_stats_cache"
 
 STOPWORDS_LIST=("english" "none")
 MODE_LIST=("duckdb" "phrases")
@@ -41,7 +44,7 @@ for STOPWORDS in "${STOPWORDS_LIST[@]}"; do
             mkdir -p "$RESULTS_DIR"
 
             # Step 1: Build the index
-            python "$INDEXER" --db "$DB" --dataset "$DATASET" --stopwords "$STOPWORDS" --mode "$MODE" --limit "$LIMIT" --min-freq "$MIN_FREQ" --min-pmi "$MIN_PMI"
+            python "$INDEXER" --db "$DB" --dataset "$DATASET" --stopwords "$STOPWORDS" --mode "$MODE" --limit "$LIMIT" --min-freq "$MIN_FREQ" --min-pmi "$MIN_PMI" --stats-cache "$STATS_CACHE"
 
             # Step 2: Search
             ./zoekeend search "$DB" "$QUERY" -o "$OUT"
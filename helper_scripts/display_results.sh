@@ -29,7 +29,7 @@ for dir in "${RESULTS_DIR}"/*; do
     MIN_FREQ=$(grep '^MIN_FREQ:' "${SETTINGS}" | awk '{print $2}')
     MIN_PMI=$(grep '^MIN_PMI:' "${SETTINGS}" | awk '{print $2}')
     DICT_SIZE=$(duckdb "${DB_PATH}" -csv -noheader "SELECT COUNT(*) FROM fts_main_documents.dict;")
-    TERMS_SIZE=$(duckdb "${DB_PATH}" -csv -noheader "SELECT COUNT(*) FROM fts_main_documents.terms;")
+    TERMS_SIZE=$(duckdb "${DB_PATH}" -csv -noheader "SELECT SUM(len) FROM fts_main_documents.docs;")
     NGRAMS=$(duckdb "${DB_PATH}" -csv -noheader "SELECT COUNT(*) FROM fts_main_documents.dict WHERE term LIKE '% %';")
     AVGDL=$(duckdb "${DB_PATH}" -csv -noheader "SELECT avgdl FROM fts_main_documents.stats;")
     SUMDF=$(duckdb "${DB_PATH}" -csv -noheader "SELECT sumdf FROM fts_main_documents.stats;")
@@ -13,15 +13,14 @@
             WHERE (dict.term = tokens.t)
         ),
         qterms AS (
-            SELECT termid, docid
+            SELECT termid, docid, tf
             FROM fts_main_documents.terms AS terms
             WHERE (CASE WHEN ((fields IS NULL)) THEN (1) ELSE (fieldid = ANY(SELECT * FROM fieldids)) END
             AND (termid = ANY(SELECT qtermids.termid FROM qtermids)))
         ),
         term_tf AS (
-            SELECT termid, docid, count_star() AS tf
+            SELECT termid, docid, tf
             FROM qterms
-            GROUP BY docid, termid
         ),
         cdocs AS (
             SELECT docid
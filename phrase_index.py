@@ -1,43 +1,12 @@
 import pathlib
 import sys
+import time
 import duckdb
 import ir_datasets
 
 
 from phrases_extractor import extract_phrases_pmi_duckdb
-from ze_index import normalize
-
-def insert_dataset(con, ir_dataset, logging=True):
-    """
-    Insert documents from an ir_dataset. Works with several datasets.
-    Add document attributes if needed.
-    """
-    con.sql('CREATE TABLE documents (did TEXT, content TEXT)')
-    insert = 'INSERT INTO documents(did, content) VALUES '
-    sql = insert
-    part = 0
-    total = 0
-    count = ir_dataset.docs_count()
-    if logging:
-        print(f"Inserting {count} docs...", file=sys.stderr)
-    for doc in ir_dataset.docs_iter():
-        doc_text = ""
-        if hasattr(doc, 'title'):
-            doc_text = doc.title
-        if hasattr(doc, 'body'):
-            doc_text += " " + doc.body
-        if hasattr(doc, 'text'):
-            doc_text += " " + doc.text
-        sql += "('" + doc.doc_id + "','" + normalize(doc_text) + "'),"
-        part += 1
-        if part > 9999:
-            total += part
-            if logging:
-                print(str(total) + " docs", file=sys.stderr)
-            con.sql(sql)
-            part = 0
-            sql = insert
-    con.sql(sql)
+from ze_index import create_rank_bm25, insert_dataset
 
 def create_lm(con, stemmer):
     con.sql(f"""
@@ -56,15 +25,14 @@ def create_lm(con, stemmer):
             WHERE (dict.term = tokens.t)
         ),
         qterms AS (
-            SELECT termid, docid
+            SELECT termid, docid, tf
             FROM fts_main_documents.terms AS terms
             WHERE (CASE WHEN ((fields IS NULL)) THEN (1) ELSE (fieldid = ANY(SELECT * FROM fieldids)) END
             AND (termid = ANY(SELECT qtermids.termid FROM qtermids)))
         ),
         term_tf AS (
-            SELECT termid, docid, count_star() AS tf
+            SELECT termid, docid, tf
             FROM qterms
-            GROUP BY docid, termid
         ),
         cdocs AS (
             SELECT docid
@@ -90,8 +58,11 @@ def create_lm(con, stemmer):
     """)
 
 def create_bm25(con, stemmer):
-    con.sql(f"""
-        CREATE MACRO fts_main_documents.match_bm25(docname, query_string, b := 0.75, conjunctive := 0, k := 1.2, fields := NULL) AS (
+    """ BM25: match_bm25 scores one document, rank_bm25 all matching
+        documents at once, with the columns of match_lm
+    """
+    def scores(materialized=""):
+        return f"""
         WITH tokens AS (
             SELECT DISTINCT stem(unnest(fts_main_documents.tokenize(query_string)), '{stemmer}') AS t
         ),
@@ -105,16 +76,15 @@ def create_bm25(con, stemmer):
             FROM fts_main_documents.dict AS dict, tokens
             WHERE (dict.term = tokens.t)
         ),
-        qterms AS (
-            SELECT termid, docid
+        qterms AS {materialized}(
+            SELECT termid, docid, tf
             FROM fts_main_documents.terms AS terms
             WHERE (CASE WHEN ((fields IS NULL)) THEN (1) ELSE (fieldid = ANY(SELECT * FROM fieldids)) END
             AND (termid = ANY(SELECT qtermids.termid FROM qtermids)))
         ),
         term_tf AS (
-            SELECT termid, docid, count_star() AS tf
+            SELECT termid, docid, tf
             FROM qterms
-            GROUP BY docid, termid
         ),
         cdocs AS (
             SELECT docid
@@ -131,10 +101,14 @@ def create_bm25(con, stemmer):
         ),
         scores AS (
            SELECT docid, sum(subscore) AS score FROM subscores GROUP BY docid
-        ),
+        )"""
+    con.sql(f"""
+        CREATE OR REPLACE MACRO fts_main_documents.match_bm25(docname, query_string, b := 0.75, conjunctive := 0, k := 1.2, fields := NULL) AS (
+        {scores()}
         SELECT score FROM scores, fts_main_documents.docs AS docs
         WHERE ((scores.docid = docs.docid) AND (docs."name" = docname)))
     """)
+    create_rank_bm25(con, scores, "b := 0.75, conjunctive := 0, k := 1.2, fields := NULL")
 
 def create_docs_table(con, fts_schema="fts_main_documents", input_schema="main", input_table="documents", input_id="did"):
     """
@@ -159,31 +133,55 @@ def create_tokenizer_duckdb(con):
         );
     """)
 
-def create_tokenizer_ciff(con, fts_schema="fts_main_documents"):
+def max_term_length(con, fts_schema="fts_main_documents"):
+    """ The number of words of the longest term in the dict table (at least 1). """
+    return con.sql(f"""
+        SELECT COALESCE(MAX(len(string_split(term, ' '))), 1) FROM {fts_schema}.dict
+    """).fetchone()[0]
+
+def create_tokenizer_phrases(con, fts_schema="fts_main_documents"):
+    """
+    Create the query tokenizer for phrase indexes: split the query like
+    create_tokenizer_duckdb, then segment the tokens with the dict table
+    exactly like create_terms_table segments the documents (greedy longest
+    match). The dictionary is probed once with all tokens and n-grams of
+    the query; the segmentation itself uses list functions only.
+    Only dictionary terms are returned.
+    """
+    max_n = max_term_length(con, fts_schema)
     con.sql(f"""
-        CREATE TABLE IF NOT EXISTS {fts_schema}.dict (termid BIGINT, term TEXT, df BIGINT);
         CREATE OR REPLACE MACRO {fts_schema}.tokenize(query_string) AS (
-          WITH RECURSIVE sequence AS (
-            SELECT range AS nr 
-            FROM RANGE((SELECT MAX(LEN(term)) + 1 FROM {fts_schema}.dict))
+          WITH words AS (
+            -- grams[i][k - 1] is the k-gram starting at word i
+            SELECT w, list_transform(range(1, len(w) + 1), i -> list_transform(range(2, {max_n} + 1), k ->
+                CASE WHEN i + k - 1 <= len(w) THEN array_to_string(w[i:i + k - 1], ' ') END)) AS grams
+            FROM (
+              SELECT string_split_regex(regexp_replace(lower(strip_accents(CAST(query_string AS VARCHAR))), '[0-9!@#$%^&*()_+={{}}\\[\\]:;<>,.?~\\\\/\\|''''"`-]+', ' ', 'g'), '\\s+') AS w
+            )
           ),
-          simpledict AS (
-            SELECT '' AS term
-            UNION
-            SELECT term FROM {fts_schema}.dict
+          hits AS (
+            -- lengths[i] is the length of the longest phrase starting at word i (1 if none)
+            SELECT w, grams, terms, list_transform(range(1, len(w) + 1), i ->
+                coalesce(list_max(list_filter(range(2, {max_n} + 1), k -> list_contains(terms, grams[i][k - 1]))), 1)) AS lengths
+            FROM words, (
+              SELECT COALESCE(LIST(term), []::VARCHAR[]) AS terms
+              FROM {fts_schema}.dict
+              WHERE term IN (SELECT unnest(w || flatten(grams)) FROM words)
+            )
           ),
-          subterms(term, subquery) AS (
-            SELECT '', lower(strip_accents(CAST(query_string AS VARCHAR)))
-            UNION
-            SELECT MAX(dict.term), SUBSTRING(subquery,
-              CASE WHEN MAX(nr) < 1 THEN 2 ELSE MAX(nr) + 1 END,
-              LEN(subquery)) AS subquery
-            FROM subterms, sequence, simpledict as dict
-            WHERE SUBSTRING(subquery, 1, nr) = dict.term
-            GROUP BY subquery
-         )
-         SELECT LIST(term)  FROM subterms WHERE NOT term = ''
-       )
+          starts AS (
+            -- left to right, a word starts a term if the previous term ended before it;
+            -- the accumulator is [next start, start, start, ...]
+            SELECT w, grams, terms, lengths, list_reduce(list_transform(range(1, len(w) + 1), i -> [i + lengths[i], i]),
+                (acc, x) -> CASE WHEN x[2] >= acc[1] THEN [x[1]] || acc[2:] || [x[2]] ELSE acc END)[2:] AS s
+            FROM hits
+          )
+          SELECT list_filter(list_transform(s, i ->
+              CASE WHEN lengths[i] > 1 THEN grams[i][lengths[i] - 1]
+                   WHEN w[i] = '' OR NOT list_contains(terms, w[i]) THEN NULL
+                   ELSE w[i] END), t -> t IS NOT NULL)
+          FROM starts
+        )
     """)
 
 def create_stopwords_table(con, fts_schema="fts_main_documents", stopwords='none'):
@@ -202,146 +200,226 @@ def create_stopwords_table(con, fts_schema="fts_main_documents", stopwords='none
     else:
         con.sql(f"CREATE TABLE {fts_schema}.stopwords (sw VARCHAR);")
 
+def create_token_stream(con, fts_schema="fts_main_documents", input_schema="main", input_table="documents", input_val="content"):
+    """
+    Tokenize the documents once into a positional token stream.
+    The table tokens (docid, pos, tokenid) is read by phrase extraction,
+    dictionary construction and terms table construction; the table
+    vocab (tokenid, token) gives the token for each tokenid.
+    """
+    con.sql(f"""
+        CREATE OR REPLACE TEMP TABLE token_strings AS
+        SELECT docid, generate_subscripts(tokens, 1) AS pos, unnest(tokens) AS token
+        FROM (
+            SELECT
+                row_number() OVER () AS docid,
+                {fts_schema}.tokenize({input_val}) AS tokens
+            FROM {input_schema}.{input_table}
+        );
+        CREATE OR REPLACE TABLE {fts_schema}.vocab AS
+        SELECT row_number() OVER (ORDER BY token) AS tokenid, token
+        FROM (SELECT DISTINCT token FROM token_strings);
+        CREATE OR REPLACE TABLE {fts_schema}.tokens AS
+        SELECT t.docid, t.pos, v.tokenid
+        FROM token_strings t
+        JOIN {fts_schema}.vocab v ON t.token = v.token
+        ORDER BY t.docid, t.pos;
+        DROP TABLE token_strings;
+    """)
+
+def drop_token_stream(con, fts_schema="fts_main_documents"):
+    con.sql(f"DROP TABLE IF EXISTS {fts_schema}.tokens;")
+    con.sql(f"DROP TABLE IF EXISTS {fts_schema}.vocab;")
+
 def create_duckdb_dict_table(con, fts_schema="fts_main_documents", stopwords='none'): 
     """
     Create the dict table using DuckDB's built-in dictionary functionality.
+    Assumes the token stream tables exist (see create_token_stream).
     """
     con.sql(f"DROP TABLE IF EXISTS {fts_schema}.dict;")
     create_stopwords_table(con, fts_schema, stopwords)
         
     con.sql(f"""
         CREATE TABLE {fts_schema}.dict AS
-        WITH distinct_terms AS (
-            SELECT DISTINCT term
-            FROM {fts_schema}.terms
-        )
         SELECT
             row_number() OVER () AS termid,
-            term
+            token AS term
         FROM
-            distinct_terms
-        {"WHERE term NOT IN (SELECT sw FROM " + fts_schema + ".stopwords)" if stopwords == 'english' else ''}
+            {fts_schema}.vocab
+        {"WHERE token NOT IN (SELECT sw FROM " + fts_schema + ".stopwords)" if stopwords == 'english' else ''}
         ORDER BY term;
     """)
 
-def build_dict_table(con, mode='duckdb', fts_schema="fts_main_documents", stopwords='none', gpt4_token_file=None, ngram_range=(1,2), min_freq=10, min_pmi=5.0):
+def build_dict_table(con, mode='duckdb', fts_schema="fts_main_documents", stopwords='none', gpt4_token_file=None, ngram_range=(1,2), min_freq=10, min_pmi=5.0, partitions=1, approx=False, cache_dir=None):
     """
     Build the dictionary table using the specified mode.
     mode: 'phrases', 'ngrams', 'gpt4', or 'duckdb'
+    Assumes the token stream tables exist (see create_token_stream).
     """
     if mode == 'phrases':
         create_stopwords_table(con, fts_schema=fts_schema, stopwords=stopwords)
-        extract_phrases_pmi_duckdb(con, fts_schema="fts_main_documents", n=2, min_freq=min_freq, min_pmi=min_pmi)
+        extract_phrases_pmi_duckdb(con, fts_schema="fts_main_documents", n=ngram_range[1], min_freq=min_freq, min_pmi=min_pmi, partitions=partitions, approx=approx, cache_dir=cache_dir)
         print("Extracted phrases:", con.execute("SELECT * FROM fts_main_documents.phrases LIMIT 10").fetchall())
 
         print("\nAdded phrases to dictionary:", con.execute(f"SELECT * FROM {fts_schema}.dict LIMIT 10").fetchall())
 
         print("\nAdded tokens to dictionary:", con.execute(f"SELECT * FROM {fts_schema}.dict WHERE term NOT LIKE '% %' LIMIT 10").fetchall())
-        con.execute(f"DROP TABLE IF EXISTS {fts_schema}.tokens")
         con.execute(f"DROP TABLE IF EXISTS {fts_schema}.phrases")
     elif mode == 'duckdb':
-        create_terms_table_duckdb(con, fts_schema=fts_schema, input_schema="main", input_table="documents", input_id="did", input_val="content")
         create_duckdb_dict_table(con, fts_schema=fts_schema, stopwords=stopwords)
     else:
         raise ValueError(f"Unknown dict table build mode: {mode}")
 
-def create_terms_table(con, fts_schema="fts_main_documents", input_schema="main", input_table="documents", input_id="did", input_val="content"):
+def create_terms_table(con, fts_schema="fts_main_documents", partitions=1):
     """
-    Create the terms table with unique terms per docid.
-    Assumes the table fts_main_documents.dict already exists.
-    Adds a fieldid and termid column for compatibility with fielded search macros.
+    Create the terms table by segmenting the token stream with the dict table.
+    Segmentation is greedy longest match from left to right: the longest
+    phrase from the dictionary is taken if it starts at a position that is
+    not part of an earlier phrase, otherwise the single token is taken
+    if it is in the dictionary.
+    The terms table has one posting (docid, fieldid, termid, tf) for each
+    term in each document; fieldid is for compatibility with fielded
+    search macros.
+    Documents are segmented independently, in the given number of docid
+    ranges, to bound the memory needed.
     """
-    # Cleanup input text using the same regex as DuckDB's tokenizer
-    con.sql(f"""
-        CREATE OR REPLACE TABLE {fts_schema}.cleaned_docs AS
-        SELECT
-            {input_id},
-            regexp_replace(lower(strip_accents(CAST({input_val} AS VARCHAR))),
-                '[0-9!@#$%^&*()_+={{}}\\[\\]:;<>,.?~\\\\/\\|''''"`-]+', ' ', 'g') AS content,
-        FROM {input_schema}.{input_table}
-    """)
-
-    # Use the ciff tokenizer to find bigrams and unigrams
+    max_n = max_term_length(con, fts_schema)
+    ahead = ", ".join(["tokenid"] + [f"LEAD(tokenid, {k}) OVER w" for k in range(1, max_n)])
+    num_docs = con.sql(f"SELECT COALESCE(MAX(docid), 0) FROM {fts_schema}.tokens").fetchone()[0]
+    step = num_docs // max(partitions, 1) + 1
     con.sql(f"""
-        CREATE OR REPLACE TABLE {fts_schema}.terms AS (
-            SELECT
-                0 AS fieldid,
-                d.termid,
-                t.docid
+        CREATE OR REPLACE TEMP TABLE dict_tokens AS
+        WITH dict_words AS (
+            SELECT termid, len(words) AS n,
+                generate_subscripts(words, 1) AS i, unnest(words) AS word
             FROM (
-                SELECT
-                    row_number() OVER () AS docid,
-                    unnest({fts_schema}.tokenize(content)) AS term
-                FROM {fts_schema}.cleaned_docs
-            ) AS t
-            JOIN {fts_schema}.dict d ON t.term = d.term
-            WHERE t.term != ''
-        );
-    """)
-
-
-def create_terms_table_duckdb(con, fts_schema="fts_main_documents", input_schema="main", input_table="documents", input_id="did", input_val="content"):
-    """
-    Step 1: Create the initial terms table (term, docid).
-    """
-    con.sql(f"""
-        CREATE OR REPLACE TABLE {fts_schema}.terms AS (
-            SELECT
-                row_number() OVER () AS docid,
-                unnest({fts_schema}.tokenize({input_val})) AS term
-            FROM {input_schema}.{input_table}
-            WHERE {input_val} != ''
-        );
+                SELECT termid, string_split(term, ' ') AS words
+                FROM {fts_schema}.dict
+                WHERE term != ''
+            )
+        )
+        -- terms with a word that is not in the vocabulary never match
+        SELECT d.termid, any_value(d.n) AS n, list_transform(list_sort(list([d.i, v.tokenid])), x -> x[2]) AS tokenids
+        FROM dict_words d
+        JOIN {fts_schema}.vocab v ON v.token = d.word
+        GROUP BY d.termid
+        HAVING COUNT(*) = any_value(d.n)
     """)
-
-def assign_termids_to_terms(con, fts_schema="fts_main_documents"):
-    """
-    Step 3: Recreate the terms table, joining with dict to assign termid.
-    """
+    for first in range(1, max(num_docs, 1) + 1, step):
+        tokens = f"(SELECT * FROM {fts_schema}.tokens WHERE docid >= {first} AND docid < {first + step})"
+        create = f"CREATE OR REPLACE TABLE {fts_schema}.terms AS" if first == 1 else f"INSERT INTO {fts_schema}.terms"
+        create_terms_partition(con, fts_schema, create, tokens, max_n, ahead)
+    con.sql("DROP TABLE dict_tokens")
+
+def create_terms_partition(con, fts_schema, create, tokens, max_n, ahead):
+    """ Segment the token stream rows in tokens, see create_terms_table. """
     con.sql(f"""
-        CREATE OR REPLACE TABLE {fts_schema}.terms AS (
-            SELECT
-                0 AS fieldid,
-                d.termid,
-                t.docid,
-                t.term,
-                row_number() OVER (PARTITION BY t.docid) AS pos
-            FROM {fts_schema}.terms t
-            JOIN {fts_schema}.dict d ON t.term = d.term
-            WHERE t.term != ''
+        {create} (
+            WITH windows AS (
+                SELECT docid, pos, list_value({ahead}) AS ahead
+                FROM {tokens}
+                WINDOW w AS (PARTITION BY docid ORDER BY pos)
+            ),
+            ngrams AS (
+                SELECT w.docid, w.pos, k.n, w.ahead[1:k.n] AS tokenids
+                FROM windows w, (SELECT DISTINCT n FROM dict_tokens WHERE n > 1) k
+                WHERE w.ahead[1] IN (SELECT tokenids[1] FROM dict_tokens WHERE n > 1)
+            ),
+            longest AS (
+                SELECT g.docid, g.pos, arg_max(d.termid, d.n) AS termid, max(d.n) AS n
+                FROM ngrams g
+                JOIN dict_tokens d ON d.n = g.n AND d.tokenids = g.tokenids
+                GROUP BY g.docid, g.pos
+            ),
+            islands AS MATERIALIZED (
+                -- overlapping phrases form an island, islands are segmented independently
+                SELECT docid, pos, termid, n,
+                    SUM(new_island) OVER (PARTITION BY docid ORDER BY pos) AS island
+                FROM (
+                    SELECT *, CASE WHEN pos <= MAX(pos + n - 1) OVER (PARTITION BY docid ORDER BY pos
+                        ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING) THEN 0 ELSE 1 END AS new_island
+                    FROM longest
+                )
+            ),
+            island_starts AS (
+                -- left to right, a phrase is taken if the previous one ended before it.
+                -- Overlapping bigrams are consecutive, so every other one is taken;
+                -- otherwise the accumulator is [next start, start, start, ...]
+                SELECT docid, island, MIN(pos) AS first, MAX(n) AS max_n,
+                    CASE WHEN MAX(n) > 2 THEN list_reduce(list_transform(list_sort(list([pos, pos + n])), x -> [x[2], x[1]]),
+                        (acc, x) -> CASE WHEN x[2] >= acc[1] THEN [x[1]] || acc[2:] || [x[2]] ELSE acc END)[2:] END AS starts
+                FROM islands
+                GROUP BY docid, island
+            ),
+            phrase_matches AS MATERIALIZED (
+                SELECT i.docid, i.pos, i.termid, i.n
+                FROM islands i
+                JOIN island_starts s ON i.docid = s.docid AND i.island = s.island
+                WHERE CASE WHEN s.max_n = 2 THEN (i.pos - s.first) % 2 = 0 ELSE list_contains(s.starts, i.pos) END
+            ),
+            covered AS (
+                SELECT p.docid, p.pos + k.offset AS pos
+                FROM phrase_matches p
+                JOIN (SELECT unnest(range({max_n})) AS offset) k ON k.offset < p.n
+            ),
+            token_matches AS (
+                SELECT t.docid, t.pos, u.termid
+                FROM {tokens} t
+                JOIN dict_tokens u ON u.n = 1 AND t.tokenid = u.tokenids[1]
+                ANTI JOIN covered c ON t.docid = c.docid AND t.pos = c.pos
+            )
+            SELECT docid, 0 AS fieldid, termid, COUNT(*) AS tf
+            FROM (
+                SELECT docid, pos, termid FROM phrase_matches
+                UNION ALL
+                SELECT * FROM token_matches
+            )
+            GROUP BY docid, termid
+            ORDER BY docid, termid
         );
     """)
 
 def update_docs_table(con, fts_schema="fts_main_documents"):
     """
-    Create the documents table.
-    input_id should be the column name in input_table that uniquely identifies each document (e.g., 'did').
+    Recompute the document lengths (len) of the docs table.
+    The lengths are computed in one GROUP BY pass over the terms table,
+    and the new table replaces the old one.
     """
-    # Remove old 'len' column if it exists, then add and populate a fresh one
-    con.sql(f"ALTER TABLE {fts_schema}.docs DROP COLUMN IF EXISTS len;")
-    con.sql(f"ALTER TABLE {fts_schema}.docs ADD COLUMN len INT;")
     con.sql(f"""
-        UPDATE {fts_schema}.docs d
-        SET len = (
-            SELECT COUNT(termid)
-            FROM {fts_schema}.terms t
-            WHERE t.docid = d.docid
-        );
+        CREATE OR REPLACE TABLE {fts_schema}.docs_new AS
+        WITH doc_len AS (
+            SELECT docid, SUM(tf) AS len
+            FROM {fts_schema}.terms
+            GROUP BY docid
+        )
+        SELECT d.docid, d.name, COALESCE(l.len, 0)::INT AS len
+        FROM {fts_schema}.docs d
+        LEFT JOIN doc_len l ON l.docid = d.docid
+        ORDER BY d.docid;
+        DROP TABLE {fts_schema}.docs;
+        ALTER TABLE {fts_schema}.docs_new RENAME TO docs;
     """)
 
 def update_dict_table(con, fts_schema="fts_main_documents"):
     """
     Update the dictionary table with document frequency (df).
     Assumes the table fts_main_documents.dict already exists.
+    The frequencies are computed in one GROUP BY pass over the terms
+    table, and the new table replaces the old one.
     """
-    con.sql(f"ALTER TABLE {fts_schema}.dict ADD COLUMN IF NOT EXISTS df BIGINT;")
     con.sql(f"""
-        UPDATE {fts_schema}.dict d
-        SET df = (
-            SELECT count(DISTINCT docid)
-            FROM {fts_schema}.terms t
-            WHERE t.termid = d.termid
-        );
+        CREATE OR REPLACE TABLE {fts_schema}.dict_new AS
+        WITH term_df AS (
+            SELECT termid, count(DISTINCT docid) AS df
+            FROM {fts_schema}.terms
+            GROUP BY termid
+        )
+        SELECT d.termid, d.term, COALESCE(t.df, 0)::BIGINT AS df
+        FROM (SELECT rowid AS nr, termid, term FROM {fts_schema}.dict) d
+        LEFT JOIN term_df t ON t.termid = d.termid
+        ORDER BY d.nr;
+        DROP TABLE {fts_schema}.dict;
+        ALTER TABLE {fts_schema}.dict_new RENAME TO dict;
     """)
 
 def limit_dict_table(con, max_terms=10000, fts_schema="fts_main_documents"):
@@ -405,14 +483,17 @@ def create_fields_table(con, fts_schema="fts_main_documents"):
     ''')
 
 def index_documents(db_name, ir_dataset, stemmer='none', stopwords='none',
-                     logging=True, keepcontent=False, limit=10000, mode='duckdb', min_freq=10, min_pmi=5.0):
+                     logging=True, keepcontent=False, limit=10000, mode='duckdb', min_freq=10, min_pmi=5.0,
+                     max_ngram=2, batch_size=10000, queue_depth=4, partitions=1, memory_limit=None, approx=False, cache_dir=None):
     """
     Insert and index documents.
     """
     if pathlib.Path(db_name).is_file():
         raise ValueError(f"File {db_name} already exists.")
     con = duckdb.connect(db_name)
-    insert_dataset(con, ir_dataset, logging)
+    if memory_limit:
+        con.sql(f"SET memory_limit = '{memory_limit}'")
+    insert_dataset(con, ir_dataset, logging, batch_size, queue_depth)
     if logging:
         print("Indexing...", file=sys.stderr)
 
@@ -429,41 +510,43 @@ def index_documents(db_name, ir_dataset, stemmer='none', stopwords='none',
 
     create_tokenizer_duckdb(con)
 
+    # Tokenize the documents once, all further steps read the token stream
+    start = time.perf_counter()
+    create_token_stream(con, fts_schema="fts_main_documents", input_schema="main", input_table="documents", input_val="content")
+    print(f"Created fts_main_documents.tokens ({time.perf_counter() - start:.2f}s).")
+
     # Create the dict table
-    build_dict_table(con, mode=mode, fts_schema="fts_main_documents", stopwords=stopwords, ngram_range=(1,2), min_freq=min_freq, min_pmi=min_pmi)
+    build_dict_table(con, mode=mode, fts_schema="fts_main_documents", stopwords=stopwords, ngram_range=(1,max_ngram), min_freq=min_freq, min_pmi=min_pmi, partitions=partitions, approx=approx, cache_dir=cache_dir)
 
-    create_tokenizer_ciff(con)
+    create_tokenizer_phrases(con)
 
     dict = con.sql("SELECT * FROM fts_main_documents.dict LIMIT 10").df()
     print("fts_main_documents.dict:\n", dict)
 
-    # Clean up the terms table
-    if mode == 'phrases':
-        con.sql("DROP TABLE IF EXISTS fts_main_documents.terms;")
-        create_terms_table(con, input_schema="main", input_table="documents", input_id="did", input_val="content")
-    else:
-        assign_termids_to_terms(con, fts_schema="fts_main_documents")
+    create_terms_table(con, fts_schema="fts_main_documents", partitions=partitions)
 
     terms = con.sql("SELECT * FROM fts_main_documents.terms LIMIT 10").df()
     print("fts_main_documents.terms:\n", terms)
 
-    update_docs_table(con, fts_schema="fts_main_documents")
-
-    docs = con.sql("SELECT * FROM fts_main_documents.docs LIMIT 10").df()
-    print("fts_main_documents.docs:\n", docs)
-
+    start = time.perf_counter()
     update_dict_table(con, fts_schema="fts_main_documents")
-    print("Updated fts_main_documents.dict with document frequencies.")
+    print(f"Updated fts_main_documents.dict with document frequencies ({time.perf_counter() - start:.2f}s).")
 
 
     # Limit the dictionary to the `max_terms` most frequent terms
     if limit > 0:
         limit_dict_table(con, max_terms=limit, fts_schema="fts_main_documents")
-        create_terms_table(con, fts_schema="fts_main_documents", input_schema="main", input_table="documents", input_id="did", input_val="content")
+        create_terms_table(con, fts_schema="fts_main_documents", partitions=partitions)
         update_dict_table(con, fts_schema="fts_main_documents")
         print("Limited fts_main_documents.dict to 10000 most frequent terms.")
 
+    # Document lengths only depend on the final terms table
+    start = time.perf_counter()
     update_docs_table(con, fts_schema="fts_main_documents")
+    print(f"Updated fts_main_documents.docs with document lengths ({time.perf_counter() - start:.2f}s).")
+
+    docs = con.sql("SELECT * FROM fts_main_documents.docs LIMIT 10").df()
+    print("fts_main_documents.docs:\n", docs)
 
     dict = con.sql("SELECT * FROM fts_main_documents.dict LIMIT 10").df()
     print("fts_main_documents.dict:\n", dict)
@@ -474,13 +557,16 @@ def index_documents(db_name, ir_dataset, stemmer='none', stopwords='none',
         WHERE df == 0;
     ''')
 
-    create_stats_table(con, fts_schema="fts_main_documents", index_type="standard", stemmer=stemmer)
+    drop_token_stream(con, fts_schema="fts_main_documents")
+
+    create_stats_table(con, fts_schema="fts_main_documents", index_type="tf", stemmer=stemmer)
 
     stats = con.sql("SELECT * FROM fts_main_documents.stats").df()
     print("fts_main_documents.stats:\n", stats)
 
     create_fields_table(con, fts_schema="fts_main_documents")
     create_lm(con, stemmer)
+    create_bm25(con, stemmer)
     con.close()
 
 
@@ -500,6 +586,13 @@ if __name__ == "__main__":
     parser.add_argument('--limit', type=int, default=10000, help='Limit the number of terms in the dictionary')
     parser.add_argument('--min-freq', type=int, default=10, help='Minimum frequency for phrases (only for mode "phrases")')
     parser.add_argument('--min-pmi', type=float, default=5.0, help='Minimum PMI for phrases (only for mode "phrases")')
+    parser.add_argument('--max-ngram', type=int, default=2, help='Maximum number of words in a phrase (only for mode "phrases")')
+    parser.add_argument('--partitions', type=int, default=1, help='Number of on-disk hash partitions for phrase statistics (only for mode "phrases")')
+    parser.add_argument('--approx', action='store_true', help='Estimate token and bigram statistics in two streaming passes (only for mode "phrases")')
+    parser.add_argument('--stats-cache', type=str, default=None, help='Directory to cache phrase statistics for reuse with other thresholds (only for mode "phrases")')
+    parser.add_argument('--memory-limit', type=str, default=None, help='DuckDB memory limit while indexing (e.g., 4GB)')
+    parser.add_argument('--batch-size', type=int, default=10000, help='Number of documents per insert batch')
+    parser.add_argument('--queue-depth', type=int, default=4, help='Maximum number of document batches read ahead')
     args = parser.parse_args()
 
     dataset = None
@@ -522,6 +615,13 @@ if __name__ == "__main__":
         mode=args.mode,
         limit=args.limit,
         min_freq=args.min_freq,
-        min_pmi=args.min_pmi
+        min_pmi=args.min_pmi,
+        max_ngram=args.max_ngram,
+        partitions=args.partitions,
+        memory_limit=args.memory_limit,
+        approx=args.approx,
+        cache_dir=args.stats_cache,
+        batch_size=args.batch_size,
+        queue_depth=args.queue_depth
     )
     print("")
\ No newline at end of file
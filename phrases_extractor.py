@@ -1,3 +1,6 @@
+import hashlib
+import os
+import tempfile
 import duckdb
 from collections import Counter
 
@@ -40,79 +43,270 @@ def extract_phrases(documents, n=2, min_freq=2, db_path='phrases.db'):
     phrases = [" ".join(ngram) for ngram, freq in ngram_counter.items() if freq >= min_freq]
     return phrases
 
-def extract_phrases_pmi_duckdb(con, fts_schema, n=2, min_freq=2, min_pmi=3.0):
-    # 1. Create a tokenized table
-    con.execute(f"""CREATE OR REPLACE TABLE {fts_schema}.tokens AS
-        SELECT
-            did AS doc_id,
-            unnest({fts_schema}.tokenize(content)) AS token
-        FROM
-            documents;
+def count_ngrams(con, target, source, key, name, min_freq=1, partitions=1):
+    """
+    Insert the frequency and document frequency of every value of key
+    (an expression over source, which has a docid column) that occurs
+    at least min_freq times into the table target (name, freq, doc_freq).
+    With more than one partition the rows of source are first written
+    to disk, hash-partitioned by key, and each partition is counted on
+    its own, so no single GROUP BY has to hold all keys in memory.
+    """
+    if partitions <= 1:
+        con.execute(f"""
+            INSERT INTO {target}
+            SELECT {key} AS {name}, COUNT(*) AS freq, COUNT(DISTINCT docid) AS doc_freq
+            FROM {source}
+            GROUP BY {name}
+            HAVING COUNT(*) >= {min_freq}
+        """)
+        return
+    # partitions go next to DuckDB's spill files (by default next to the database)
+    temp_directory = con.execute("SELECT current_setting('temp_directory')").fetchone()[0]
+    with tempfile.TemporaryDirectory(prefix="ngram_partitions.", dir=os.path.dirname(temp_directory) or None) as partition_dir:
+        con.execute(f"""
+            COPY (
+                SELECT docid, {key} AS {name}, hash({key}) % {partitions} AS bucket
+                FROM {source}
+            ) TO '{partition_dir}' (FORMAT PARQUET, PARTITION_BY (bucket))
+        """)
+        for bucket in range(partitions):
+            path = os.path.join(partition_dir, f"bucket={bucket}")
+            if not os.path.isdir(path):
+                continue
+            con.execute(f"""
+                INSERT INTO {target}
+                SELECT {name}, COUNT(*) AS freq, COUNT(DISTINCT docid) AS doc_freq
+                FROM read_parquet('{path}/*.parquet')
+                GROUP BY {name}
+                HAVING COUNT(*) >= {min_freq}
+            """)
 
-    """)
+def approx_ngram_freq(con, fts_schema, min_freq=2, width=2**21, depth=4, batch_size=1000000):
+    """
+    Approximate token_freq and the bigrams of ngram_freq in two streaming
+    passes over the token stream, without a window or GROUP BY over all
+    bigram occurrences. The first pass counts tokens exactly and bigrams
+    in a count-min sketch (depth x width cells); every bigram whose
+    estimate reaches min_freq is a candidate. The second pass counts the
+    candidates exactly, which removes the sketch's false positives.
+    Document frequencies are counted distinct per batch, so a document
+    split over two batches may be counted twice: doc_freq is at most
+    (number of batches - 1) too high. Returns the number of batches.
+    """
+    import numpy as np
+    import pyarrow as pa
 
-    print("Tokenized documents:\n", con.execute(f"SELECT * FROM {fts_schema}.tokens LIMIT 10").fetchall())
+    (max_tokenid, ) = con.execute(f"SELECT MAX(tokenid) FROM {fts_schema}.tokens").fetchone()
+    vocab_size = (max_tokenid or 0) + 1
+    shift = np.uint64(64 - (width.bit_length() - 1))
+    multipliers = np.random.default_rng(42).integers(1, 2**62, size=depth, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
 
-    # 2. Add position index for each token in its document
-    con.execute(f"""
-        CREATE OR REPLACE TABLE {fts_schema}.tokens_pos AS
-        SELECT doc_id, token,
-               ROW_NUMBER() OVER (PARTITION BY doc_id ORDER BY rowid) AS pos
-        FROM {fts_schema}.tokens
-    """)
+    def stream():
+        """ Yield docids and tokenids, and docids and keys of the bigrams, per batch """
+        last = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+        # a plain scan returns the tokens in insertion order: (docid, pos)
+        reader = con.execute(f"SELECT docid, tokenid FROM {fts_schema}.tokens").fetch_record_batch(batch_size)
+        for batch in reader:
+            docids = batch.column(0).to_numpy().astype(np.int64)
+            tokenids = batch.column(1).to_numpy().astype(np.int64)
+            pair_docids = np.concatenate([last[0], docids])
+            pair_tokenids = np.concatenate([last[1], tokenids])
+            same = pair_docids[1:] == pair_docids[:-1]
+            keys = (pair_tokenids[:-1] * vocab_size + pair_tokenids[1:])[same]
+            last = (docids[-1:], tokenids[-1:])
+            yield docids, tokenids, pair_docids[1:][same], keys
 
-    # 3. Compute total token count
-    total_tokens = con.execute(f"SELECT COUNT(*)::DOUBLE FROM {fts_schema}.tokens_pos").fetchone()[0]
+    def count(keys, docids):
+        """ Distinct keys with their frequency and number of distinct docids (docids ascending) """
+        if len(keys) == 0:
+            return keys, keys, keys
+        span = int(docids[-1] - docids[0]) + 1
+        if int(keys.max()) < np.iinfo(np.int64).max // span:
+            # sort (key, docid) packed into one integer
+            packed = np.sort(keys * span + (docids - docids[0]))
+            keys, docids = packed // span, packed % span
+        else:
+            order = np.argsort(keys, kind='stable')
+            keys, docids = keys[order], docids[order]
+        new_key = np.ones(len(keys), dtype=bool)
+        new_key[1:] = keys[1:] != keys[:-1]
+        new_doc = new_key.copy()
+        new_doc[1:] |= docids[1:] != docids[:-1]
+        starts = np.flatnonzero(new_key)
+        return keys[starts], np.diff(np.append(starts, len(keys))), np.add.reduceat(new_doc, starts)
 
-    # 4. Compute token frequencies
-    con.execute(f"""
-        CREATE OR REPLACE TABLE {fts_schema}.token_freq AS
-        SELECT token,
-               COUNT(*) AS freq,
-               COUNT(DISTINCT doc_id) AS doc_freq
-        FROM {fts_schema}.tokens_pos
-        GROUP BY token
-    """)
-    print("Token frequency:\n", con.execute(f"SELECT * FROM {fts_schema}.token_freq LIMIT 10").fetchall())
+    def unique(values):
+        values = np.sort(values)
+        return values[np.append(True, values[1:] != values[:-1])] if len(values) else values
 
-    # 5. Compute bigrams (or n-grams)
-    con.execute(f"""
-        CREATE OR REPLACE TABLE {fts_schema}.ngrams AS
-        SELECT t1.token AS w1, t2.token AS w2,
-               t1.doc_id AS doc_id
-        FROM {fts_schema}.tokens_pos t1
-        JOIN {fts_schema}.tokens_pos t2
-        ON t1.doc_id = t2.doc_id AND t2.pos = t1.pos + 1
-    """)
+    # Pass 1: exact token counts, count-min sketch and candidates for bigrams
+    token_freq = np.zeros(vocab_size, dtype=np.int64)
+    token_doc_freq = np.zeros(vocab_size, dtype=np.int64)
+    sketch = np.zeros((depth, width), dtype=np.int64)
+    candidates = []
+    batches = 0
+    for (docids, tokenids, _, keys) in stream():
+        batches += 1
+        (tokens, freq, doc_freq) = count(tokenids, docids)
+        token_freq[tokens] += freq
+        token_doc_freq[tokens] += doc_freq
+        cells = [((keys.astype(np.uint64) * m) >> shift).astype(np.int64) for m in multipliers]
+        estimate = None
+        for row, cell in enumerate(cells):
+            sketch[row] += np.bincount(cell, minlength=width)
+        for row, cell in enumerate(cells):
+            estimate = sketch[row][cell] if estimate is None else np.minimum(estimate, sketch[row][cell])
+        if estimate is not None:
+            candidates.append(unique(keys[estimate >= min_freq]))
+    candidates = unique(np.concatenate(candidates)) if candidates else np.empty(0, dtype=np.int64)
 
-    # 6. Compute n-gram frequencies
+    # Pass 2: exact counts of the candidates
+    freq = np.zeros(len(candidates), dtype=np.int64)
+    doc_freq = np.zeros(len(candidates), dtype=np.int64)
+    for (_, _, pair_docids, keys) in stream():
+        (batch_keys, batch_freq, batch_doc_freq) = count(keys, pair_docids)
+        index = np.searchsorted(candidates, batch_keys)
+        found = index < len(candidates)
+        found[found] = candidates[index[found]] == batch_keys[found]
+        freq[index[found]] += batch_freq[found]
+        doc_freq[index[found]] += batch_doc_freq[found]
+
+    frequent = freq >= min_freq
+    print(f"Count-min sketch: {len(candidates)} candidates, {int(frequent.sum())} frequent bigrams")
+    tokens = np.flatnonzero(token_freq)
+    token_table = pa.table({'tokenid': tokens, 'freq': token_freq[tokens], 'doc_freq': token_doc_freq[tokens]})
+    ngram_table = pa.table({'w1': candidates[frequent] // vocab_size, 'w2': candidates[frequent] % vocab_size,
+                            'freq': freq[frequent], 'doc_freq': doc_freq[frequent]})
     con.execute(f"""
+        CREATE OR REPLACE TABLE {fts_schema}.token_freq AS
+        SELECT tokenid, freq, doc_freq FROM token_table;
         CREATE OR REPLACE TABLE {fts_schema}.ngram_freq AS
-        SELECT w1, w2, COUNT(*) AS freq,
-               COUNT(DISTINCT doc_id) AS doc_freq
-        FROM {fts_schema}.ngrams
-        GROUP BY w1, w2
-        HAVING COUNT(*) >= {min_freq}
+        SELECT [w1, w2] AS words, freq, doc_freq FROM ngram_table;
     """)
+    return batches
+
+def count_phrase_stats(con, fts_schema, n=2, min_freq=2, partitions=1, approx=False):
+    """
+    Count the statistics of the positional token stream {fts_schema}.tokens
+    (docid, pos, tokenid) into {fts_schema}.token_stats (token, freq,
+    doc_freq) and {fts_schema}.phrase_stats (phrase, freq, df, pmi), which
+    has every phrase of 2 up to n words that occurs at least min_freq
+    times. Token and n-gram statistics are counted in the given number of
+    hash partitions (see count_ngrams), or, with approx, token and bigram
+    statistics are estimated by approx_ngram_freq.
+    """
+    # 1. Compute total token count
+    total_tokens = con.execute(f"SELECT COUNT(*)::DOUBLE FROM {fts_schema}.tokens").fetchone()[0]
+
+    # 2. Compute token frequencies
+    if approx:
+        batches = approx_ngram_freq(con, fts_schema, min_freq)
+        print(f"Approximate statistics: doc_freq is at most {batches - 1} too high")
+    else:
+        con.execute(f"""
+            CREATE OR REPLACE TABLE {fts_schema}.token_freq
+                (tokenid BIGINT, freq BIGINT, doc_freq BIGINT)
+        """)
+        count_ngrams(con, f"{fts_schema}.token_freq", f"{fts_schema}.tokens",
+                     "tokenid", "tokenid", partitions=partitions)
+    print("Token frequency:\n", con.execute(f"""
+        SELECT token, freq, doc_freq
+        FROM {fts_schema}.token_freq JOIN {fts_schema}.vocab USING (tokenid)
+        LIMIT 10
+    """).fetchall())
+
+    # 3. Compute n-gram frequencies level by level. Bigrams are counted
+    #    in one scan of the token stream; a longer n-gram is only counted
+    #    where both of its (n-1)-gram parts are frequent (Apriori pruning),
+    #    so each level is built from the occurrences of the previous one
+    pairs = f"""(
+        SELECT docid, pos, tokenid AS w1,
+               LEAD(tokenid) OVER (PARTITION BY docid ORDER BY pos) AS w2
+        FROM {fts_schema}.tokens
+    )"""
+    if n > 2:
+        # the pair occurrences are needed again to build the trigrams
+        con.execute(f"CREATE OR REPLACE TEMP TABLE ngram_pairs AS SELECT * FROM {pairs}")
+        pairs = "ngram_pairs"
+    if not approx:
+        con.execute(f"""
+            CREATE OR REPLACE TABLE {fts_schema}.ngram_freq
+                (words BIGINT[], freq BIGINT, doc_freq BIGINT)
+        """)
+        count_ngrams(con, f"{fts_schema}.ngram_freq", f"(SELECT * FROM {pairs} WHERE w2 IS NOT NULL)",
+                     "[w1, w2]", "words", min_freq, partitions)
+    if n > 2:
+        con.execute(f"""
+            CREATE OR REPLACE TEMP TABLE ngram_occ AS
+            SELECT p.docid, p.pos, [p.w1, p.w2] AS words
+            FROM ngram_pairs p
+            SEMI JOIN {fts_schema}.ngram_freq f ON f.words = [p.w1, p.w2];
+            DROP TABLE ngram_pairs;
+        """)
+    for level in range(3, n + 1):
+        con.execute(f"""
+            CREATE OR REPLACE TEMP TABLE ngram_candidates AS
+            SELECT a.docid, a.pos, list_append(a.words, b.words[-1]) AS words
+            FROM ngram_occ a
+            JOIN ngram_occ b ON b.docid = a.docid AND b.pos = a.pos + 1;
+            CREATE OR REPLACE TEMP TABLE ngram_level
+                (words BIGINT[], freq BIGINT, doc_freq BIGINT);
+        """)
+        count_ngrams(con, "ngram_level", "ngram_candidates", "words", "words", min_freq, partitions)
+        count = con.execute(f"""
+            INSERT INTO {fts_schema}.ngram_freq SELECT * FROM ngram_level;
+            CREATE OR REPLACE TEMP TABLE ngram_occ AS
+            SELECT c.* FROM ngram_candidates c
+            SEMI JOIN ngram_level l ON l.words = c.words;
+            SELECT COUNT(*) FROM ngram_level;
+        """).fetchone()[0]
+        print(f"Number of {level}-grams: {count}")
+        if count == 0:
+            break
+    con.execute("DROP TABLE IF EXISTS ngram_candidates")
+    con.execute("DROP TABLE IF EXISTS ngram_level")
+    con.execute("DROP TABLE IF EXISTS ngram_occ")
     
     print("N-gram frequency:\n", con.execute(f"SELECT * FROM {fts_schema}.ngram_freq LIMIT 10").fetchall())
     print(f"Number of n-grams: {con.execute(f'SELECT COUNT(*) FROM {fts_schema}.ngram_freq').fetchone()[0]}")
-    # 7. Compute PMI for bigrams
+    # 4. Compute PMI for n-grams: log2(P(w1..wn) / (P(w1) * ... * P(wn)))
+    levels = []
+    for k in range(2, n + 1):
+        positions = range(1, k + 1)
+        levels.append(f"""
+            SELECT {" || ' ' || ".join(f"v{i}.token" for i in positions)} AS phrase,
+                LOG(n.freq * {" * ".join([str(total_tokens)] * (k - 1))} / ({" * ".join(f"f{i}.freq::DOUBLE" for i in positions)})) / LOG(2) AS pmi,
+                n.freq, n.doc_freq AS df
+            FROM {fts_schema}.ngram_freq n
+            {" ".join(f"JOIN {fts_schema}.token_freq f{i} ON n.words[{i}] = f{i}.tokenid" for i in positions)}
+            {" ".join(f"JOIN {fts_schema}.vocab v{i} ON n.words[{i}] = v{i}.tokenid" for i in positions)}
+            WHERE len(n.words) = {k}
+        """)
+    con.execute(f"""
+        CREATE OR REPLACE TABLE {fts_schema}.phrase_stats AS
+        SELECT phrase, freq, df, pmi FROM ({" UNION ALL ".join(levels)});
+        CREATE OR REPLACE TABLE {fts_schema}.token_stats AS
+        SELECT token, freq, doc_freq
+        FROM {fts_schema}.token_freq JOIN {fts_schema}.vocab USING (tokenid);
+        DROP TABLE {fts_schema}.token_freq;
+        DROP TABLE {fts_schema}.ngram_freq;
+    """)
+
+def create_phrase_dict(con, fts_schema, min_freq=2, min_pmi=3.0):
+    """
+    Build the phrases table and the dict table from the phrase and token
+    statistics (see count_phrase_stats) that pass min_freq and min_pmi.
+    """
     con.execute(f"""
         CREATE OR REPLACE TABLE {fts_schema}.phrases AS
-        SELECT w1 || ' ' || w2 AS phrase,
-            LOG(n.freq * {total_tokens} / (f1.freq * f2.freq)) / LOG(2) AS pmi,
-            n.doc_freq AS df
-        FROM {fts_schema}.ngram_freq n
-        JOIN {fts_schema}.token_freq f1 ON n.w1 = f1.token
-        JOIN {fts_schema}.token_freq f2 ON n.w2 = f2.token
-        WHERE LOG(n.freq * {total_tokens} / (f1.freq * f2.freq)) / LOG(2) >= {min_pmi}
+        SELECT phrase, pmi, df FROM {fts_schema}.phrase_stats
+        WHERE freq >= {min_freq} AND pmi >= {min_pmi}
         ORDER BY pmi DESC
     """)
 
     print("Extracted phrases:\n", con.execute(f"SELECT phrase, pmi, df FROM {fts_schema}.phrases LIMIT 10").fetchall())
-    print("Extracted tokens:\n", con.execute(f"SELECT token FROM {fts_schema}.token_freq LIMIT 10").fetchall())
-    # 8. Combine phrases and words
+    # Combine phrases and words
     con.execute(f"""
         CREATE OR REPLACE TABLE {fts_schema}.dict AS
         SELECT ROW_NUMBER() OVER () AS termid, phrase as term, df
@@ -123,14 +317,82 @@ def extract_phrases_pmi_duckdb(con, fts_schema, n=2, min_freq=2, min_pmi=3.0):
         )
         UNION ALL
         SELECT ROW_NUMBER() OVER () + (SELECT COUNT(*) FROM {fts_schema}.phrases) AS termid, token AS term, doc_freq AS df
-        FROM {fts_schema}.token_freq
+        FROM {fts_schema}.token_stats
         WHERE token NOT IN (SELECT sw FROM {fts_schema}.stopwords)
           AND freq >= {min_freq}
     """)
     
     print("Phrases:\n", con.execute(f"SELECT term, df FROM {fts_schema}.dict LIMIT 10").fetchall())
 
-    con.execute(f"DROP TABLE IF EXISTS {fts_schema}.tokens_pos")
-    con.execute(f"DROP TABLE IF EXISTS {fts_schema}.token_freq")
-    con.execute(f"DROP TABLE IF EXISTS {fts_schema}.ngrams")
-    con.execute(f"DROP TABLE IF EXISTS {fts_schema}.ngram_freq")
+def phrase_stats_key(con, fts_schema, n=2, approx=False):
+    """
+    Cache key of the phrase statistics: a hash of the content of the
+    token stream and the settings that change the statistics.
+    """
+    (content, ) = con.execute(f"""
+        SELECT hash(
+            (SELECT bit_xor(hash(docid, pos, tokenid)) FROM {fts_schema}.tokens),
+            (SELECT bit_xor(hash(tokenid, token)) FROM {fts_schema}.vocab),
+            (SELECT COUNT(*) FROM {fts_schema}.tokens)
+        )
+    """).fetchone()
+    return hashlib.sha256(f"{content}:{n}:{approx}".encode()).hexdigest()[:16]
+
+def load_phrase_stats(con, fts_schema, path, min_freq):
+    """
+    Load token_stats and phrase_stats from the cache file path if it
+    exists and was counted with a min_freq of at most min_freq.
+    Returns True if the statistics were loaded.
+    """
+    if not os.path.exists(path):
+        return False
+    con.execute(f"ATTACH '{path}' AS phrase_stats_cache (READ_ONLY)")
+    try:
+        (cached_min_freq, ) = con.execute("SELECT min_freq FROM phrase_stats_cache.settings").fetchone()
+        if cached_min_freq > max(min_freq, 1):
+            return False
+        con.execute(f"""
+            CREATE OR REPLACE TABLE {fts_schema}.token_stats AS
+            SELECT * FROM phrase_stats_cache.token_stats;
+            CREATE OR REPLACE TABLE {fts_schema}.phrase_stats AS
+            SELECT * FROM phrase_stats_cache.phrase_stats WHERE freq >= {min_freq};
+        """)
+        return True
+    finally:
+        con.execute("DETACH phrase_stats_cache")
+
+def save_phrase_stats(con, fts_schema, path, min_freq):
+    """ Write token_stats and phrase_stats, counted with min_freq, to the cache file path """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    con.execute(f"""
+        ATTACH '{temp_path}' AS phrase_stats_cache;
+        CREATE TABLE phrase_stats_cache.settings AS SELECT {max(min_freq, 1)} AS min_freq;
+        CREATE TABLE phrase_stats_cache.token_stats AS SELECT * FROM {fts_schema}.token_stats;
+        CREATE TABLE phrase_stats_cache.phrase_stats AS SELECT * FROM {fts_schema}.phrase_stats;
+        DETACH phrase_stats_cache;
+    """)
+    os.replace(temp_path, path)
+
+def extract_phrases_pmi_duckdb(con, fts_schema, n=2, min_freq=2, min_pmi=3.0, partitions=1, approx=False, cache_dir=None):
+    """
+    Extract phrases of 2 up to n words from the positional token stream
+    {fts_schema}.tokens (docid, pos, tokenid) and build the dict table
+    from phrases and tokens. With a cache_dir, the phrase statistics are
+    stored there per token stream content, n and approx, so another run
+    over the same documents with a min_freq that is at least as high
+    (and any min_pmi or stopwords) only applies its thresholds.
+    """
+    path = None
+    if cache_dir:
+        path = os.path.join(cache_dir, f"phrase_stats_{phrase_stats_key(con, fts_schema, n, approx)}.db")
+    if path and load_phrase_stats(con, fts_schema, path, min_freq):
+        print(f"Loaded phrase statistics from {path}")
+    else:
+        count_phrase_stats(con, fts_schema, n, min_freq, partitions, approx)
+        if path:
+            save_phrase_stats(con, fts_schema, path, min_freq)
+            print(f"Saved phrase statistics to {path}")
+    create_phrase_dict(con, fts_schema, min_freq, min_pmi)
+    con.execute(f"DROP TABLE IF EXISTS {fts_schema}.token_stats")
+    con.execute(f"DROP TABLE IF EXISTS {fts_schema}.phrase_stats")
@@ -0,0 +1,43 @@
+"""
+Tests of reindexing: the postings of a reindexed copy keep the
+column types of the original index.
+Run from the repository root: python -m pytest tests
+"""
+
+import duckdb
+import pytest
+
+import ze_eval
+import ze_index
+import ze_reindex
+import ze_reindex_group
+
+
+@pytest.fixture(scope='module')
+def db_name(tmp_path_factory):
+    name = str(tmp_path_factory.mktemp('reindex') / 'test.db')
+    ze_index.index_documents(name, ze_eval.ir_dataset_test(), logging=False)
+    return name
+
+
+def column_type(name, table, column):
+    con = duckdb.connect(name, read_only=True)
+    try:
+        return con.sql(f"""
+            SELECT data_type FROM duckdb_columns()
+            WHERE schema_name = 'fts_main_documents' AND table_name = '{table}' AND column_name = '{column}'
+        """).fetchone()[0]
+    finally:
+        con.close()
+
+
+def test_group_keeps_tf_type(db_name, tmp_path):
+    name_out = str(tmp_path / 'group.db')
+    ze_reindex_group.reindex_group(db_name, name_out)
+    assert column_type(name_out, 'terms', 'tf') == column_type(db_name, 'terms', 'tf') == 'BIGINT'
+
+
+def test_steps_group_keeps_tf_type(db_name, tmp_path):
+    name_out = str(tmp_path / 'steps.db')
+    ze_reindex.reindex(db_name, name_out, ['group'])
+    assert column_type(name_out, 'terms', 'tf') == column_type(db_name, 'terms', 'tf')
@@ -0,0 +1,78 @@
+"""
+Tests of the search engines: engines numpy and varbyte return the LM and
+BM25 hits of engine duckdb, also on an index with the document priors of
+reindex_prior; the result cache drops the hits of a changed index.
+Run from the repository root: python -m pytest tests
+"""
+
+import shutil
+
+import duckdb
+import pytest
+
+import ze_compress
+import ze_csr
+import ze_eval
+import ze_index
+import ze_reindex_prior
+import ze_search
+
+
+QUERIES = [query.text for query in ze_eval.ir_dataset_test().queries_iter()] + [
+    'retrieval', 'learning models', 'neural networks for search', 'unknownterm']
+
+
+@pytest.fixture(scope='module')
+def db_name(tmp_path_factory):
+    path = tmp_path_factory.mktemp('search')
+    ze_index.index_documents(str(path / 'test.db'), ze_eval.ir_dataset_test(), logging=False)
+    name = str(path / 'prior.db')
+    ze_reindex_prior.reindex_prior(str(path / 'test.db'), name, init='uniform')
+    ze_csr.csr_export(name)
+    ze_compress.compress_index(name)
+    return name
+
+
+def search(con, index, matcher, query):
+    """ Top 5 of matcher for query by engine duckdb (index None) or on
+        index; the summation order may change the last bits of a score
+    """
+    if matcher == 'lm' and index is None:
+        hits = ze_search.duckdb_search_lm(con, query, 5)
+    elif matcher == 'lm':
+        hits = ze_search.numpy_search_lm(index, con, query, 5)
+    elif index is None:
+        hits = ze_search.duckdb_search_bm25(con, query, 5, b=0.4, k=0.9)
+    else:
+        hits = ze_search.numpy_search_bm25(index, con, query, 5, b=0.4, k=0.9)
+    return [(docname, round(score, 9)) for (docname, score, _) in hits]
+
+
+@pytest.mark.parametrize('matcher', ['lm', 'bm25'])
+@pytest.mark.parametrize('engine', ['numpy', 'varbyte'])
+def test_engine_matches_duckdb(db_name, engine, matcher):
+    con = duckdb.connect(db_name, read_only=True)
+    try:
+        if engine == 'numpy':
+            index = ze_csr.CSRIndex(ze_csr.csr_path(db_name))
+        else:
+            index = ze_compress.VarbyteIndex(con)
+        for query in QUERIES:
+            assert search(con, index, matcher, query) == search(con, None, matcher, query)
+    finally:
+        con.close()
+
+
+def test_cache_drops_entries_of_changed_index(db_name, tmp_path):
+    name = str(tmp_path / 'cached.db')
+    shutil.copyfile(db_name, name)
+    cache = ze_search.ResultCache(10)
+    cache.check_index(name)
+    cache.put('key', [('doc', 1.0, 1)])
+    cache.check_index(name)
+    assert cache.get('key') == [('doc', 1.0, 1)]
+    con = duckdb.connect(name)
+    con.sql("UPDATE fts_main_documents.docs SET prior = 2")
+    con.close()
+    cache.check_index(name)
+    assert cache.get('key') is None
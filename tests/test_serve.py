@@ -0,0 +1,111 @@
+"""
+Tests of ze_serve: the responses of a SearchServer on a free port to
+searches, to malformed requests, and to searches beyond max_pending.
+Run from the repository root: python -m pytest tests
+"""
+
+import asyncio
+import json
+import threading
+
+import pytest
+
+import ze_eval
+import ze_index
+import ze_search
+import ze_serve
+
+
+SEARCH = b"GET /search?q=information+retrieval&top=3 HTTP/1.1\r\n\r\n"
+
+
+@pytest.fixture(scope='module')
+def db_name(tmp_path_factory):
+    name = str(tmp_path_factory.mktemp('serve') / 'test.db')
+    ze_index.index_documents(name, ze_eval.ir_dataset_test(), logging=False)
+    return name
+
+
+async def request(port, data):
+    """ Status, JSON object and connection header of the response to data """
+    (reader, writer) = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        writer.write(data)
+        await writer.drain()
+        status = int((await reader.readline()).split()[1])
+        headers = {}
+        line = await reader.readline()
+        while line.strip():
+            (name, value) = line.decode('latin-1').split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+            line = await reader.readline()
+        result = json.loads(await reader.readexactly(int(headers['content-length'])))
+        if headers['connection'] == 'close':
+            assert await reader.read() == b''
+        return status, result, headers['connection']
+    finally:
+        writer.close()
+
+
+def run_server(db_name, test, **options):
+    """ Run the coroutine test(server, port) with a server on a free port """
+    server = ze_serve.SearchServer(db_name, **options)
+
+    async def main():
+        port = await server.start('127.0.0.1', 0)
+        await test(server, port)
+
+    try:
+        asyncio.run(main())
+    finally:
+        server.close()
+
+
+def test_search(db_name):
+    async def test(server, port):
+        (status, result, connection) = await request(port, SEARCH)
+        assert (status, connection) == (200, 'keep-alive')
+        hits = ze_search.duckdb_search_lm(server.con.cursor(), 'information retrieval', 3)
+        assert [(h['docname'], h['score'], h['postings_cost']) for h in result['hits']] == hits
+        (status, result, _) = await request(port, b'POST /search HTTP/1.1\r\nContent-Length: 34\r\n\r\n'
+                                                  b'{"q": "retrieval", "matcher": "x"}')
+        assert status == 400
+        assert server.statuses == {200: 1, 400: 1}
+
+    run_server(db_name, test)
+
+
+@pytest.mark.parametrize('data', [
+    b"GARBAGE\r\n\r\n",
+    b"GET /search?q=retrieval HTTP/1.1 extra\r\n\r\n",
+    b"GET /search?q=retrieval HTTP/1.1\r\nno colon\r\n\r\n",
+    b"POST /search HTTP/1.1\r\nContent-Length: -1\r\n\r\n",
+])
+def test_malformed_request(db_name, data):
+    async def test(server, port):
+        (status, result, connection) = await request(port, data)
+        assert (status, connection) == (400, 'close')
+        assert 'Malformed' in result['error']
+
+    run_server(db_name, test)
+
+
+def test_too_many_pending(db_name):
+    release = threading.Event()
+
+    async def test(server, port):
+        search = server.search
+        server.search = lambda params: release.wait() and search(params)
+        try:
+            first = asyncio.create_task(request(port, SEARCH))
+            while server.pending == 0:
+                await asyncio.sleep(0.01)
+            (status, _, _) = await request(port, SEARCH)
+            assert status == 503
+        finally:
+            release.set()
+        (status, _, _) = await first
+        assert status == 200
+        assert server.stats()['rejected'] == 1
+
+    run_server(db_name, test, concurrency=1, max_pending=0)
@@ -0,0 +1,196 @@
+"""
+Zoekeend compressed postings: the terms table as one row per term (and
+field) with its docids as a delta + variable-byte coded gap list, and its
+term frequencies variable-byte coded, both as a BLOB:
+
+  fts_main_documents.postings_varbyte(termid, fieldid, num_postings, docids, tfs)
+
+The plain terms table remains the source of the match macros; the
+compressed postings are searched by zoekeend search --engine varbyte
+(see VarbyteIndex), which decodes them with NumPy.
+Based on: Falk Scholer, Hugh E. Williams, John Yiannis and Justin Zobel,
+Compression of inverted indexes for fast query evaluation, SIGIR 2002.
+"""
+
+import duckdb
+import numpy as np
+import pyarrow as pa
+
+import ze_vacuum
+
+
+def varbyte_encode(values, stop_bit=True):
+    """ Variable-byte code of non-negative integers: 7 bits per byte, low
+        bits first. With stop_bit, the high bit marks the last byte of a
+        value; without, it marks that more bytes follow, as in protobuf
+        varints. Returns the code and the end of each value in the code.
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    lengths = np.ones(len(values), dtype=np.int64)
+    rest = values >> np.uint64(7)
+    while rest.any():
+        lengths += rest > 0
+        rest >>= np.uint64(7)
+    ends = np.cumsum(lengths)
+    code = np.empty(ends[-1] if len(ends) else 0, dtype=np.uint8)
+    starts = ends - lengths
+    more = np.uint64(0 if stop_bit else 0x80)
+    for i in range(int(lengths.max()) if len(lengths) else 0):
+        sel = np.flatnonzero(lengths > i)
+        code[starts[sel] + i] = ((values[sel] >> np.uint64(7 * i)) & np.uint64(0x7f)) | more
+    code[ends - 1] ^= 0x80
+    return code, ends
+
+
+def varbyte_decode(data, stop_bit=True):
+    """ Decode the variable-byte code of varbyte_encode """
+    code = np.frombuffer(data, dtype=np.uint8)
+    ends = np.flatnonzero(code & 0x80 if stop_bit else code < 0x80)
+    if len(ends) == len(code):
+        return (code & 0x7f).astype(np.int64)
+    starts = np.zeros(len(ends), dtype=np.int64)
+    starts[1:] = ends[:-1] + 1
+    shifts = 7 * (np.arange(len(code)) - np.repeat(starts, ends - starts + 1))
+    return np.add.reduceat((code & 0x7f).astype(np.int64) << shifts, starts)
+
+
+def delta_encode(docids, first):
+    """ Gaps between docids, restarting at each first posting of a list """
+    gaps = np.empty_like(docids)
+    gaps[0] = docids[0]
+    np.subtract(docids[1:], docids[:-1], out=gaps[1:])
+    gaps[first] = docids[first]
+    return gaps
+
+
+def split_code(code, ends, first):
+    """ A binary array of the code of each list, lists start at first """
+    offsets = np.zeros(len(first) + 1, dtype=np.int32)
+    offsets[1:-1] = ends[first[1:] - 1]
+    offsets[-1] = len(code)
+    return pa.Array.from_buffers(pa.binary(), len(first),
+                                 [None, pa.py_buffer(offsets), pa.py_buffer(code)])
+
+
+def encode_postings(termid, fieldid, docid, tf):
+    """ Postings ordered by termid, fieldid, docid as a table of lists """
+    first = np.ones(len(termid), dtype=bool)
+    first[1:] = (termid[1:] != termid[:-1]) | (fieldid[1:] != fieldid[:-1])
+    first = np.flatnonzero(first)
+    (gap_code, gap_ends) = varbyte_encode(delta_encode(docid, first))
+    (tf_code, tf_ends) = varbyte_encode(tf)
+    return pa.table({
+        'termid': termid[first],
+        'fieldid': fieldid[first],
+        'num_postings': np.diff(np.append(first, len(termid))),
+        'docids': split_code(gap_code, gap_ends, first),
+        'tfs': split_code(tf_code, tf_ends, first),
+    })
+
+
+def compress_postings(con, batch_size=1000000):
+    """ Create the postings_varbyte table from the terms table, with an
+        index on termid for fetching the lists of the query terms
+    """
+    ze_vacuum.check_tf_postings(con, doclen=True)
+    con.sql("""
+        CREATE OR REPLACE TABLE fts_main_documents.postings_varbyte (
+          termid BIGINT, fieldid BIGINT, num_postings BIGINT, docids BLOB, tfs BLOB)
+    """)
+    reader = con.cursor()
+    result = reader.sql("""
+        SELECT termid, fieldid, docid, tf
+        FROM fts_main_documents.terms
+        ORDER BY termid, fieldid, docid
+    """)
+    con.begin()  # no automatic checkpoint while the reader streams
+    pending = None
+    for batch in result.fetch_arrow_reader(batch_size):
+        columns = [column.to_numpy() for column in batch.columns]
+        if pending is not None:
+            columns = [np.concatenate(pair) for pair in zip(pending, columns)]
+        (termid, fieldid) = columns[:2]
+        last = np.flatnonzero((termid != termid[-1]) | (fieldid != fieldid[-1]))
+        split = last[-1] + 1 if len(last) else 0
+        pending = [column[split:] for column in columns]
+        if split > 0:
+            lists = encode_postings(*[column[:split] for column in columns])
+            con.sql("INSERT INTO fts_main_documents.postings_varbyte SELECT * FROM lists")
+    if pending is not None and len(pending[0]) > 0:
+        lists = encode_postings(*pending)
+        con.sql("INSERT INTO fts_main_documents.postings_varbyte SELECT * FROM lists")
+    reader.close()
+    con.commit()
+    # Without an index, DuckDB reads the blobs of all rows to find a term
+    con.sql("CREATE INDEX postings_varbyte_termid ON fts_main_documents.postings_varbyte (termid)")
+
+
+def compress_index(db_name, batch_size=1000000):
+    """ Add compressed postings to index db_name """
+    con = duckdb.connect(db_name)
+    try:
+        compress_postings(con, batch_size=batch_size)
+    finally:
+        con.close()
+
+
+class VarbyteIndex:
+    """ The compressed postings of an index, with the interface of
+        ze_csr.CSRIndex used by ze_search.numpy_search_lm and
+        ze_search.numpy_search_bm25. Terms are looked up by termid.
+    """
+
+    def __init__(self, con):
+        ze_vacuum.check_tf_postings(con, doclen=True)
+        self.con = con
+        try:
+            (num_postings,) = con.sql("""
+                SELECT SUM(num_postings) FROM fts_main_documents.postings_varbyte
+            """).fetchall()[0]
+        except duckdb.duckdb.CatalogException:
+            raise ValueError("Index has no compressed postings, use compress first.")
+        (num_rows,) = con.sql("SELECT COUNT(*) FROM fts_main_documents.terms").fetchall()[0]
+        if num_postings != num_rows:
+            raise ValueError("Compressed postings do not match the index, use compress again.")
+        (num_docs, avgdl, sumdf, stemmer, index_type) = con.sql("""
+            SELECT num_docs, avgdl, sumdf, stemmer, index_type FROM fts_main_documents.stats
+        """).fetchall()[0]
+        self.meta = {'num_docs': num_docs, 'avgdl': avgdl, 'sumdf': sumdf,
+                     'stemmer': stemmer, 'index_type': index_type}
+        (term, termid, df) = con.sql("SELECT term, termid, df FROM fts_main_documents.dict").fetchnumpy().values()
+        self.termids = dict(zip(term.tolist(), termid.tolist()))
+        self.df = dict(zip(termid.tolist(), df.tolist()))
+        (docid, name, doclen, logprior, name_rank) = con.sql("""
+            SELECT docid, name, len, LN(len), ROW_NUMBER() OVER (ORDER BY name) - 1
+            FROM fts_main_documents.docs
+        """).fetchnumpy().values()
+        size = int(docid.max()) + 1 if len(docid) else 0
+        self.names = [None] * size
+        for (d, n) in zip(docid.tolist(), name.tolist()):
+            self.names[d] = n
+        (self.doclen, self.logprior) = (np.zeros(size, dtype=np.int64), np.zeros(size))
+        self.name_rank = np.zeros(size, dtype=np.int64)
+        self.doclen[docid] = doclen
+        self.logprior[docid] = logprior
+        self.name_rank[docid] = name_rank
+
+    def lookup(self, term):
+        return self.termids.get(term)
+
+    def postings(self, termid):
+        """ Postings (docids, tfs) of termid, decoded """
+        lists = self.con.execute("""
+            SELECT docids, tfs FROM fts_main_documents.postings_varbyte WHERE termid = $1
+        """, [termid]).fetchall()
+        docids = [np.cumsum(varbyte_decode(gaps)) for (gaps, _) in lists]
+        tfs = [varbyte_decode(tf) for (_, tf) in lists]
+        if len(lists) == 1:
+            return docids[0], tfs[0]
+        return np.concatenate(docids or [[]]).astype(np.int64), np.concatenate(tfs or [[]]).astype(np.int64)
+
+    def name(self, docid):
+        return self.names[docid]
+
+
+if __name__ == "__main__":
+    compress_index('cran.db')
@@ -0,0 +1,185 @@
+"""
+Zoekeend CSR sidecar: the dict, docs and terms tables of an index as
+memory-mapped NumPy arrays in compressed sparse row (CSR) layout, for
+searching without SQL (see ze_search.numpy_search_lm). Arrays are opened
+read-only with mmap, so processes that search the same index share the
+pages of the operating system's file cache.
+
+Layout of the directory (by default the index file name + '.csr'):
+  meta.json          collection statistics of the index
+  vocab.npy          UTF-8 bytes of all terms, sorted bytewise
+  vocab_offsets.npy  term i is vocab[vocab_offsets[i]:vocab_offsets[i+1]]
+  df.npy             document frequency of term i
+  offsets.npy        postings of term i are [offsets[i]:offsets[i+1]]
+  docids.npy         docid per posting, ordered by docid per term
+  tfs.npy            term frequency per posting
+  doclen.npy         document length by docid
+  logprior.npy       LN(len), the document prior of match_lm, by docid
+  names.npy          UTF-8 bytes of all document names
+  names_offsets.npy  name of docid d is names[names_offsets[d]:names_offsets[d+1]]
+  name_rank.npy      position of the name of docid d in name order, for
+                     breaking ties like ORDER BY score DESC, docname
+"""
+
+import json
+import os
+import pathlib
+import shutil
+
+import duckdb
+import numpy as np
+
+import ze_vacuum
+
+
+CSR_VERSION = 1
+
+
+def csr_path(db_name):
+    return db_name + '.csr'
+
+
+def get_stats(con):
+    (num_docs, avgdl, sumdf, stemmer, index_type) = con.sql("""
+        SELECT num_docs, avgdl, sumdf, stemmer, index_type FROM fts_main_documents.stats
+    """).fetchall()[0]
+    return {'num_docs': num_docs, 'avgdl': avgdl, 'sumdf': sumdf,
+            'stemmer': stemmer, 'index_type': index_type}
+
+
+def save_strings(path, name, strings):
+    """ Save strings as one UTF-8 byte array plus offsets """
+    encoded = [s.encode('utf-8') if s is not None else b'' for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(e) for e in encoded], out=offsets[1:])
+    np.save(path / f'{name}.npy', np.frombuffer(b''.join(encoded), dtype=np.uint8))
+    np.save(path / f'{name}_offsets.npy', offsets)
+
+
+def export_postings(con, path, num_terms, batch_size):
+    """ Postings in vocabulary order, streamed into memory-mapped arrays """
+    (counts,) = con.sql("""
+        SELECT COALESCE(COUNT(T.termid), 0)
+        FROM csr_vocab AS V LEFT JOIN fts_main_documents.terms AS T ON V.termid = T.termid
+        GROUP BY V.pos ORDER BY V.pos
+    """).fetchnumpy().values()
+    offsets = np.zeros(num_terms + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    np.save(path / 'offsets.npy', offsets)
+    total = int(offsets[-1])
+    (max_docid,) = con.sql("SELECT COALESCE(MAX(docid), 0) FROM fts_main_documents.docs").fetchall()[0]
+    docid_type = np.int32 if max_docid < 2**31 else np.int64
+    docids = np.lib.format.open_memmap(path / 'docids.npy', mode='w+', dtype=docid_type, shape=(total,))
+    tfs = np.lib.format.open_memmap(path / 'tfs.npy', mode='w+', dtype=np.int32, shape=(total,))
+    result = con.sql("""
+        SELECT T.docid, T.tf
+        FROM csr_vocab AS V, fts_main_documents.terms AS T
+        WHERE V.termid = T.termid
+        ORDER BY V.pos, T.docid
+    """)
+    start = 0
+    for batch in result.fetch_arrow_reader(batch_size):
+        end = start + batch.num_rows
+        docids[start:end] = batch.column(0).to_numpy()
+        tfs[start:end] = batch.column(1).to_numpy()
+        start = end
+    docids.flush()
+    tfs.flush()
+
+
+def csr_export(db_name, csr_dir=None, batch_size=1000000):
+    """ Write the CSR sidecar of index db_name to csr_dir """
+    if csr_dir is None:
+        csr_dir = csr_path(db_name)
+    path = pathlib.Path(csr_dir)
+    if path.exists():
+        raise ValueError(f"{csr_dir} already exists.")
+    tmp_path = pathlib.Path(f'{csr_dir}.{os.getpid()}.tmp')
+    tmp_path.mkdir(parents=True)
+    con = duckdb.connect(db_name, read_only=True)
+    try:
+        ze_vacuum.check_tf_postings(con, db_name, doclen=True)
+        meta = get_stats(con)
+        meta['version'] = CSR_VERSION
+        con.sql("""
+            CREATE TEMP TABLE csr_vocab AS
+            SELECT termid, term, df, ROW_NUMBER() OVER (ORDER BY term) - 1 AS pos
+            FROM fts_main_documents.dict
+        """)
+        (terms, df) = con.sql("SELECT term, df FROM csr_vocab ORDER BY pos").fetchnumpy().values()
+        save_strings(tmp_path, 'vocab', terms)
+        np.save(tmp_path / 'df.npy', df.astype(np.int64))
+        export_postings(con, tmp_path, len(terms), batch_size)
+
+        (docid, name, doclen, logprior, name_rank) = con.sql("""
+            SELECT docid, name, len, LN(len), ROW_NUMBER() OVER (ORDER BY name) - 1
+            FROM fts_main_documents.docs ORDER BY docid
+        """).fetchnumpy().values()
+        size = int(docid.max()) + 1 if len(docid) else 0
+        names = [None] * size
+        for (d, n) in zip(docid.tolist(), name.tolist()):
+            names[d] = n
+        save_strings(tmp_path, 'names', names)
+        for (array_name, values, dtype) in (('doclen', doclen, np.int64), ('logprior', logprior, np.float64),
+                                            ('name_rank', name_rank, np.int64)):
+            array = np.zeros(size, dtype=dtype)
+            array[docid] = values
+            np.save(tmp_path / f'{array_name}.npy', array)
+        with open(tmp_path / 'meta.json', 'w') as file:
+            json.dump(meta, file, indent=1)
+        tmp_path.rename(path)
+    finally:
+        con.close()
+        if tmp_path.exists():
+            shutil.rmtree(tmp_path)
+
+
+class CSRIndex:
+    """ A CSR sidecar, memory-mapped read-only """
+
+    def __init__(self, csr_dir):
+        path = pathlib.Path(csr_dir)
+        if not (path / 'meta.json').is_file():
+            raise ValueError(f"No CSR sidecar {csr_dir}, use csr_export first.")
+        with open(path / 'meta.json') as file:
+            self.meta = json.load(file)
+        if self.meta.get('version') != CSR_VERSION:
+            raise ValueError(f"CSR sidecar {csr_dir} has an unknown version, export it again.")
+        for name in ('vocab', 'vocab_offsets', 'df', 'offsets', 'docids', 'tfs',
+                     'doclen', 'logprior', 'names', 'names_offsets', 'name_rank'):
+            setattr(self, name, np.load(path / f'{name}.npy', mmap_mode='r'))
+
+    def check(self, con):
+        """ The sidecar must have been exported from the index of con """
+        stats = get_stats(con)
+        if any(stats[key] != self.meta[key] for key in ('num_docs', 'sumdf', 'index_type')):
+            raise ValueError("CSR sidecar does not match the index, export it again.")
+
+    def term(self, i):
+        return bytes(self.vocab[self.vocab_offsets[i]:self.vocab_offsets[i + 1]])
+
+    def lookup(self, term):
+        """ Position of term in the vocabulary, or None (binary search) """
+        key = term.encode('utf-8')
+        (low, high) = (0, len(self.df))
+        while low < high:
+            mid = (low + high) // 2
+            if self.term(mid) < key:
+                low = mid + 1
+            else:
+                high = mid
+        if low < len(self.df) and self.term(low) == key:
+            return low
+        return None
+
+    def postings(self, i):
+        """ Postings (docids, tfs) of term i """
+        (start, end) = (self.offsets[i], self.offsets[i + 1])
+        return self.docids[start:end], self.tfs[start:end]
+
+    def name(self, docid):
+        return bytes(self.names[self.names_offsets[docid]:self.names_offsets[docid + 1]]).decode('utf-8')
+
+
+if __name__ == "__main__":
+    csr_export('cran.db')
@@ -4,15 +4,20 @@ Author: Djoerd Hiemstra
 """
 
 import pathlib
+import queue
 import sys
+import threading
+import time
 
 import duckdb
 import ir_datasets
+import pyarrow as pa
 
 
-def normalize(text):
-    """ Escape quotes for SQL """
-    return text.replace("'", "''")
+docs_schema = pa.schema([
+    ("did", pa.string()),
+    ("content", pa.string())
+])
 
 
 def create_lm(con, stemmer):
@@ -32,15 +37,14 @@ def create_lm(con, stemmer):
             WHERE (dict.term = tokens.t)
         ),
         qterms AS (
-            SELECT termid, docid
+            SELECT termid, docid, tf
             FROM fts_main_documents.terms AS terms
             WHERE (CASE WHEN ((fields IS NULL)) THEN (1) ELSE (fieldid = ANY(SELECT * FROM fieldids)) END
             AND (termid = ANY(SELECT qtermids.termid FROM qtermids)))
         ),
         term_tf AS (
-            SELECT termid, docid, count_star() AS tf
+            SELECT termid, docid, tf
             FROM qterms
-            GROUP BY docid, termid
         ),
         cdocs AS (
             SELECT docid
@@ -66,48 +70,190 @@ def create_lm(con, stemmer):
     """)
 
 
-def insert_dataset(con, ir_dataset, logging=True):
+def create_bm25(con, stemmer):
+    """ BM25 of the DuckDB FTS extension, reading the term frequencies from
+        the postings: match_bm25 scores one document, rank_bm25 all matching
+        documents at once, with the columns of match_lm
+    """
+    def scores(materialized=""):
+        return f"""
+        WITH tokens AS (
+            SELECT DISTINCT stem(unnest(fts_main_documents.tokenize(query_string)), '{stemmer}') AS t
+        ),
+        fieldids AS (
+            SELECT fieldid
+            FROM fts_main_documents.fields
+            WHERE CASE WHEN ((fields IS NULL)) THEN (1) ELSE (field = ANY(SELECT * FROM (SELECT unnest(string_split(fields, ','))) AS fsq)) END
+        ),
+        qtermids AS (
+            SELECT termid, df
+            FROM fts_main_documents.dict AS dict, tokens
+            WHERE (dict.term = tokens.t)
+        ),
+        qterms AS {materialized}(
+            SELECT termid, docid, tf
+            FROM fts_main_documents.terms AS terms
+            WHERE (CASE WHEN ((fields IS NULL)) THEN (1) ELSE (fieldid = ANY(SELECT * FROM fieldids)) END
+            AND (termid = ANY(SELECT qtermids.termid FROM qtermids)))
+        ),
+        term_tf AS (
+            SELECT termid, docid, tf
+            FROM qterms
+        ),
+        cdocs AS (
+            SELECT docid
+            FROM qterms
+            GROUP BY docid
+            HAVING CASE WHEN (conjunctive) THEN ((count(DISTINCT termid) = (SELECT count_star() FROM tokens))) ELSE 1 END
+        ),
+        subscores AS (
+           SELECT docs.docid, docs.len, term_tf.termid, term_tf.tf, qtermids.df, (log((((((SELECT num_docs FROM fts_main_documents.stats) - df) + 0.5) / (df + 0.5)) + 1)) * ((tf * (k + 1)) / (tf + (k * ((1 - b) + (b * (len / (SELECT avgdl FROM fts_main_documents.stats)))))))) AS subscore
+           FROM term_tf, cdocs, fts_main_documents.docs AS docs, qtermids
+           WHERE ((term_tf.docid = cdocs.docid)
+           AND (term_tf.docid = docs.docid)
+           AND (term_tf.termid = qtermids.termid))
+        ),
+        scores AS (
+           SELECT docid, sum(subscore) AS score FROM subscores GROUP BY docid
+        )"""
+    con.sql(f"""
+        CREATE OR REPLACE MACRO fts_main_documents.match_bm25(docname, query_string, fields := NULL, k := 1.2, b := 0.75, conjunctive := 0) AS (
+        {scores()}
+        SELECT score FROM scores, fts_main_documents.docs AS docs
+        WHERE ((scores.docid = docs.docid) AND (docs."name" = docname)))
+    """)
+    create_rank_bm25(con, scores, "fields := NULL, k := 1.2, b := 0.75, conjunctive := 0")
+
+
+def create_rank_bm25(con, scores, parameters, cost_from="term_tf"):
+    """ The table macro rank_bm25 of a match_bm25 macro, for all matching
+        documents at once, with the columns of match_lm. scores(materialized)
+        is the WITH clause of match_bm25, that ends with the scores CTE; its
+        qterms CTE is MATERIALIZED here, so qterms is read once for the
+        scores and for the postings cost, the rows of cost_from (not in
+        match_bm25, which DuckDB can then no longer decorrelate). The named
+        parameters are those of match_bm25.
+    """
+    con.sql(f"""
+        CREATE OR REPLACE MACRO fts_main_documents.rank_bm25(query_string, {parameters}) AS TABLE (
+        {scores("MATERIALIZED ")},
+        postings_cost AS (
+           SELECT COUNT(*) AS cost FROM {cost_from}
+        )
+        SELECT docs.name AS docname, score, (SELECT cost FROM postings_cost) AS postings_cost
+        FROM scores, fts_main_documents.docs AS docs
+        WHERE scores.docid = docs.docid
+        );
+    """)
+
+
+def aggregate_terms(con):
+    """
+    Replace the terms table of the FTS extension, which has a row for
+    each term occurrence, by postings (docid, fieldid, termid, tf) with
+    the term frequency of each term in each document.
+    """
+    con.sql("""
+        CREATE TABLE fts_main_documents.terms_tf AS
+        SELECT docid, fieldid, termid, COUNT(*) AS tf
+        FROM fts_main_documents.terms
+        GROUP BY docid, fieldid, termid
+        ORDER BY termid, docid;
+        DROP TABLE fts_main_documents.terms;
+        ALTER TABLE fts_main_documents.terms_tf RENAME TO terms;
+    """)
+
+
+def document_text(doc):
+    """ Concatenate the title, body and text attributes of a document """
+    doc_text = ""
+    if hasattr(doc, 'title'):
+        doc_text = doc.title
+    if hasattr(doc, 'body'):
+        doc_text += " " + doc.body
+    if hasattr(doc, 'text'):
+        doc_text += " " + doc.text
+    return doc_text
+
+
+def iter_docs_batches(ir_dataset, batch_size=10000):
+    """ Generator for reading batches of (did, content) documents """
+    dids = []
+    contents = []
+    for doc in ir_dataset.docs_iter():
+        dids.append(doc.doc_id)
+        contents.append(document_text(doc))
+        if len(dids) == batch_size:
+            yield pa.RecordBatch.from_arrays([dids, contents], schema=docs_schema)
+            dids = []
+            contents = []
+    if dids:
+        yield pa.RecordBatch.from_arrays([dids, contents], schema=docs_schema)
+
+
+def read_docs_batches(ir_dataset, batch_queue, batch_size=10000):
+    """
+    Reader thread: put batches of documents in the queue, blocking
+    while the queue is full. None marks the end of the dataset.
+    """
+    try:
+        for batch in iter_docs_batches(ir_dataset, batch_size):
+            batch_queue.put(batch)
+    except Exception as e:
+        batch_queue.put(e)
+    batch_queue.put(None)
+
+
+def check_batching(batch_size, queue_depth):
+    """ Batches and the queue must be bounded to bound memory use """
+    if batch_size < 1:
+        raise ValueError(f"Batch size must be positive, not {batch_size}.")
+    if queue_depth < 1:
+        raise ValueError(f"Queue depth must be positive, not {queue_depth}.")
+
+
+def insert_dataset(con, ir_dataset, logging=True, batch_size=10000, queue_depth=4):
     """
     Insert documents from an ir_dataset. Works with several datasets.
-    Add document attributes if needed.
+    Add document attributes if needed. A reader thread decodes documents
+    into Arrow record batches of batch_size documents, while DuckDB
+    inserts them. At most queue_depth batches wait in between, which
+    bounds memory use for large collections.
     """
+    check_batching(batch_size, queue_depth)
     con.sql('CREATE TABLE documents (did TEXT, content TEXT)')
-    insert = 'INSERT INTO documents(did, content) VALUES '
-    sql = insert
-    part = 0
     total = 0
     count = ir_dataset.docs_count()
     if logging:
         print(f"Inserting {count} docs...", file=sys.stderr)
-    for doc in ir_dataset.docs_iter():
-        doc_text = ""
-        if hasattr(doc, 'title'):
-            doc_text = doc.title
-        if hasattr(doc, 'body'):
-            doc_text += " " + doc.body
-        if hasattr(doc, 'text'):
-            doc_text += " " + doc.text
-        sql += "('" + doc.doc_id + "','" + normalize(doc_text) + "'),"
-        part += 1
-        if part > 9999:
-            total += part
-            if logging:
-                print(str(total) + " docs", file=sys.stderr)
-            con.sql(sql)
-            part = 0
-            sql = insert
-    con.sql(sql)
+    batch_queue = queue.Queue(maxsize=queue_depth)
+    reader = threading.Thread(target=read_docs_batches, daemon=True,
+                              args=(ir_dataset, batch_queue, batch_size))
+    start = time.perf_counter()
+    reader.start()
+    while (batch := batch_queue.get()) is not None:
+        if isinstance(batch, Exception):
+            raise batch
+        con.execute("INSERT INTO documents SELECT did, content FROM batch")
+        total += batch.num_rows
+        if logging:
+            elapsed = time.perf_counter() - start
+            print(f"{total} docs ({total / elapsed:.0f} docs/sec, "
+                  f"{batch_queue.qsize()} batches queued)", file=sys.stderr)
+    reader.join()
 
 
 def index_documents(db_name, ir_dataset, stemmer='none', stopwords='none',
-                     logging=True, keepcontent=False):
+                     logging=True, keepcontent=False, batch_size=10000,
+                     queue_depth=4):
     """
     Insert and index documents.
     """
     if pathlib.Path(db_name).is_file():
         raise ValueError(f"File {db_name} already exists.")
+    check_batching(batch_size, queue_depth)
     con = duckdb.connect(db_name)
-    insert_dataset(con, ir_dataset, logging)
+    insert_dataset(con, ir_dataset, logging, batch_size, queue_depth)
     if logging:
         print("Indexing...", file=sys.stderr)
     con.sql(f"""
@@ -119,12 +265,14 @@ def index_documents(db_name, ir_dataset, stemmer='none', stopwords='none',
         UPDATE fts_main_documents.stats SET sumdf =
             (SELECT SUM(df) FROM fts_main_documents.dict);
         ALTER TABLE fts_main_documents.stats ADD index_type TEXT; 
-        UPDATE fts_main_documents.stats SET index_type = 'standard';
+        UPDATE fts_main_documents.stats SET index_type = 'tf';
         ALTER TABLE fts_main_documents.stats ADD stemmer TEXT; 
         UPDATE fts_main_documents.stats SET stemmer = '{stemmer}';
 
     """)
+    aggregate_terms(con)
     create_lm(con, stemmer)
+    create_bm25(con, stemmer)
     if not keepcontent:
         con.sql("ALTER TABLE documents DROP COLUMN content")
     con.close()
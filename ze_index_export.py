@@ -4,15 +4,22 @@ Zoekeend CIFF exporter
 Author: Gijs Hendriksen
 """
 
+import gzip
+import os
+import pathlib
 from typing import Iterable, Type, TypeVar
+
 import duckdb
+import numpy as np
 
-from ciff_toolkit.write import CiffWriter
-from ciff_toolkit.ciff_pb2 import Header, PostingsList, DocRecord
+from ciff_toolkit.ciff_pb2 import Header, DocRecord
 from google.protobuf.message import Message
 
 from tqdm import tqdm
 
+from ze_compress import varbyte_encode
+from ze_vacuum import ordered_map
+
 
 M = TypeVar('M', bound=Message)
 
@@ -62,54 +69,162 @@ def create_ciff_header(conn: duckdb.DuckDBPyConnection, description: str) -> Hea
     return header
 
 
-def create_ciff_postings_lists(conn: duckdb.DuckDBPyConnection, batch_size: int = 1024) -> Iterable[PostingsList]:
-    postings_info = conn.sql("""
-        WITH postings AS (
-            SELECT termid, docid, COUNT(*) AS tf
-            FROM fts_main_documents.terms
-            GROUP BY ALL
-        ),
-        gapped_postings AS (
-            SELECT *, docid - lag(docid, 1, 0) OVER (PARTITION BY termid ORDER BY docid) AS gap
-            FROM postings
-        ),
-        grouped_postings AS (
-            SELECT termid, list(row(gap, tf)::STRUCT(docid BIGINT, tf BIGINT) ORDER BY docid) AS postings, SUM(tf)::BIGINT AS cf
-            FROM gapped_postings
-            GROUP BY termid
-        )
-        SELECT term, df, cf, postings
-        FROM grouped_postings
-        JOIN fts_main_documents.dict USING (termid)
-        ORDER BY term;
+def postings_tf(conn: duckdb.DuckDBPyConnection) -> str:
+    """ The tf of a posting of an index with term frequencies, or with a row per term occurrence """
+    try:
+        conn.sql("SELECT tf FROM fts_main_documents.terms LIMIT 0")
+    except duckdb.BinderException:
+        return "COUNT(*)"
+    return "SUM(T.tf)"
+
+
+def varint_bytes(value: int) -> bytes:
+    code = bytearray()
+    while value >= 0x80:
+        code.append((value & 0x7f) | 0x80)
+        value >>= 7
+    code.append(value)
+    return bytes(code)
+
+
+def encode_postings_chunk(chunk: tuple) -> tuple[bytes, int]:
+    """
+    Size-prefixed PostingsList messages of a chunk of posting lists (run by
+    a worker), in the wire format of protobuf: fields with value 0 are left
+    out. The postings of all lists are encoded at once, each posting is the
+    varint sequence (tag 0x22, size, tag 0x08, gap, tag 0x10, tf).
+    """
+    (terms, df, counts, docids, tfs) = chunk
+    first = np.concatenate(([0], np.cumsum(counts)))[:-1]
+    gaps = np.diff(docids, prepend=0)
+    gaps[first] = docids[first]
+    cf = np.add.reduceat(tfs, first) if len(tfs) else np.zeros(0, dtype=np.int64)
+    (_, gap_ends) = varbyte_encode(gaps, stop_bit=False)
+    (_, tf_ends) = varbyte_encode(tfs, stop_bit=False)
+    gap_size = np.diff(gap_ends, prepend=0)
+    size = np.where(gaps > 0, 1 + gap_size, 0) + 1 + np.diff(tf_ends, prepend=0)
+    tokens = np.stack([np.full(len(gaps), 0x22), size, np.full(len(gaps), 0x08), gaps,
+                       np.full(len(gaps), 0x10), tfs], axis=1)
+    present = np.ones(tokens.shape, dtype=bool)
+    present[:, 2:4] = (gaps > 0)[:, None]
+    (code, ends) = varbyte_encode(tokens[present], stop_bit=False)
+    list_ends = np.concatenate(([0], ends))[np.cumsum(present.sum(axis=1))[np.cumsum(counts) - 1]]
+    code = code.tobytes()
+    messages = []
+    start = 0
+    for (term, list_df, list_cf, end) in zip(terms, df.tolist(), cf.tolist(), list_ends.tolist()):
+        term = term.encode('utf-8')
+        message = b''.join((
+            b'\x0a' + varint_bytes(len(term)) + term if term else b'',
+            b'\x10' + varint_bytes(list_df) if list_df else b'',
+            b'\x18' + varint_bytes(list_cf) if list_cf else b'',
+            code[start:end]))
+        messages.append(varint_bytes(len(message)) + message)
+        start = end
+    return b''.join(messages), len(docids)
+
+
+def encode_docs_chunk(docs: tuple) -> tuple[bytes, int]:
+    """ Size-prefixed DocRecord messages of a chunk of documents (run by a worker) """
+    messages = []
+    for (docid, name, doclength) in zip(*docs):
+        message = DocRecord(docid=docid, collection_docid=name, doclength=doclength).SerializeToString()
+        messages.append(varint_bytes(len(message)) + message)
+    return b''.join(messages), len(messages)
+
+
+def iter_postings_chunks(conn: duckdb.DuckDBPyConnection, chunk_size: int) -> Iterable[tuple]:
+    """
+    Posting lists ordered by term, in chunks of about chunk_size postings.
+    Each chunk is a range of terms, fetched by its own query, so the
+    postings are never grouped and sorted for the whole index at once.
+    """
+    conn.sql("""
+        CREATE TEMP TABLE ciff_vocab AS
+        SELECT termid, term, df, ROW_NUMBER() OVER (ORDER BY term) - 1 AS pos
+        FROM fts_main_documents.dict
     """)
-
-    yield from create_protobuf_messages_from_result(postings_info, PostingsList, batch_size=batch_size)
-
-
-def create_ciff_doc_records(conn: duckdb.DuckDBPyConnection, batch_size: int = 1024) -> Iterable[DocRecord]:
-    docs_info = conn.sql("""
-        SELECT
-            docid,
-            name AS collection_docid,
-            len AS doclength,
+    (df,) = conn.sql("SELECT df FROM ciff_vocab ORDER BY pos").fetchnumpy().values()
+    ends = np.cumsum(df)
+    tf = postings_tf(conn)
+    start = 0
+    while start < len(df):
+        end = max(int(np.searchsorted(ends, ends[start] - df[start] + chunk_size, side='right')), start + 1)
+        (pos, docids, tfs) = conn.execute(f"""
+            SELECT V.pos, T.docid, {tf}::BIGINT AS tf
+            FROM fts_main_documents.terms AS T, ciff_vocab AS V
+            WHERE T.termid = V.termid AND V.pos >= $1 AND V.pos < $2
+            GROUP BY V.pos, T.docid
+            ORDER BY V.pos, T.docid
+        """, [start, end]).fetchnumpy().values()
+        (terms, list_df) = conn.execute("""
+            SELECT term, df FROM ciff_vocab WHERE pos >= $1 AND pos < $2 ORDER BY pos
+        """, [start, end]).fetchnumpy().values()
+        first = np.flatnonzero(np.diff(pos, prepend=-1))
+        if len(first) < len(terms):
+            # Terms without postings are left out
+            keep = np.isin(np.arange(start, end), pos[first])
+            (terms, list_df) = (terms[keep], list_df[keep])
+        if len(first) > 0:
+            yield (terms.tolist(), list_df.astype(np.int64), np.diff(np.append(first, len(pos))),
+                   docids.astype(np.int64), tfs.astype(np.int64))
+        start = end
+
+
+def iter_docs_chunks(conn: duckdb.DuckDBPyConnection, chunk_size: int) -> Iterable[tuple]:
+    """ Document records ordered by name, in chunks of chunk_size """
+    result = conn.sql("""
+        SELECT docid, name, len
         FROM fts_main_documents.docs
-        ORDER BY collection_docid
+        ORDER BY name
     """)
-
-    yield from create_protobuf_messages_from_result(docs_info, DocRecord, batch_size=batch_size)
-
-
-def ciff_export(db_name: str, file_name: str, description: str, batch_size: int = 1024):
-    with duckdb.connect(db_name) as conn, CiffWriter(file_name) as writer:
+    for batch in result.fetch_arrow_reader(chunk_size):
+        yield tuple(column.to_pylist() for column in batch.columns)
+
+
+def encode_chunk(task: tuple) -> tuple[bytes, int]:
+    """ Encode a chunk, and compress it as a gzip member if needed (run by a worker) """
+    (encode, chunk, compress) = task
+    (data, count) = encode(chunk)
+    # Level 6 (as zlib): level 9 of gzip.open is about 15 times slower
+    # on postings, for a 7% smaller file
+    return (gzip.compress(data, compresslevel=6) if compress else data), count
+
+
+def write_chunks(file, encode, chunks: Iterable, compress: bool, workers: int, progress: tqdm):
+    """ Encode the chunks by worker processes, and write them in order """
+    tasks = ((encode, chunk, compress) for chunk in chunks)
+    for (data, count) in ordered_map(encode_chunk, tasks, workers):
+        file.write(data)
+        progress.update(count)
+
+
+def ciff_export(db_name: str, file_name: str, description: str, batch_size: int = 1000000,
+                workers: int | None = None):
+    """
+    Export the index to CIFF. Posting lists are streamed in chunks of
+    about batch_size postings (documents: batch_size / 10), which
+    {workers} processes encode and which are written in order. With a .gz
+    file name, the workers also compress the chunks: the file is then a
+    sequence of gzip members.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    compress = pathlib.Path(file_name).suffix == '.gz'
+    with duckdb.connect(db_name, read_only=True) as conn, open(file_name, 'wb') as file:
         header = create_ciff_header(conn, description)
         print(header)
-        writer.write_header(header)
-        writer.write_postings_lists(tqdm(create_ciff_postings_lists(conn, batch_size=batch_size), total=header.num_postings_lists,
-                                         desc='Writing posting lists', unit='pl'))
-        writer.write_documents(tqdm(create_ciff_doc_records(conn, batch_size=batch_size), total=header.num_docs,
-                                    desc='Writing documents', unit='d'))
+        message = header.SerializeToString()
+        message = varint_bytes(len(message)) + message
+        file.write(gzip.compress(message, compresslevel=6) if compress else message)
+        (total,) = conn.sql("SELECT SUM(df)::BIGINT FROM fts_main_documents.dict").fetchall()[0]
+        with tqdm(total=total, desc='Writing posting lists', unit='postings', unit_scale=True) as progress:
+            write_chunks(file, encode_postings_chunk, iter_postings_chunks(conn, batch_size),
+                         compress, workers, progress)
+        with tqdm(total=header.num_docs, desc='Writing documents', unit='d', unit_scale=True) as progress:
+            write_chunks(file, encode_docs_chunk, iter_docs_chunks(conn, max(1, batch_size // 10)),
+                         compress, workers, progress)
 
 
 if __name__ == '__main__':
-    ciff_export('index.db', 'index-copy.ciff.gz', 'OWS.eu index', batch_size=2**12)
+    ciff_export('index.db', 'index-copy.ciff.gz', 'OWS.eu index')
@@ -6,96 +6,197 @@ Author: Arjen P. de Vries
 Adapted from: https://github.com/arjenpdevries/CIFF2DuckDB
 """
 
+import gzip
+import os
+import pathlib
+
 import duckdb
+import numpy as np
 import pyarrow as pa
 
-from ciff_toolkit.read import CiffReader
 from ciff_toolkit.ciff_pb2 import DocRecord, Header, PostingsList
-from google.protobuf.json_format import MessageToJson, MessageToDict
-from typing import Iterator, TypeVar, Iterable
 
-pbopt = {"including_default_value_fields": True,
-         "preserving_proto_field_name": True}
+import ze_index
+from ze_compress import varbyte_decode
+from ze_vacuum import ordered_map
+
+
+def varint_at(data, pos):
+    """ The varint at pos of data, and the position after it """
+    (value, shift) = (0, 0)
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+class MessageStream:
+    """ The size-prefixed messages of a CIFF file, read in blocks """
+
+    def __init__(self, fp, block_size=1 << 20):
+        (self.fp, self.block_size) = (fp, block_size)
+        (self.buffer, self.pos) = (b'', 0)
+
+    def fill(self, size):
+        """ At least size bytes after pos, unless the file ends """
+        if len(self.buffer) - self.pos < size:
+            self.buffer = self.buffer[self.pos:] + self.fp.read(max(size, self.block_size))
+            self.pos = 0
+
+    def messages(self, count):
+        """ Generator for the next count serialized messages """
+        for _ in range(count):
+            self.fill(10)
+            try:
+                (size, self.pos) = varint_at(self.buffer, self.pos)
+            except IndexError:
+                raise ValueError("Unexpected end of CIFF file.")
+            self.fill(size)
+            if len(self.buffer) - self.pos < size:
+                raise ValueError("Unexpected end of CIFF file.")
+            yield self.buffer[self.pos:self.pos + size]
+            self.pos += size
+
+
+def split_postings_list(data):
+    """ Term, df and the start of the repeated postings field of a
+        serialized PostingsList; the start is None for other layouts.
+    """
+    (pos, term, df) = (0, '', 0)
+    while pos < len(data) and data[pos] != 0x22:
+        (tag, pos) = varint_at(data, pos)
+        if tag == 0x0a:
+            (size, pos) = varint_at(data, pos)
+            term = data[pos:pos + size].decode('utf-8')
+            pos += size
+        elif tag == 0x10:
+            (df, pos) = varint_at(data, pos)
+        elif tag == 0x18:
+            (_, pos) = varint_at(data, pos)
+        else:
+            return term, df, None
+    return term, df, pos
+
+
+def decode_postings_list(data):
+    """ Docid gaps and term frequencies of a serialized PostingsList, one
+        list at a time (protobuf leaves out the gap of docid 0).
+    """
+    message = PostingsList.FromString(data)
+    return (np.array([p.docid for p in message.postings], dtype=np.int64),
+            np.array([p.tf for p in message.postings], dtype=np.int64))
 
 
-def iter_posting_batches(reader: Iterable[PostingsList]):
+def decode_postings_chunk(messages):
+    """
+    Columns of a chunk of serialized posting lists (run by a worker). The
+    postings fields of all lists are decoded at once: each posting is the
+    varint sequence (tag 0x22, size, tag 0x08, gap, tag 0x10, tf). Lists
+    that do not follow this layout are decoded one at a time.
+    """
+    (terms, df, starts) = zip(*map(split_postings_list, messages)) if messages else ((), (), ())
+    fields = [data[start:] if start is not None else b'' for (data, start) in zip(messages, starts)]
+    code = np.frombuffer(b''.join(fields), dtype=np.uint8)
+    tokens = varbyte_decode(code, stop_bit=False)
+    field_ends = np.cumsum([len(field) for field in fields], dtype=np.int64)
+    token_ends = np.concatenate(([0], np.cumsum(code < 0x80)))[field_ends]
+    num_tokens = np.diff(token_ends, prepend=0)
+    regular = (num_tokens % 6 == 0) & np.array([start is not None for start in starts], dtype=bool)
+    rows = tokens[np.repeat(regular, num_tokens)].reshape(-1, 6)
+    row_list = np.repeat(np.flatnonzero(regular), num_tokens[regular] // 6)
+    wrong = (rows[:, 0] != 0x22) | (rows[:, 2] != 0x08) | (rows[:, 4] != 0x10)
+    if wrong.any():
+        regular[row_list[wrong]] = False
+        keep = regular[row_list]
+        (rows, row_list) = (rows[keep], row_list[keep])
+    counts = np.where(regular, num_tokens // 6, 0)
+    irregular = {i: decode_postings_list(messages[i]) for i in np.flatnonzero(~regular).tolist()}
+    for (i, (gaps, _)) in irregular.items():
+        counts[i] = len(gaps)
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    (docids, tfs) = (np.empty(offsets[-1], dtype=np.int64), np.empty(offsets[-1], dtype=np.int64))
+    # Gap decoding: a cumulative sum per list
+    gaps = rows[:, 3]
+    sums = np.cumsum(gaps)
+    first = np.concatenate(([0], np.cumsum(counts[regular])))[:-1]
+    before = np.concatenate(([0], sums))[first]
+    positions = np.arange(len(gaps)) + np.repeat(offsets[:-1][regular] - first, counts[regular])
+    docids[positions] = sums - np.repeat(before, counts[regular])
+    tfs[positions] = rows[:, 5]
+    for (i, (gaps, list_tfs)) in irregular.items():
+        docids[offsets[i]:offsets[i + 1]] = np.cumsum(gaps)
+        tfs[offsets[i]:offsets[i + 1]] = list_tfs
+    return list(terms), np.array(df, dtype=np.int64), counts, docids, tfs
+
+
+def iter_chunks(messages, chunk_bytes):
+    """ Group messages into chunks of about chunk_bytes """
+    (chunk, size) = ([], 0)
+    for data in messages:
+        chunk.append(data)
+        size += len(data)
+        if size >= chunk_bytes:
+            yield chunk
+            (chunk, size) = ([], 0)
+    if chunk:
+        yield chunk
+
+
+def ciff_postings(con, stream, num_postings_lists, workers, chunk_bytes):
+    """ Insert the posting lists into the dict and terms tables; term
+        identifiers are handed out in the order of the CIFF file.
+    """
+    con.execute("""
+        CREATE TABLE dict(termid BIGINT, term TEXT, df BIGINT);
+        CREATE TABLE terms(docid BIGINT, fieldid BIGINT, termid BIGINT, tf BIGINT);
+    """)
+    termid = 0
+    messages = stream.messages(num_postings_lists)
+    chunks = iter_chunks(messages, chunk_bytes)
+    for (terms, df, counts, docids, tfs) in ordered_map(decode_postings_chunk, chunks, workers):
+        termids = np.arange(termid, termid + len(terms), dtype=np.int64)
+        termid += len(terms)
+        dict_batch = pa.table({'termid': termids, 'term': terms, 'df': df})
+        con.execute("INSERT INTO dict SELECT * FROM dict_batch")
+        terms_batch = pa.table({'docid': docids, 'termid': np.repeat(termids, counts), 'tf': tfs})
+        con.execute("INSERT INTO terms SELECT docid, 0, termid, tf FROM terms_batch")
+
+
+def ciff_docs(con, stream, num_docs, batch_size=100000):
+    """ Insert the document records into the docs table """
+    con.execute("CREATE TABLE docs(docid BIGINT, name TEXT, len BIGINT)")
+    messages = stream.messages(num_docs)
+    while True:
+        docs = [DocRecord.FromString(data) for (_, data) in zip(range(batch_size), messages)]
+        if not docs:
+            break
+        docs_batch = pa.table({
+            'docid': [doc.docid for doc in docs],
+            'name': [doc.collection_docid for doc in docs],
+            'len': [doc.doclength for doc in docs]})
+        con.execute("INSERT INTO docs SELECT * FROM docs_batch")
+
+
+def ciff_tables(con, file_name, stemmer, workers, chunk_bytes):
     """
-    Generator for reading batches of postings
-    Note: Term identifiers handed out here, while reading term-posting
-    pairs from the CIFF file
+    Read the CIFF file sequentially. Posting lists are decoded straight
+    from the protobuf wire format into NumPy arrays, in chunks of about
+    chunk_bytes, by {workers} processes.
     """
-    batch = []
-    for tid, p in enumerate(reader.read_postings_lists()):
-        pp = MessageToDict(p, **pbopt)
-        pp['termid']=tid
-        # Gap Decompression...
-        pp['postings']=[prev := {"docid":0}] and \
-            [prev := {"docid": posting['docid'] + prev['docid'], "tf": posting['tf']} for posting in pp['postings']]
-        batch.append(pp)
-        if len(batch) == 4096:
-            yield pa.RecordBatch.from_pylist(batch)
-            batch = []
-    yield pa.RecordBatch.from_pylist(batch)
-
-
-def iter_docs_batches(reader: Iterable[DocRecord]):
-    """ Generator for reading batches of docs """
-    batch = []
-    for doc in reader.read_documents():
-        batch.append(MessageToDict(doc, **pbopt))
-        if len(batch) == 8192:
-            yield pa.RecordBatch.from_pylist(batch)
-            batch = []
-    yield pa.RecordBatch.from_pylist(batch)
-
-
-def ciff_arrow(con, file_name, stemmer):
-    """ Use CIFFReader to create RecordBatches for table (using Arrow) """
-    # Schema: manually defined
-    # (alternative: protarrow could create the datastructure from the proto definition)
-    postings_schema = pa.schema([
-        ("term", pa.string()),
-        ("termid", pa.int64()),
-        ("df", pa.int64()),
-        ("cf", pa.int64()),
-        ("postings", pa.list_(pa.struct([
-            ("docid", pa.int32()),
-            ("tf", pa.int32())
-            ])))
-         ])
-
-    docs_schema = pa.schema([
-        ("docid", pa.int32()),
-        ("collection_docid", pa.string()),
-        ("doclength", pa.int32())
-     ])
-
-    with CiffReader(file_name) as reader:
-        # Header info: TBD
-        h = reader.read_header()
-        header = MessageToJson(h, **pbopt)
+    open_file = gzip.open if pathlib.Path(file_name).suffix == '.gz' else open
+    with open_file(file_name, 'rb') as fp:
+        stream = MessageStream(fp)
+        (h,) = map(Header.FromString, stream.messages(1))
         con.execute(f"""
             CREATE TABLE stats(num_docs BIGINT, avgdl DOUBLE, sumdf BIGINT, index_type TEXT, stemmer TEXT);
             INSERT INTO stats(num_docs, avgdl, index_type, stemmer) VALUES
-              ({h.num_docs}, {h.average_doclength}, 'standard', '{stemmer}');
-        """)
-
-        # RecordBatches for postings to an Arrow Datastructure
-        postings_rb = iter_posting_batches(reader)
-        postings_rbr = pa.ipc.RecordBatchReader.from_batches(postings_schema, postings_rb)
-
-        # Create a DuckDB table from the Arrow data
-        con.execute("CREATE TABLE ciff_postings AS SELECT * FROM postings_rbr;")
-
-        # RecordBatches for docs to an Arrow Datastructure
-        docs_rb = iter_docs_batches(reader)
-        docs_rbr = pa.ipc.RecordBatchReader.from_batches(docs_schema, docs_rb)
-
-        # Create a DuckDB table from the Arrow data
-        # Dropping cf here because DuckDB FTS does not use it
-        con.execute("""
-          CREATE TABLE docs AS SELECT docid::BIGINT AS docid, collection_docid AS name, doclength::BIGINT AS len FROM docs_rbr;
+              ({h.num_docs}, {h.average_doclength}, 'tf', '{stemmer}');
         """)
+        ciff_postings(con, stream, h.num_postings_lists, workers, chunk_bytes)
+        ciff_docs(con, stream, h.num_docs)
 
 
 def create_tokenizer(con, tokenizer):
@@ -116,16 +217,22 @@ def create_tokenizer_duckdb(con):
 
 
 def create_tokenizer_ciff(con):
+    """
+    Greedy longest match of dictionary terms on the characters of the query.
+    Only dictionary terms that occur in the query can match, so these are
+    selected with one scan of the dictionary before the recursion starts.
+    """
     con.sql("""
         CREATE MACRO fts_main_documents.tokenize(query_string) AS (
-          WITH RECURSIVE sequence AS (
-            SELECT range AS nr 
-            FROM RANGE((SELECT MAX(LEN(term)) + 1 FROM fts_main_documents.dict))
-          ),
-          simpledict AS (
+          WITH RECURSIVE simpledict AS MATERIALIZED (
             SELECT '' AS term
             UNION
             SELECT term FROM fts_main_documents.dict
+            WHERE contains(lower(strip_accents(CAST(query_string AS VARCHAR))), term)
+          ),
+          sequence AS (
+            SELECT range AS nr 
+            FROM RANGE((SELECT MAX(LEN(term)) + 1 FROM simpledict))
           ),
           subterms(term, subquery) AS (
             SELECT '', lower(strip_accents(CAST(query_string AS VARCHAR)))
@@ -161,15 +268,14 @@ def create_lm(con, stemmer):
             WHERE (dict.term = tokens.t)
         ),
         qterms AS (
-            SELECT termid, docid
+            SELECT termid, docid, tf
             FROM fts_main_documents.terms AS terms
             WHERE (CASE WHEN ((fields IS NULL)) THEN (1) ELSE (fieldid = ANY(SELECT * FROM fieldids)) END
             AND (termid = ANY(SELECT qtermids.termid FROM qtermids)))
         ),
         term_tf AS (
-            SELECT termid, docid, count_star() AS tf
+            SELECT termid, docid, tf
             FROM qterms
-            GROUP BY docid, termid
         ),
         cdocs AS (
             SELECT docid
@@ -193,8 +299,11 @@ def create_lm(con, stemmer):
 
 
 def create_bm25(con, stemmer):
-    con.sql(f"""
-        CREATE MACRO fts_main_documents.match_bm25(docname, query_string, b := 0.75, conjunctive := 0, k := 1.2, fields := NULL) AS (
+    """ BM25: match_bm25 scores one document, rank_bm25 all matching
+        documents at once (docname, score, postings_cost)
+    """
+    def scores(materialized=""):
+        return f"""
         WITH tokens AS (
             SELECT DISTINCT stem(unnest(fts_main_documents.tokenize(query_string)), '{stemmer}') AS t
         ),
@@ -208,16 +317,15 @@ def create_bm25(con, stemmer):
             FROM fts_main_documents.dict AS dict, tokens
             WHERE (dict.term = tokens.t)
         ),
-        qterms AS (
-            SELECT termid, docid
+        qterms AS {materialized}(
+            SELECT termid, docid, tf
             FROM fts_main_documents.terms AS terms
             WHERE (CASE WHEN ((fields IS NULL)) THEN (1) ELSE (fieldid = ANY(SELECT * FROM fieldids)) END
             AND (termid = ANY(SELECT qtermids.termid FROM qtermids)))
         ),
         term_tf AS (
-            SELECT termid, docid, count_star() AS tf
+            SELECT termid, docid, tf
             FROM qterms
-            GROUP BY docid, termid
         ),
         cdocs AS (
             SELECT docid
@@ -234,36 +342,46 @@ def create_bm25(con, stemmer):
         ),
         scores AS (
            SELECT docid, sum(subscore) AS score FROM subscores GROUP BY docid
-        )
+        )"""
+    con.sql(f"""
+        CREATE MACRO fts_main_documents.match_bm25(docname, query_string, b := 0.75, conjunctive := 0, k := 1.2, fields := NULL) AS (
+        {scores()}
         SELECT score FROM scores, fts_main_documents.docs AS docs
         WHERE ((scores.docid = docs.docid) AND (docs."name" = docname)))
     """)
+    ze_index.create_rank_bm25(con, scores, "b := 0.75, conjunctive := 0, k := 1.2, fields := NULL")
 
 
-def ciff_import(db_name, file_name, tokenizer='ciff', stemmer='none'):
+def ciff_import(db_name, file_name, tokenizer='ciff', stemmer='none',
+                metadata_file=None, workers=None, chunk_bytes=8000000):
+    """
+    Import a CIFF file as an index with a tf terms table. Document
+    identifiers (did) for main.documents are taken from metadata_file,
+    a parquet file, if given; otherwise from the names of the docs.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
     con = duckdb.connect(db_name)
     con.execute("""
         CREATE SCHEMA fts_main_documents;
         USE fts_main_documents;
     """)
-    ciff_arrow(con, file_name, stemmer)
+    ciff_tables(con, file_name, stemmer, workers, chunk_bytes)
     con.execute("""
-        CREATE TABLE dict AS SELECT termid, term, df FROM ciff_postings;
         CREATE TABLE fts_main_documents.fields(fieldid BIGINT, field VARCHAR);
-        CREATE TABLE terms(docid BIGINT, fieldid BIGINT, termid BIGINT);
-        WITH postings AS (
-          SELECT termid, unnest(postings, recursive := true) 
-          FROM ciff_postings
-        )
-        INSERT INTO terms(docid, fieldid, termid)
-        SELECT docid, 0, termid 
-        FROM postings, range(tf)
-        ORDER BY termid;
-        DROP TABLE ciff_postings;
-        CREATE TABLE main.documents AS SELECT DISTINCT name AS did FROM fts_main_documents.docs;
         -- new stats
         UPDATE fts_main_documents.stats SET sumdf = (SELECT SUM(df) FROM fts_main_documents.dict);
     """)
+    if metadata_file:
+        try:
+            con.execute("CREATE TABLE main.documents AS SELECT * FROM read_parquet($1)", [metadata_file])
+            con.execute("SELECT did FROM main.documents LIMIT 0")
+        except duckdb.duckdb.IOException as e:
+            raise FileNotFoundError(e)
+        except duckdb.duckdb.BinderException:
+            raise ValueError(f"Metadata file {metadata_file} has no column did.")
+    else:
+        con.execute("CREATE TABLE main.documents AS SELECT DISTINCT name AS did FROM fts_main_documents.docs")
     create_tokenizer(con, tokenizer)
     create_lm(con, stemmer)
     create_bm25(con, stemmer)
@@ -0,0 +1,173 @@
+"""
+Zoekeend reindex pipeline: the steps of ze_reindex_group, ze_reindex_prior,
+ze_reindex_fitted and ze_reindex_const in one pass. The index is copied
+once, and each step updates the small tables (dict, docs, stats) and the
+scoring macros in the order given, as the separate reindex commands would.
+The postings transformations of the steps are chained as common table
+expressions over the original terms table, so terms is rewritten at most
+once, at the end. Document ids stay the original ones in the chain; the
+renumbering of the fitted step is applied in the final rewrite.
+"""
+
+import time
+
+import duckdb
+
+import ze_reindex_const
+import ze_reindex_fitted
+import ze_reindex_group
+import ze_reindex_prior
+import ze_vacuum
+
+
+STEPS = ('group', 'prior', 'fitted', 'const')
+
+
+class Postings:
+    """ The postings (docid, fieldid, termid, tf) after each step """
+
+    def __init__(self):
+        self.ctes = ["postings0 AS (SELECT docid, fieldid, termid, tf FROM fts_main_documents.terms)"]
+        self.grouped = None
+
+    def last(self):
+        return f"postings{len(self.ctes) - 1}"
+
+    def add(self, select):
+        self.ctes.append(f"postings{len(self.ctes)} AS ({select})")
+
+    def changed(self):
+        return len(self.ctes) > 1
+
+    def query(self, select):
+        """ select over the postings, preceded by the chain """
+        return "WITH " + ",\n".join(self.ctes) + "\n" + select
+
+
+def check_steps(steps, fitted):
+    for step in steps:
+        if step not in STEPS:
+            raise ValueError(f"Unknown step {step}, use: {', '.join(STEPS)}.")
+        if steps.count(step) > 1:
+            raise ValueError(f"Step {step} is used more than once.")
+    if 'fitted' in steps and fitted.get('column', 'prior') not in ['len', 'prior']:
+        raise ValueError(f'Column "{fitted["column"]}" not allowed: use len or prior.')
+    # the macros of all steps use the document lengths
+    removes_len = [step for step in steps
+                   if step == 'const' or (step == 'fitted' and fitted.get('column') == 'len')]
+    if len(removes_len) > 1 or (removes_len and removes_len[0] != steps[-1]):
+        raise ValueError("Steps const and fitted on len remove the document "
+                         "lengths: use one of them, as the last step.")
+
+
+def step_group(con, postings, stemmer='porter'):
+    oldstemmer = ze_reindex_group.get_stats_stemmer(con)
+    if oldstemmer != 'none':
+        print(f"Warning: stemmer {oldstemmer} was already used on this database")
+    ze_reindex_group.create_newdict(con, stemmer)
+    postings.add(ze_reindex_group.select_grouped_postings(postings.last()))
+    postings.grouped = postings.last()
+    con.sql(f"""
+        UPDATE fts_main_documents.stats SET index_type = 'grouped({stemmer})';
+    """)
+    ze_reindex_group.replace_bm25(con, oldstemmer)
+
+
+def replace_grouped_dict(con, select):
+    """ The dict of step group, with the dfs of the grouped postings """
+    con.sql(f"""
+        DROP TABLE fts_main_documents.dict;
+        CREATE TABLE fts_main_documents.dict AS
+        {select};
+    """)
+
+
+def step_prior(con, postings, **options):
+    ze_reindex_prior.add_prior(con, **options)
+
+
+def step_fitted(con, postings, column='prior', **options):
+    try:
+        con.sql(f'SELECT "{column}" FROM fts_main_documents.docs LIMIT 0')
+    except duckdb.duckdb.BinderException:
+        raise ValueError(f"Step fitted needs a {column} column, use step prior first.")
+    ze_reindex_fitted.create_renumbered_docs(con, column)
+    con.sql("CREATE TEMP TABLE reindex_docids AS SELECT docid, newid FROM fts_main_documents.docs_new")
+    ze_reindex_fitted.replace_renumbered_docs(con)
+    ze_reindex_fitted.fit_column(con, column=column, **options)
+
+
+def step_const(con, postings, **options):
+    postings.add(ze_reindex_const.select_const_postings(postings.last(), 'reindex_doclens', **options))
+    ze_reindex_const.const_docs(con, const_len=options.get('const_len', 400), b=options.get('b', 1))
+
+
+def rewrite_terms(con, postings, renumbered):
+    """ Replace terms by the postings after all steps, renumbered if the
+        fitted step renumbered the documents
+    """
+    if renumbered:
+        select = f"""
+            SELECT D.newid AS docid, T.fieldid, T.termid, T.tf
+            FROM {postings.last()} T, reindex_docids D
+            WHERE T.docid = D.docid
+            ORDER BY T.termid
+        """
+    else:
+        select = f"SELECT docid, fieldid, termid, tf FROM {postings.last()}"
+    con.sql(f"""
+        CREATE TABLE fts_main_documents.terms_new AS
+        {postings.query(select)};
+        DROP TABLE fts_main_documents.terms;
+        ALTER TABLE fts_main_documents.terms_new RENAME TO terms;
+    """)
+
+
+def reindex(name_in, name_out, steps, group=None, prior=None, fitted=None, const=None):
+    """ Apply steps (names of STEPS) in order to a copy of index name_in,
+        with the options of each step as keyword arguments of its reindex
+        function. Returns the time in seconds per step.
+    """
+    options = {'group': group or {}, 'prior': prior or {}, 'fitted': fitted or {}, 'const': const or {}}
+    check_steps(steps, options['fitted'])
+    ze_vacuum.check_tf_file(name_in)
+    timings = []
+    start = time.time()
+    ze_vacuum.copy_file(name_in, name_out)
+    timings.append(('copy', time.time() - start))
+    con = duckdb.connect(name_out)
+    try:
+        if 'const' in steps:  # lengths for the final rewrite, step const removes them
+            con.sql("CREATE TEMP TABLE reindex_doclens AS SELECT docid, len FROM fts_main_documents.docs")
+        postings = Postings()
+        functions = {'group': step_group, 'prior': step_prior, 'fitted': step_fitted, 'const': step_const}
+        for step in steps:
+            start = time.time()
+            functions[step](con, postings, **options[step])
+            timings.append((step, time.time() - start))
+        if postings.grouped not in (None, postings.last()):
+            # dfs before a later step dropped postings, from the old terms
+            start = time.time()
+            select = ze_reindex_group.select_grouped_dict(postings.grouped)
+            replace_grouped_dict(con, postings.query(select))
+            timings.append(('dict', time.time() - start))
+        if postings.changed() or 'fitted' in steps:
+            start = time.time()
+            rewrite_terms(con, postings, renumbered='fitted' in steps)
+            timings.append(('terms', time.time() - start))
+        if postings.grouped == postings.last():
+            # dfs from the new terms, the cheaper join
+            start = time.time()
+            select = ze_reindex_group.select_grouped_dict('fts_main_documents.terms')
+            replace_grouped_dict(con, select)
+            timings.append(('dict', time.time() - start))
+        if 'group' in steps:
+            con.sql("DROP TABLE fts_main_documents.newdict")
+    finally:
+        con.close()
+    return timings
+
+
+if __name__ == "__main__":
+    reindex('cran.db', 'cran_reindexed.db', ['group', 'prior', 'fitted'],
+            prior={'init': 'len'})
@@ -1,16 +1,8 @@
 import duckdb
-import pathlib
 import sys
 
-
-def copy_file(name_in, name_out):
-    path1 = pathlib.Path(name_in)
-    if not(path1.is_file()):
-        raise ValueError(f"File {name_in} does not exist.")
-    path2 = pathlib.Path(name_out)
-    if path2.is_file():
-        raise ValueError(f"File {name_out} already exists.")
-    path2.write_bytes(path1.read_bytes())
+import ze_index
+import ze_vacuum
 
 
 def get_stats_stemmer(con):
@@ -21,10 +13,11 @@ def get_stats_stemmer(con):
 def replace_bm25_const(con, stemmer):
     """ New version of BM25; assuming that const_len=avgdl, the document
         length normalization part disappears and the ranking function
-        becomes BM1 from Robertson and Walker's SIGIR 1994 paper.
+        becomes BM1 from Robertson and Walker's SIGIR 1994 paper. Also
+        creates rank_bm25, which returns all matching documents.
     """
-    con.sql(f"""
-      CREATE OR REPLACE MACRO fts_main_documents.match_bm25(docname, query_string, b := 0.75, k := 1.2, conjunctive := 0, fields := NULL) AS (
+    def scores(materialized=""):
+        return f"""
         WITH tokens AS (
           SELECT DISTINCT stem(unnest(fts_main_documents.tokenize(query_string)), '{stemmer}') AS t
         ),
@@ -38,16 +31,15 @@ def replace_bm25_const(con, stemmer):
           FROM fts_main_documents.dict AS dict, tokens
           WHERE (dict.term = tokens.t)
         ),
-        qterms AS (
-          SELECT termid, docid
+        qterms AS {materialized}(
+          SELECT termid, docid, tf
           FROM fts_main_documents.terms AS terms
           WHERE (CASE  WHEN ((fields IS NULL)) THEN (1) ELSE (fieldid = ANY(SELECT * FROM fieldids)) END
           AND (termid = ANY(SELECT qtermids.termid FROM qtermids)))
         ),
         term_tf AS (
-          SELECT termid, docid, count_star() AS tf
+          SELECT termid, docid, tf
           FROM qterms
-          GROUP BY docid, termid
         ),
         cdocs AS (
           SELECT docid
@@ -67,12 +59,16 @@ def replace_bm25_const(con, stemmer):
           SELECT docid, sum(subscore) AS score
           FROM subscores
           GROUP BY docid
-        )
+        )"""
+    con.sql(f"""
+      CREATE OR REPLACE MACRO fts_main_documents.match_bm25(docname, query_string, b := 0.75, k := 1.2, conjunctive := 0, fields := NULL) AS (
+        {scores()}
         SELECT score
         FROM scores, fts_main_documents.docs AS docs
         WHERE (scores.docid = docs.docid) AND (docs."name" = docname)
       )
     """)
+    ze_index.create_rank_bm25(con, scores, "b := 0.75, k := 1.2, conjunctive := 0, fields := NULL")
 
 
 def get_sql_selects(con):
@@ -114,15 +110,15 @@ def replace_lm_const(con, stemmer, const_len):
             ),
             qterms AS (
                 SELECT termid,
-                       docid
+                       docid,
+                       tf
                 FROM fts_main_documents.terms AS terms
                 WHERE CASE WHEN fields IS NULL THEN 1 ELSE fieldid IN (SELECT * FROM fieldids) END
                   AND termid IN (SELECT qtermids.termid FROM qtermids)
             ),
             term_tf AS (
-                SELECT termid, docid, COUNT(*) AS tf
+                SELECT termid, docid, tf
                 FROM qterms
-                GROUP BY docid, termid
             ),
             cdocs AS (
                 SELECT docid
@@ -151,35 +147,38 @@ def replace_lm_const(con, stemmer, const_len):
         """)
 
 
-def reindex_const(name_in, name_out, const_len=400, b=1, keep_terms=False, maxp=1.0):
-    copy_file(name_in, name_out)
-    con = duckdb.connect(name_out)
+def select_const_postings(terms, docs, const_len=400, b=1, keep_terms=False, maxp=1.0):
+    """ Postings of terms with their tf rescaled to document length
+        const_len, using the len column of docs
+    """
     max_tf = int(const_len * maxp)
     if keep_terms:
         new_tf = 'CASE WHEN tf > 0.5 THEN tf - 0.5 ELSE 0.1 END'
     else:
         new_tf = 'tf - 0.5'
-    con.sql(f"""
-        CREATE TABLE fts_main_documents.terms_new (
-          docid BIGINT, fieldid BIGINT, termid BIGINT);
-        WITH sequence AS (
-          SELECT range AS nr FROM RANGE({max_tf})
-        ),
-        tf_new AS (
+    return f"""
+        WITH tf_norm AS (
           SELECT T.docid, T.fieldid, termid, 
           -- BM25-like length normalization:
-          COUNT(*) / (1 - {b} + {b} * (ANY_VALUE(D.len) / {const_len})) AS tf,
+          T.tf / (1 - {b} + {b} * (D.len / {const_len})) AS tf
+          FROM {terms} T, {docs} D 
+          WHERE T.docid = D.docid 
+        ),
+        tf_new AS (
+          SELECT docid, fieldid, termid, 
           -- proper rounding, but do not remove terms:
           {new_tf} AS new_tf
-          FROM fts_main_documents.terms T, fts_main_documents.docs D 
-          WHERE T.docid = D.docid 
-          GROUP BY T.docid, T.fieldid, T.termid
+          FROM tf_norm
         ) 
-        INSERT INTO fts_main_documents.terms_new 
-        SELECT docid, fieldid, termid 
-        FROM tf_new, sequence WHERE sequence.nr < tf_new.new_tf;
-        DROP TABLE fts_main_documents.terms;
-        ALTER TABLE fts_main_documents.terms_new RENAME TO terms;
+        -- the new tf counts the integers 0, 1, ... below new_tf, at most {max_tf}
+        SELECT docid, fieldid, termid, LEAST(CEIL(new_tf), {max_tf})::BIGINT AS tf
+        FROM tf_new WHERE new_tf > 0 AND {max_tf} > 0
+    """
+
+
+def const_docs(con, const_len=400, b=1):
+    """ Replace document lengths by const_len, and the macros that used them """
+    con.sql(f"""
         UPDATE fts_main_documents.stats 
           SET index_type = 'const(len={const_len},b={b})';
         ALTER TABLE fts_main_documents.stats ADD const_len BIGINT;
@@ -190,6 +189,22 @@ def reindex_const(name_in, name_out, const_len=400, b=1, keep_terms=False, maxp=
     stemmer = get_stats_stemmer(con)
     replace_bm25_const(con, stemmer)
     replace_lm_const(con, stemmer, const_len)
+
+
+def reindex_const(name_in, name_out, const_len=400, b=1, keep_terms=False, maxp=1.0):
+    ze_vacuum.check_tf_file(name_in)
+    ze_vacuum.copy_file(name_in, name_out)
+    con = duckdb.connect(name_out)
+    con.sql(f"""
+        CREATE TABLE fts_main_documents.terms_new (
+          docid BIGINT, fieldid BIGINT, termid BIGINT, tf BIGINT);
+        INSERT INTO fts_main_documents.terms_new
+        {select_const_postings('fts_main_documents.terms', 'fts_main_documents.docs',
+                               const_len=const_len, b=b, keep_terms=keep_terms, maxp=maxp)};
+        DROP TABLE fts_main_documents.terms;
+        ALTER TABLE fts_main_documents.terms_new RENAME TO terms;
+    """)
+    const_docs(con, const_len=const_len, b=b)
     con.close()
 
 
@@ -1,19 +1,10 @@
-import pathlib
 import sys
 
 import duckdb
 import ir_datasets
 
-
-def copy_file(name_in, name_out):
-    """ Simple file copy """
-    path1 = pathlib.Path(name_in)
-    if not path1.is_file():
-        raise ValueError(f"File {name_in} does not exist.")
-    path2 = pathlib.Path(name_out)
-    if path2.is_file():
-        raise ValueError(f"File {name_out} already exists.")
-    path2.write_bytes(path1.read_bytes())
+import ze_index
+import ze_vacuum
 
 
 def get_stats_stemmer(con):
@@ -141,8 +132,11 @@ def insert_qrels(con, qrels_tag):
 
 
 def replace_bm25_fitted_doclen(con, stemmer):
-    con.sql(f"""
-        CREATE OR REPLACE MACRO fts_main_documents.match_bm25(docname, query_string, b := 0.75, k := 1.2, conjunctive := 0, fields := NULL) AS (
+    """ BM25 with the fitted document lengths: match_bm25 scores one
+        document, rank_bm25 all matching documents at once
+    """
+    def scores(materialized=""):
+        return f"""
             WITH tokens AS (
                 SELECT DISTINCT stem(unnest(fts_main_documents.tokenize(query_string)), '{stemmer}') AS t
             ),
@@ -157,17 +151,17 @@ def replace_bm25_fitted_doclen(con, stemmer):
                      tokens
                 WHERE dict.term = tokens.t
             ),
-            qterms AS (
+            qterms AS {materialized}(
                 SELECT termid,
-                       docid
+                       docid,
+                       tf
                 FROM fts_main_documents.terms AS terms
                 WHERE CASE WHEN fields IS NULL THEN 1 ELSE fieldid IN (SELECT * FROM fieldids) END
                   AND termid IN (SELECT qtermids.termid FROM qtermids)
             ),
             term_tf AS (
-                SELECT termid, docid, COUNT(*) AS tf
+                SELECT termid, docid, tf
                 FROM qterms
-                GROUP BY docid, termid
             ),
             cdocs AS (
                 SELECT docid
@@ -187,13 +181,17 @@ def replace_bm25_fitted_doclen(con, stemmer):
                 SELECT docid, sum(subscore) AS score
                 FROM subscores
                 GROUP BY docid
-            )
+            )"""
+    con.sql(f"""
+        CREATE OR REPLACE MACRO fts_main_documents.match_bm25(docname, query_string, b := 0.75, k := 1.2, conjunctive := 0, fields := NULL) AS (
+            {scores()}
             SELECT score
             FROM scores, fts_main_documents.docs AS docs
             WHERE scores.docid = docs.docid
               AND docs.name = docname
         )"""
     )
+    ze_index.create_rank_bm25(con, scores, "b := 0.75, k := 1.2, conjunctive := 0, fields := NULL")
 
 
 def replace_lm_fitted_doclen(con, stemmer):
@@ -215,15 +213,15 @@ def replace_lm_fitted_doclen(con, stemmer):
             ),
             qterms AS (
                 SELECT termid,
-                       docid
+                       docid,
+                       tf
                 FROM fts_main_documents.terms AS terms
                 WHERE CASE WHEN fields IS NULL THEN 1 ELSE fieldid IN (SELECT * FROM fieldids) END
                   AND termid IN (SELECT qtermids.termid FROM qtermids)
             ),
             term_tf AS (
-                SELECT termid, docid, COUNT(*) AS tf
+                SELECT termid, docid, tf
                 FROM qterms
-                GROUP BY docid, termid
             ),
             cdocs AS (
                 SELECT docid
@@ -277,15 +275,15 @@ def replace_lm_fitted_prior(con, stemmer='none'):
             ),
             qterms AS (
                 SELECT termid,
-                       docid
+                       docid,
+                       tf
                 FROM fts_main_documents.terms AS terms
                 WHERE CASE WHEN fields IS NULL THEN 1 ELSE fieldid IN (SELECT * FROM fieldids) END
                   AND termid IN (SELECT qtermids.termid FROM qtermids)
             ),
             term_tf AS (
-                SELECT termid, docid, COUNT(*) AS tf
+                SELECT termid, docid, tf
                 FROM qterms
-                GROUP BY docid, termid
             ),
             cdocs AS (
                 SELECT docid
@@ -315,36 +313,53 @@ def replace_lm_fitted_prior(con, stemmer='none'):
     con.sql(sql)
 
 
-def renumber_doc_ids(con, column):
+def create_renumbered_docs(con, column):
+    """ docs_new renumbers document ids by decreasing len/prior column """
     con.sql(f"""
-        -- renumber document ids by decreasing len/prior column
         CREATE TABLE fts_main_documents.docs_new AS
         SELECT ROW_NUMBER() over (ORDER BY "{column}" DESC, name ASC) newid, docs.*
         FROM fts_main_documents.docs AS docs;
-        -- update postings
-        CREATE TABLE fts_main_documents.terms_new AS
-        SELECT D.newid as docid, T.fieldid, T.termid
-        FROM fts_main_documents.terms T, fts_main_documents.docs_new D
-        WHERE T.docid = D.docid 
-        ORDER BY T.termid;
-        -- replace old by new data
+    """)
+
+
+def select_renumbered_postings(terms):
+    """ Postings of terms with the new document ids of docs_new """
+    return f"""
+        SELECT D.newid as docid, T.fieldid, T.termid, T.tf
+        FROM {terms} T, fts_main_documents.docs_new D
+        WHERE T.docid = D.docid
+    """
+
+
+def replace_renumbered_docs(con):
+    """ Replace docs by docs_new """
+    con.sql("""
         ALTER TABLE fts_main_documents.docs_new DROP COLUMN docid;
         ALTER TABLE fts_main_documents.docs_new RENAME COLUMN newid TO docid;
         DROP TABLE fts_main_documents.docs;
-        DROP TABLE fts_main_documents.terms;
         ALTER TABLE fts_main_documents.docs_new RENAME TO docs;
-        ALTER TABLE fts_main_documents.terms_new RENAME TO terms;
         UPDATE fts_main_documents.stats SET index_type = 'fitted';
     """)
 
 
-def reindex_fitted_column(name_in, name_out, column='prior', total=None,
-                          print_sample=False, threshold=0, qrels=None):
-    if column not in ['len', 'prior']:
-        raise ValueError(f'Column "{column}" not allowed: use len or prior.')
-    copy_file(name_in, name_out)
-    con = duckdb.connect(name_out)
-    renumber_doc_ids(con, column)
+def renumber_doc_ids(con, column):
+    create_renumbered_docs(con, column)
+    con.sql(f"""
+        -- update postings
+        CREATE TABLE fts_main_documents.terms_new AS
+        {select_renumbered_postings('fts_main_documents.terms')}
+        ORDER BY T.termid;
+        DROP TABLE fts_main_documents.terms;
+        ALTER TABLE fts_main_documents.terms_new RENAME TO terms;
+    """)
+    replace_renumbered_docs(con)
+
+
+def fit_column(con, column='prior', total=None, print_sample=False,
+               threshold=0, qrels=None):
+    """ Replace the len/prior column of (renumbered) docs by a linear
+        regression on the document ids, and the macros that used it
+    """
     try:
         con.sql("""
             ALTER TABLE fts_main_documents.stats ADD intercept DOUBLE;
@@ -376,6 +391,18 @@ def reindex_fitted_column(name_in, name_out, column='prior', total=None,
         replace_bm25_fitted_doclen(con, stemmer=stemmer)
     else:
         replace_lm_fitted_prior(con, stemmer=stemmer)
+
+
+def reindex_fitted_column(name_in, name_out, column='prior', total=None,
+                          print_sample=False, threshold=0, qrels=None):
+    if column not in ['len', 'prior']:
+        raise ValueError(f'Column "{column}" not allowed: use len or prior.')
+    ze_vacuum.check_tf_file(name_in)
+    ze_vacuum.copy_file(name_in, name_out)
+    con = duckdb.connect(name_out)
+    renumber_doc_ids(con, column)
+    fit_column(con, column=column, total=total, print_sample=print_sample,
+               threshold=threshold, qrels=qrels)
     con.close()
 
 
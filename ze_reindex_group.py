@@ -1,16 +1,8 @@
 import duckdb
-import pathlib
 import sys
 
-
-def copy_file(name_in, name_out):
-    path1 = pathlib.Path(name_in)
-    if not(path1.is_file()):
-        raise ValueError(f"File {name_in} does not exist.")
-    path2 = pathlib.Path(name_out)
-    if path2.is_file():
-        raise ValueError(f"File {name_out} already exists.")
-    path2.write_bytes(path1.read_bytes())
+import ze_index
+import ze_vacuum
 
 
 def get_stats_stemmer(con):
@@ -20,10 +12,11 @@ def get_stats_stemmer(con):
 
 def replace_bm25(con, stemmer):
     """ The standard DuckDB BM25 implementation does not work with the grouped index.
-        This version also works with the standard DuckDB index.
+        This version also works with the standard DuckDB index. Also creates
+        rank_bm25, which returns all matching documents like match_lm.
     """
-    con.sql(f"""
-      CREATE OR REPLACE MACRO fts_main_documents.match_bm25(docname, query_string, b := 0.75, k := 1.2, conjunctive := 0, fields := NULL) AS (
+    def scores(materialized=""):
+        return f"""
         WITH tokens AS (
           SELECT DISTINCT stem(unnest(fts_main_documents.tokenize(query_string)), '{stemmer}') AS t
         ),
@@ -37,16 +30,15 @@ def replace_bm25(con, stemmer):
           FROM fts_main_documents.dict AS dict, tokens
           WHERE (dict.term = tokens.t)
         ),
-        qterms AS (
-          SELECT termid, docid
+        qterms AS {materialized}(
+          SELECT termid, docid, tf
           FROM fts_main_documents.terms AS terms
           WHERE (CASE  WHEN ((fields IS NULL)) THEN (1) ELSE (fieldid = ANY(SELECT * FROM fieldids)) END
           AND (termid = ANY(SELECT qtermids.termid FROM qtermids)))
         ),
         term_tf AS (
-          SELECT termid, docid, count_star() AS tf
+          SELECT termid, docid, tf
           FROM qterms
-          GROUP BY docid, termid
         ),
         cdocs AS (
           SELECT docid
@@ -66,39 +58,66 @@ def replace_bm25(con, stemmer):
           SELECT docid, sum(subscore) AS score
           FROM subscores
           GROUP BY docid
-        )
+        )"""
+    con.sql(f"""
+      CREATE OR REPLACE MACRO fts_main_documents.match_bm25(docname, query_string, b := 0.75, k := 1.2, conjunctive := 0, fields := NULL) AS (
+        {scores()}
         SELECT score
         FROM scores, fts_main_documents.docs AS docs
         WHERE (scores.docid = docs.docid) AND (docs."name" = docname)
       )
     """)
+    ze_index.create_rank_bm25(con, scores, "b := 0.75, k := 1.2, conjunctive := 0, fields := NULL")
+
+
+def create_newdict(con, stemmer):
+    """ newdict gives stems unique ids """
+    con.sql(f"""
+        CREATE TABLE fts_main_documents.newdict AS
+        SELECT termid, term, stem(term, '{stemmer}') AS stem, DENSE_RANK() OVER (ORDER BY stem) AS newid, df
+        FROM fts_main_documents.dict;
+    """)
+
+
+def select_grouped_postings(terms):
+    """ Postings of terms with the new ids of newdict """
+    return f"""
+        SELECT terms.docid, terms.fieldid, newdict.newid AS termid, SUM(terms.tf)::BIGINT AS tf
+        FROM {terms} AS terms, fts_main_documents.newdict AS newdict
+        WHERE terms.termid = newdict.termid
+        GROUP BY terms.docid, terms.fieldid, newdict.newid
+    """
+
+
+def select_grouped_dict(terms):
+    """ The dict of grouped postings terms: new ids and new dfs """
+    return f"""
+        SELECT D.newid AS termid, D.term, T.df
+        FROM fts_main_documents.newdict D, (
+          SELECT termid, COUNT(DISTINCT docid) AS df FROM {terms} GROUP BY termid
+        ) T
+        WHERE T.termid = D.newid
+    """
 
 
 def reindex_group(name_in, name_out, stemmer='porter'):
-    copy_file(name_in, name_out)
+    ze_vacuum.check_tf_file(name_in)
+    ze_vacuum.copy_file(name_in, name_out)
     con = duckdb.connect(name_out)
     oldstemmer = get_stats_stemmer(con)
     if oldstemmer != 'none':
         print(f"Warning: stemmer {oldstemmer} was already used on this database")
+    create_newdict(con, stemmer)
     con.sql(f"""
-        -- newdict gives stems unique ids
-        CREATE TABLE fts_main_documents.newdict AS
-        SELECT termid, term, stem(term, '{stemmer}') AS stem, DENSE_RANK() OVER (ORDER BY stem) AS newid, df
-        FROM fts_main_documents.dict;
         DROP TABLE fts_main_documents.dict;
         -- newterms uses those new ids
         CREATE TABLE fts_main_documents.newterms AS
-        SELECT terms.docid, terms.fieldid, newdict.newid AS termid
-        FROM fts_main_documents.terms AS terms, fts_main_documents.newdict AS newdict
-        WHERE terms.termid = newdict.termid;
+        {select_grouped_postings('fts_main_documents.terms')};
         DROP TABLE fts_main_documents.terms;
         ALTER TABLE fts_main_documents.newterms RENAME TO terms;
         -- now remove old ids from dict table and compute new dfs.
         CREATE TABLE fts_main_documents.dict AS
-        SELECT D.newid AS termid, D.term, COUNT(DISTINCT T.docid) AS df
-        FROM fts_main_documents.newdict D, fts_main_documents.terms T
-        WHERE T.termid = D.newid
-        GROUP BY D.newid, D.term;
+        {select_grouped_dict('fts_main_documents.terms')};
         DROP TABLE fts_main_documents.newdict;
         -- update stats
         UPDATE fts_main_documents.stats SET index_type = 'grouped({stemmer})';
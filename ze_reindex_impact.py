@@ -0,0 +1,170 @@
+import duckdb
+
+import ze_index
+import ze_vacuum
+
+
+def get_stats_stemmer(con):
+    sql = "SELECT stemmer FROM fts_main_documents.stats"
+    return con.sql(sql).fetchall()[0][0]
+
+
+def replace_lm_impact(con, stemmer, doc_prior="LN(docs.len)"):
+    """ Language model: the document length prior plus the sum of the
+        precomputed impacts of the query terms. Lambda is fixed at reindex
+        time; it is accepted for compatibility with create_lm of ze_index,
+        but ignored.
+    """
+    con.sql(f"""
+        CREATE OR REPLACE MACRO fts_main_documents.match_lm(query_string, fields := NULL, lambda := NULL, conjunctive := 0) AS TABLE (
+        WITH tokens AS (
+            SELECT DISTINCT stem(unnest(fts_main_documents.tokenize(query_string)), '{stemmer}') AS t
+        ),
+        fieldids AS (
+            SELECT fieldid
+            FROM fts_main_documents.fields
+            WHERE CASE WHEN ((fields IS NULL)) THEN (1) ELSE (field = ANY(SELECT * FROM (SELECT unnest(string_split(fields, ','))) AS fsq)) END
+        ),
+        qtermids AS (
+            SELECT termid
+            FROM fts_main_documents.dict AS dict, tokens
+            WHERE (dict.term = tokens.t)
+        ),
+        qterms AS (
+            SELECT termid, docid, lm_impact AS impact
+            FROM fts_main_documents.terms AS terms
+            WHERE (CASE WHEN ((fields IS NULL)) THEN (1) ELSE (fieldid = ANY(SELECT * FROM fieldids)) END
+            AND (termid = ANY(SELECT qtermids.termid FROM qtermids)))
+        ),
+        scores AS (
+            SELECT docid, sum(impact) AS impact
+            FROM qterms
+            GROUP BY docid
+            HAVING CASE WHEN (conjunctive) THEN ((count(DISTINCT termid) = (SELECT count_star() FROM tokens))) ELSE 1 END
+        ),
+        postings_cost AS (
+           SELECT COUNT(*) AS cost FROM qterms
+        )
+        SELECT docs.name AS docname, {doc_prior} + impact * (SELECT ANY_VALUE(lm_scale) FROM fts_main_documents.stats) AS score,
+            (SELECT cost FROM postings_cost) AS postings_cost
+        FROM scores, fts_main_documents.docs AS docs
+        WHERE scores.docid = docs.docid
+        );
+    """)
+
+
+def replace_bm25_impact(con, stemmer):
+    """ BM25: the sum of the precomputed impacts of the query terms. The
+        parameters k and b are fixed at reindex time; they are accepted
+        for compatibility with the BM25 macros of ze_index, but ignored.
+        match_bm25 scores one document, rank_bm25 all matching documents.
+    """
+    def scores(materialized=""):
+        return f"""
+        WITH tokens AS (
+            SELECT DISTINCT stem(unnest(fts_main_documents.tokenize(query_string)), '{stemmer}') AS t
+        ),
+        fieldids AS (
+            SELECT fieldid
+            FROM fts_main_documents.fields
+            WHERE CASE WHEN ((fields IS NULL)) THEN (1) ELSE (field = ANY(SELECT * FROM (SELECT unnest(string_split(fields, ','))) AS fsq)) END
+        ),
+        qtermids AS (
+            SELECT termid
+            FROM fts_main_documents.dict AS dict, tokens
+            WHERE (dict.term = tokens.t)
+        ),
+        qterms AS {materialized}(
+            SELECT termid, docid, bm25_impact AS impact
+            FROM fts_main_documents.terms AS terms
+            WHERE (CASE WHEN ((fields IS NULL)) THEN (1) ELSE (fieldid = ANY(SELECT * FROM fieldids)) END
+            AND (termid = ANY(SELECT qtermids.termid FROM qtermids)))
+        ),
+        scores AS (
+            SELECT docid, sum(impact) * (SELECT ANY_VALUE(bm25_scale) FROM fts_main_documents.stats) AS score
+            FROM qterms
+            GROUP BY docid
+            HAVING CASE WHEN (conjunctive) THEN ((count(DISTINCT termid) = (SELECT count_star() FROM tokens))) ELSE 1 END
+        )"""
+    con.sql(f"""
+        CREATE OR REPLACE MACRO fts_main_documents.match_bm25(docname, query_string, fields := NULL, k := NULL, b := NULL, conjunctive := 0) AS (
+        {scores()}
+        SELECT score FROM scores, fts_main_documents.docs AS docs
+        WHERE ((scores.docid = docs.docid) AND (docs."name" = docname)))
+    """)
+    ze_index.create_rank_bm25(con, scores, "fields := NULL, k := NULL, b := NULL, conjunctive := 0", cost_from="qterms")
+
+
+def add_max_impacts(con):
+    """ The maximum impact of each term in a document, for dynamic pruning
+        (see ze_search_maxscore), from the block maxima of ze_vacuum.
+    """
+    con.sql("""
+        ALTER TABLE fts_main_documents.dict ADD lm_max INTEGER;
+        ALTER TABLE fts_main_documents.dict ADD bm25_max INTEGER;
+        UPDATE fts_main_documents.dict
+          SET lm_max = M.lm_max, bm25_max = M.bm25_max
+          FROM (
+            SELECT termid, MAX(lm_max) AS lm_max, MAX(bm25_max) AS bm25_max
+            FROM fts_main_documents.blocks
+            GROUP BY termid
+          ) AS M
+          WHERE dict.termid = M.termid;
+    """)
+
+
+def reindex_impact(name_in, name_out, lmbda=0.3, k=0.9, b=0.4, bits=8, block_size=128):
+    """ Add the LM impact (for lambda) and BM25 impact (for k and b)
+        of every posting to the terms table, quantized uniformly to
+        integers of {bits} bits. The scale of each impact is stored in
+        the stats table: impact = quantized impact * scale. Block-max
+        metadata per {block_size} documents is stored in the blocks table,
+        and block_size in the stats table.
+    """
+    if not 1 <= bits <= 16:
+        raise ValueError(f"Number of bits must be between 1 and 16, not {bits}.")
+    if block_size < 1:
+        raise ValueError(f"Block size must be positive, not {block_size}.")
+    ze_vacuum.check_tf_file(name_in, doclen=True)
+    ze_vacuum.copy_file(name_in, name_out)
+    con = duckdb.connect(name_out)
+    impact_type = 'UTINYINT' if bits <= 8 else 'USMALLINT'
+    levels = 2 ** bits - 1
+    con.sql(f"""
+        CREATE TEMP TABLE impacts AS
+        SELECT T.docid, T.fieldid, T.termid, T.tf,
+          LN(1 + ({lmbda} * T.tf * S.sumdf) / ((1 - {lmbda}) * dict.df * D.len)) AS lm,
+          log((((S.num_docs - dict.df) + 0.5) / (dict.df + 0.5)) + 1) *
+            ((T.tf * ({k} + 1)) / (T.tf + ({k} * ((1 - {b}) + ({b} * (D.len / S.avgdl)))))) AS bm25
+        FROM fts_main_documents.terms T, fts_main_documents.docs D,
+          fts_main_documents.dict, fts_main_documents.stats S
+        WHERE T.docid = D.docid AND T.termid = dict.termid;
+        ALTER TABLE fts_main_documents.stats ADD lm_scale DOUBLE;
+        ALTER TABLE fts_main_documents.stats ADD bm25_scale DOUBLE;
+        ALTER TABLE fts_main_documents.stats ADD block_size BIGINT;
+        UPDATE fts_main_documents.stats SET
+          lm_scale = (SELECT MAX(lm) / {levels} FROM impacts),
+          bm25_scale = (SELECT MAX(bm25) / {levels} FROM impacts),
+          block_size = {block_size};
+        CREATE TABLE fts_main_documents.terms_new AS
+        SELECT docid, fieldid, termid, tf,
+          ROUND(lm / (SELECT lm_scale FROM fts_main_documents.stats))::{impact_type} AS lm_impact,
+          ROUND(bm25 / (SELECT bm25_scale FROM fts_main_documents.stats))::{impact_type} AS bm25_impact
+        FROM impacts
+        ORDER BY termid, docid;
+        DROP TABLE impacts;
+        DROP TABLE fts_main_documents.terms;
+        ALTER TABLE fts_main_documents.terms_new RENAME TO terms;
+        UPDATE fts_main_documents.stats
+          SET index_type = 'impact(lambda={lmbda},k={k},b={b},bits={bits})';
+    """)
+    ze_vacuum.create_blocks(con, block_size=block_size)
+    add_max_impacts(con)
+    stemmer = get_stats_stemmer(con)
+    replace_lm_impact(con, stemmer, doc_prior=f"LN(docs.{ze_vacuum.get_doc_prior(con)})")
+    replace_bm25_impact(con, stemmer)
+    con.close()
+
+
+if __name__ == "__main__":
+    reindex_impact('cran.db', 'cran_impact.db')
@@ -1,17 +1,8 @@
-import pathlib
 import sys
 
 import duckdb
 
-
-def copy_file(name_in, name_out):
-    path1 = pathlib.Path(name_in)
-    if not path1.is_file():
-        raise ValueError(f"File {name_in} does not exist.")
-    path2 = pathlib.Path(name_out)
-    if path2.is_file():
-        raise ValueError(f"File {name_out} already exists.")
-    path2.write_bytes(path1.read_bytes())
+import ze_vacuum
 
 
 def get_stats_stemmer(con):
@@ -36,15 +27,14 @@ def replace_lm_prior(con, stemmer):
             WHERE (dict.term = tokens.t)
         ),
         qterms AS (
-            SELECT termid, docid
+            SELECT termid, docid, tf
             FROM fts_main_documents.terms AS terms
             WHERE (CASE WHEN ((fields IS NULL)) THEN (1) ELSE (fieldid = ANY(SELECT * FROM fieldids)) END
             AND (termid = ANY(SELECT qtermids.termid FROM qtermids)))
         ),
         term_tf AS (
-            SELECT termid, docid, count_star() AS tf
+            SELECT termid, docid, tf
             FROM qterms
-            GROUP BY docid, termid
         ),
         cdocs AS (
             SELECT docid
@@ -90,9 +80,8 @@ def insert_priors(con, csv_file, default):
             print(f"Warning: {count} rows missing from file. Use --default", file=sys.stderr)
 
 
-def reindex_prior(name_in, name_out, csv_file=None, default=None, init=None):
-    copy_file(name_in, name_out)
-    con = duckdb.connect(name_out)
+def add_prior(con, csv_file=None, default=None, init=None):
+    """ Add the prior column to docs and the LM macro that uses it """
     con.sql("ALTER TABLE fts_main_documents.docs ADD prior DOUBLE")
     if (csv_file and init):
         print(f"Warning: init={init} ignored.", file=sys.stderr)
@@ -107,6 +96,13 @@ def reindex_prior(name_in, name_out, csv_file=None, default=None, init=None):
             raise ValueError(f'Unknown value for init: {init}')
     stemmer = get_stats_stemmer(con)
     replace_lm_prior(con, stemmer=stemmer)
+
+
+def reindex_prior(name_in, name_out, csv_file=None, default=None, init=None):
+    ze_vacuum.check_tf_file(name_in)
+    ze_vacuum.copy_file(name_in, name_out)
+    con = duckdb.connect(name_out)
+    add_prior(con, csv_file=csv_file, default=default, init=init)
     con.close()
 
 
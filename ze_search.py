@@ -3,21 +3,110 @@ Zoekeend searcher.
 Author: Djoerd Hiemstra
 """
 
+import collections
+import concurrent.futures
+import json
+import os
 import sys
+import time
 
 import duckdb
 import ir_datasets
 
+import ze_vacuum
+
 
 def duckdb_search_lm(con, query, limit):
     sql = """
         SELECT docname, score, postings_cost
         FROM fts_main_documents.match_lm($1)
-        ORDER BY score DESC
+        ORDER BY score DESC, docname
         LIMIT $2
     """
     return con.execute(sql, [query, limit]).fetchall()
 
+
+BATCH_QTERMIDS = """
+    WITH queries AS (
+        SELECT UNNEST($1) AS query, GENERATE_SUBSCRIPTS($1, 1) AS pos
+    ),
+    tokens AS (
+        SELECT DISTINCT pos, stem(unnest(fts_main_documents.tokenize(query)), stats.stemmer) AS t
+        FROM queries, fts_main_documents.stats AS stats
+    ),
+    qtermids AS (
+        SELECT pos, termid, df, ROW_NUMBER() OVER (PARTITION BY pos ORDER BY termid DESC) AS r
+        FROM fts_main_documents.dict AS dict, tokens
+        WHERE (dict.term = tokens.t)
+    )
+"""
+
+
+def check_batch_index(con):
+    """ Batch search computes the match_lm of ze_index: it needs postings
+        with term frequencies and document lengths (reindex_const and
+        reindex_fitted on len remove the lengths), and a match_lm that
+        reindex_impact did not replace (it adds lm_scale to stats)
+    """
+    ze_vacuum.check_tf_postings(con, doclen=True)
+    try:
+        con.sql("SELECT lm_scale FROM fts_main_documents.stats LIMIT 0")
+    except duckdb.duckdb.BinderException:
+        return
+    raise ValueError("Batch search cannot use the impacts of reindex_impact, search without batch.")
+
+
+def duckdb_search_lm_batch(con, queries, limit, l=0.3):
+    """ match_lm for a list of queries in one statement: the query terms
+        of all queries are joined with the terms table together, and the
+        top-k per query is selected by a window. Sums the subscores of a
+        document in the same order as match_lm on the postings of ze_index,
+        so scores are identical; on rewritten postings (grouped) they may
+        differ in the last bits. Returns a list of hits per query.
+    """
+    check_batch_index(con)
+    (num_terms,) = con.execute(BATCH_QTERMIDS + """
+        SELECT COALESCE(MAX(r), 0) FROM qtermids
+    """, [queries]).fetchall()[0]
+    hits = [[] for _ in queries]
+    if num_terms == 0:
+        return hits
+    # one column per query term, added in the order of the sum in match_lm
+    columns = ",\n".join(f"MAX(CASE WHEN r = {i} THEN subscore END) AS s{i}"
+                         for i in range(1, num_terms + 1))
+    total = " + ".join(["0::DOUBLE"] + [f"COALESCE(s{i}, 0)" for i in range(1, num_terms + 1)])
+    sql = BATCH_QTERMIDS + f""",
+        qterms AS (
+            SELECT pos, terms.termid, docid, tf
+            FROM fts_main_documents.terms AS terms, (SELECT DISTINCT pos, termid FROM qtermids) AS q
+            WHERE (terms.termid = q.termid)
+        ),
+        subscores AS (
+            SELECT qterms.pos, docs.docid, docs.len AS doc_len, qtermids.r, LN(1 + ({l} * tf * (SELECT ANY_VALUE(sumdf) FROM fts_main_documents.stats)) / ((1-{l}) * df * docs.len)) AS subscore
+            FROM qterms, fts_main_documents.docs AS docs, qtermids
+            WHERE ((qterms.docid = docs.docid)
+            AND (qterms.pos = qtermids.pos)
+            AND (qterms.termid = qtermids.termid))
+        ),
+        docsubscores AS (
+            SELECT pos, docs.name AS docname, MAX(doc_len) AS doc_len, {columns}
+            FROM subscores, fts_main_documents.docs AS docs
+            WHERE subscores.docid = docs.docid
+            GROUP BY pos, docs.name
+        ),
+        postings_cost AS (
+            SELECT pos, COUNT(*) AS cost FROM qterms GROUP BY pos
+        )
+        SELECT docsubscores.pos, docname, LN(doc_len) + ({total}) AS score, cost
+        FROM docsubscores, postings_cost
+        WHERE docsubscores.pos = postings_cost.pos
+        QUALIFY ROW_NUMBER() OVER (PARTITION BY docsubscores.pos ORDER BY score DESC, docname) <= $2
+        ORDER BY docsubscores.pos, score DESC, docname
+    """
+    for (pos, docname, score, cost) in con.execute(sql, [queries, limit]).fetchall():
+        hits[pos - 1].append((docname, score, cost))
+    return hits
+
 # def duckdb_search_lm(con, query, limit, l):
 #     print(f"Searching for: {query} with limit {limit} and l={l}")
 #     sql = """
@@ -45,15 +134,79 @@ def duckdb_print_query(con, query):
 
 def duckdb_search_bm25(con, query, limit, b, k):
     sql = """
-        SELECT did, score
-        FROM (
-            SELECT did, fts_main_documents.match_bm25(did, $1, b=$2, k=$3) AS score
-            FROM documents) sq
-        WHERE score IS NOT NULL
-        ORDER BY score DESC
+        SELECT docname, score, postings_cost
+        FROM fts_main_documents.rank_bm25($1, b := $2, k := $3)
+        ORDER BY score DESC, docname
         LIMIT $4
     """
-    return con.execute(sql, [query, b, k, limit]).fetchall()
+    try:
+        return con.execute(sql, [query, b, k, limit]).fetchall()
+    except duckdb.duckdb.CatalogException:
+        raise ValueError("Index has no rank_bm25 macro; rebuild it, or reindex it.")
+
+def numpy_query_terms(csr, con, query):
+    """ Vocabulary positions of the (distinct) query terms in the CSR sidecar,
+        or their termids in the compressed postings (see ze_compress)
+    """
+    sql = f"""
+        SELECT DISTINCT stem(unnest(fts_main_documents.tokenize($1)), '{csr.meta['stemmer']}')
+    """
+    terms = [csr.lookup(term) for (term,) in con.execute(sql, [query]).fetchall()]
+    return [i for i in terms if i is not None]
+
+
+def numpy_top_k(csr, docids, subscores, prior, limit):
+    """ Scatter-add the subscores per document, and select the top-k;
+        ties are broken by name rank, like ORDER BY score DESC, docname
+    """
+    import numpy as np
+
+    cost = len(docids)
+    if cost == 0:
+        return []
+    size = len(csr.doclen)
+    matched = np.flatnonzero(np.bincount(docids, minlength=size))
+    scores = np.bincount(docids, weights=subscores, minlength=size)[matched]
+    if prior is not None:
+        scores = prior[matched] + scores
+    if len(scores) > limit:
+        kth = np.partition(scores, len(scores) - limit)[len(scores) - limit]
+        top = scores >= kth  # all documents tied with the k-th, to break ties by name
+        (matched, scores) = (matched[top], scores[top])
+    order = np.lexsort((csr.name_rank[matched], -scores))[:limit]
+    return [(csr.name(d), score, cost) for (d, score) in zip(matched[order].tolist(), scores[order].tolist())]
+
+
+def numpy_search_lm(csr, con, query, limit, l=0.3):
+    """ The language model of match_lm on the CSR sidecar (see ze_csr) """
+    import numpy as np
+
+    (docids, subscores) = ([], [])
+    for i in numpy_query_terms(csr, con, query):
+        (d, tf) = csr.postings(i)
+        docids.append(d)
+        subscores.append(np.log(1 + (l * tf * csr.meta['sumdf']) / ((1 - l) * csr.df[i] * csr.doclen[d])))
+    if not docids:
+        return []
+    return numpy_top_k(csr, np.concatenate(docids), np.concatenate(subscores), csr.logprior, limit)
+
+
+def numpy_search_bm25(csr, con, query, limit, b, k):
+    """ BM25 of match_bm25 on the CSR sidecar (see ze_csr) """
+    import numpy as np
+
+    (docids, subscores) = ([], [])
+    (num_docs, avgdl) = (csr.meta['num_docs'], csr.meta['avgdl'])
+    for i in numpy_query_terms(csr, con, query):
+        (d, tf) = csr.postings(i)
+        df = csr.df[i]
+        docids.append(d)
+        subscores.append(np.log10((((num_docs - df) + 0.5) / (df + 0.5)) + 1) *
+                         ((tf * (k + 1)) / (tf + (k * ((1 - b) + (b * (csr.doclen[d] / avgdl)))))))
+    if not docids:
+        return []
+    return numpy_top_k(csr, np.concatenate(docids), np.concatenate(subscores), None, limit)
+
 
 class Query:
     def __init__(self, query_id, text):
@@ -79,37 +232,271 @@ def get_queries(query_tag):
     return get_queries_from_file(query_tag)
 
 
+class Searcher:
+    """ Index db_name, opened read-only for a search engine and matcher """
+
+    def __init__(self, db_name, matcher='lm', engine='duckdb', b=0.75, k=1.2, limit=1000):
+        if matcher not in ('lm', 'bm25'):
+            raise ValueError(f"Unknown match function: {matcher}")
+        if engine not in ('duckdb', 'maxscore', 'numpy', 'varbyte'):
+            raise ValueError(f"Unknown search engine: {engine}")
+        (self.matcher, self.engine, self.b, self.k, self.limit) = (matcher, engine, b, k, limit)
+        self.con = duckdb.connect(db_name, read_only=True)
+        if engine == 'maxscore':
+            import ze_search_maxscore
+            self.index = ze_search_maxscore.ImpactIndex(self.con, matcher)
+        elif engine == 'numpy':
+            import ze_csr
+            self.csr = ze_csr.CSRIndex(ze_csr.csr_path(db_name))
+            self.csr.check(self.con)
+        elif engine == 'varbyte':
+            import ze_compress
+            self.csr = ze_compress.VarbyteIndex(self.con)
+
+    def search(self, q_string):
+        if self.engine == 'maxscore':
+            import ze_search_maxscore
+            return ze_search_maxscore.search(self.index, q_string, self.limit)
+        elif self.engine in ('numpy', 'varbyte') and self.matcher == 'lm':
+            return numpy_search_lm(self.csr, self.con, q_string, self.limit)
+        elif self.engine in ('numpy', 'varbyte'):
+            return numpy_search_bm25(self.csr, self.con, q_string, self.limit, self.b, self.k)
+        elif self.matcher == 'lm':
+            return duckdb_search_lm(self.con, q_string, self.limit)
+        else:
+            return duckdb_search_bm25(self.con, q_string, self.limit, self.b, self.k)
+
+    def search_all(self, q_strings, batch=1):
+        """ Hits per query string, batch query strings per statement """
+        if batch > 1:
+            return duckdb_search_lm_batch(self.con, q_strings, self.limit)
+        return [self.search(q_string) for q_string in q_strings]
+
+    def close(self):
+        self.con.close()
+
+
+class ResultCache:
+    """ Hits of queries by query key (see query_key), at most size entries
+        in memory, evicting the least recently used; optionally all
+        entries also in DuckDB database path, one path per index. Entries
+        are dropped when the index file changes (see check_index).
+    """
+
+    def __init__(self, size=1000, path=None):
+        if size < 1:
+            raise ValueError(f"Cache size must be positive, not {size}.")
+        self.size = size
+        self.entries = collections.OrderedDict()
+        (self.hits, self.disk_hits, self.misses) = (0, 0, 0)
+        self.version = None
+        self.disk = None
+        if path:
+            self.disk = duckdb.connect(path)
+            self.disk.sql("""
+                CREATE TABLE IF NOT EXISTS results (key VARCHAR PRIMARY KEY, version VARCHAR, hits VARCHAR)
+            """)
+
+    def check_index(self, db_name, engine='duckdb'):
+        """ Drop the entries of another index version than that of index
+            db_name: its path, size and modification time, and those of
+            the CSR sidecar that engine numpy searches
+        """
+        files = [db_name]
+        if engine == 'numpy':
+            import ze_csr
+            files.append(os.path.join(ze_csr.csr_path(db_name), 'meta.json'))
+        stats = [(os.path.abspath(name), os.stat(name)) for name in files if os.path.exists(name)]
+        version = json.dumps([(path, stat.st_size, stat.st_mtime_ns) for (path, stat) in stats])
+        if version != self.version:
+            self.entries.clear()
+            if self.disk:
+                self.disk.execute("DELETE FROM results WHERE version <> $1", [version])
+            self.version = version
+
+    def get(self, key):
+        """ The hits of key, or None """
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        if self.disk:
+            rows = self.disk.execute("SELECT hits FROM results WHERE key = $1", [key]).fetchall()
+            if rows:
+                self.disk_hits += 1
+                hits = [tuple(hit) for hit in json.loads(rows[0][0])]
+                self.put(key, hits, disk=False)
+                return hits
+        self.misses += 1
+        return None
+
+    def put(self, key, hits, disk=True):
+        self.entries[key] = hits
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        if disk and self.disk:
+            self.disk.execute("INSERT OR REPLACE INTO results VALUES ($1, $2, $3)",
+                              [key, self.version, json.dumps(hits)])
+
+    def summary(self):
+        return (f"cache: {self.hits + self.disk_hits} hits ({self.disk_hits} from disk), "
+                f"{self.misses} misses")
+
+    def close(self):
+        if self.disk:
+            self.disk.close()
+
+
+def query_key(con, query, params):
+    """ Cache key of query: its distinct stemmed tokens, which determine
+        the results of the match macros, and the search parameters
+    """
+    sql = """
+        SELECT DISTINCT stem(unnest(fts_main_documents.tokenize($1)), stemmer) AS t
+        FROM fts_main_documents.stats
+        ORDER BY t
+    """
+    tokens = [t for (t,) in con.execute(sql, [query]).fetchall()]
+    return json.dumps([tokens, params])
+
+
+worker_searcher = None  # the Searcher of a worker process of search_run
+
+
+def init_search_worker(workers, *args):
+    """ Open the index in a worker process, with DuckDB threads for its
+        share of the cores; an error is raised by its first search, as an
+        error here would only break the pool
+    """
+    global worker_searcher
+    try:
+        worker_searcher = Searcher(*args)
+        worker_searcher.con.sql(f"SET threads = {max(1, (os.cpu_count() or 1) // workers)}")
+    except ValueError as e:
+        worker_searcher = e
+
+
+def search_worker(q_strings, batch, verbose, searcher=None):
+    """ Hits (and verbose query info) of q_strings by searcher, by default
+        that of the worker process, with the process id and the time spent
+    """
+    searcher = searcher or worker_searcher
+    if isinstance(searcher, ValueError):
+        raise searcher
+    start = time.perf_counter()
+    hits = searcher.search_all(q_strings, batch)
+    infos = [duckdb_print_query(searcher.con, q) if verbose else None for q in q_strings]
+    return hits, infos, os.getpid(), time.perf_counter() - start
+
+
+def print_utilization(num_queries, wall, busy):
+    """ Queries per second of the run, and the busy time of each worker
+        (by process id) relative to the time of the run
+    """
+    print(f"{num_queries} queries in {wall:.2f}s, {num_queries / wall:.1f} queries/s", file=sys.stderr)
+    for (i, (pid, (count, seconds))) in enumerate(busy.items()):
+        print(f"worker {i} (pid {pid}): {count} queries, busy {seconds:.2f}s "
+              f"({100 * seconds / wall:.0f}%)", file=sys.stderr)
+
+
 def search_run(db_name, query_tag, matcher='lm', run_tag=None,
                b=0.75, k=1.2, limit=1000, fileout=None,
-               startq=None, endq=None, verbose=False):
-    con = duckdb.connect(db_name, read_only=True)
+               startq=None, endq=None, verbose=False, engine='duckdb', batch=1,
+               workers=1, cache=None):
+    """ Search the queries of query_tag, batch queries at a time, by
+        workers processes that each open the index read-only. Hits are
+        written in query order. Queries found in cache (a ResultCache)
+        are not searched again.
+    """
+    if batch > 1 and (engine != 'duckdb' or matcher != 'lm'):
+        raise ValueError("Batch search is only available for matcher lm with engine duckdb.")
+    if workers < 1:
+        raise ValueError(f"Number of workers must be positive, not {workers}.")
+    args = (db_name, matcher, engine, b, k, limit)
+    params = {'matcher': matcher, 'engine': engine, 'limit': limit}
+    if matcher == 'bm25':
+        params.update(b=b, k=k)
+    if workers == 1:
+        searcher = Searcher(*args)
+        con = searcher.con
+    else:
+        searcher = None
+        con = duckdb.connect(db_name, read_only=True) if cache else None
+    if cache:
+        cache.check_index(db_name, engine)
     if fileout:
         file = open(fileout, "w")
     else:
         file = sys.stdout
     if not run_tag:
         run_tag = matcher
-    queries = get_queries(query_tag)
-    for query in queries:
+    queries = []
+    for query in get_queries(query_tag):
         qid = query.query_id
         if (startq and int(qid) < startq) or (endq and int(qid) > endq):
             continue
         if hasattr(query, 'title'):
-            q_string = query.title
-        else:
-            q_string = query.text
-        if verbose:
-           print(q_string, end='', file=sys.stderr)
-           print(duckdb_print_query(con, q_string), file=sys.stderr)
-        if matcher == 'lm':
-            hits = duckdb_search_lm(con, q_string, limit)
-        elif matcher == 'bm25':
-            hits = duckdb_search_bm25(con, q_string, limit, b, k)
+            queries.append((qid, query.title))
         else:
-            raise ValueError(f"Unknown match function: {matcher}")
-        for rank, (docno, score, postings_cost) in enumerate(hits):
-            file.write(f'{qid} Q0 {docno} {rank} {score} {run_tag} {postings_cost}\n')
-    con.close()
+            queries.append((qid, query.text))
+    start = time.perf_counter()
+    if workers > 1:
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=init_search_worker,
+                                                      initargs=(workers,) + args)
+    busy = {}
+    pending = collections.deque()  # chunks in query order, with their cached hits and search
+
+    def write_chunk(chunk, keys, cached, result):
+        if isinstance(result, concurrent.futures.Future):
+            result = result.result()
+        if result:
+            (found, infos, pid, seconds) = result
+            (count, total) = busy.get(pid, (0, 0.0))
+            busy[pid] = (count + len(found), total + seconds)
+            searched = zip(found, infos)
+        for ((qid, q_string), key, hits) in zip(chunk, keys, cached):
+            if hits is None:
+                (hits, info) = next(searched)
+                if cache:
+                    cache.put(key, hits)
+            elif verbose:
+                info = duckdb_print_query(con, q_string)
+            if verbose:
+                print(q_string, end='', file=sys.stderr)
+                print(info, file=sys.stderr)
+            for rank, (docno, score, postings_cost) in enumerate(hits):
+                file.write(f'{qid} Q0 {docno} {rank} {score} {run_tag} {postings_cost}\n')
+
+    try:
+        for start_chunk in range(0, len(queries), batch):
+            chunk = queries[start_chunk:start_chunk + batch]
+            if cache:
+                keys = [query_key(con, q_string, params) for (_, q_string) in chunk]
+                cached = [cache.get(key) for key in keys]
+            else:
+                (keys, cached) = ([None] * len(chunk), [None] * len(chunk))
+            misses = [q_string for ((_, q_string), hits) in zip(chunk, cached) if hits is None]
+            if not misses:
+                result = None
+            elif workers > 1:
+                result = pool.submit(search_worker, misses, batch, verbose)
+            else:
+                result = search_worker(misses, batch, verbose, searcher)
+            pending.append((chunk, keys, cached, result))
+            while len(pending) > 2 * (workers - 1):
+                write_chunk(*pending.popleft())
+        while pending:
+            write_chunk(*pending.popleft())
+    finally:
+        if workers > 1:
+            pool.shutdown(cancel_futures=True)
+        if con:
+            con.close()
+    if workers > 1:
+        print_utilization(len(queries), time.perf_counter() - start, busy)
+    if cache and verbose:
+        print(cache.summary(), file=sys.stderr)
     file.close()
 
 
@@ -0,0 +1,329 @@
+"""
+Zoekeend top-k search with dynamic pruning over impact postings.
+
+Based on: Howard Turtle and James Flood, Query evaluation: strategies and
+optimizations, Information Processing & Management 31(6), 1995 (MaxScore),
+and Shuai Ding and Torsten Suel, Faster top-k document retrieval using
+block-max indexes, SIGIR 2011.
+
+Requires an index created by ze_reindex_impact. Returns the same top-k
+as the (exhaustive) match macros of that index, and reports as postings
+cost the number of postings actually read. Postings are fetched per block
+(see ze_vacuum.create_blocks), skipping blocks whose block-max impacts
+show they cannot contribute to the top-k; every posting of a fetched
+block counts, also if no candidate document needed it.
+"""
+
+from collections import namedtuple
+
+import duckdb
+import numpy as np
+
+import ze_vacuum
+
+
+Blocks = namedtuple('Blocks', ['first_row', 'rows', 'min_docid', 'max_docid', 'max_impact'])
+
+MAX_GAP = 8  # fetch up to MAX_GAP unneeded blocks rather than start a new range
+
+
+class ImpactIndex:
+    """ Per-connection state of an impact index: scales and priors """
+
+    def __init__(self, con, matcher='lm'):
+        if matcher not in ('lm', 'bm25'):
+            raise ValueError(f"Unknown match function: {matcher}")
+        try:
+            (stemmer, scale) = con.sql(f"""
+                SELECT stemmer, {matcher}_scale FROM fts_main_documents.stats
+            """).fetchall()[0]
+            con.sql(f"SELECT {matcher}_max FROM fts_main_documents.dict LIMIT 0")
+            con.sql(f"SELECT {matcher}_max FROM fts_main_documents.blocks LIMIT 0")
+        except (duckdb.duckdb.BinderException, duckdb.duckdb.CatalogException):
+            raise ValueError("Index has no impacts, use reindex_impact first.")
+        self.con = con
+        self.matcher = matcher
+        self.stemmer = stemmer
+        self.scale = scale
+        if matcher == 'lm':
+            (docids, priors) = self.fetch_arrays(f"""
+                SELECT docid, LN({ze_vacuum.get_doc_prior(con)}) FROM fts_main_documents.docs
+            """)
+            self.prior = np.zeros(docids.max() + 1)
+            self.prior[docids] = priors
+            self.prior_max = priors.max()
+        else:
+            self.prior = None
+            self.prior_max = 0.0
+
+    def fetch_arrays(self, sql, params=None):
+        result = self.con.execute(sql, params).fetchnumpy()
+        return [np.asarray(column) for column in result.values()]
+
+    def query_terms(self, query):
+        """ Query terms (termid, maximum impact), ordered by maximum impact """
+        return self.con.execute(f"""
+            WITH tokens AS (
+                SELECT DISTINCT stem(unnest(fts_main_documents.tokenize($1)), '{self.stemmer}') AS t
+            )
+            SELECT termid, COALESCE({self.matcher}_max, 0) AS max_impact
+            FROM fts_main_documents.dict AS dict, tokens
+            WHERE dict.term = tokens.t
+            ORDER BY max_impact, termid
+        """, [query]).fetchall()
+
+    def blocks(self, termids):
+        """ Block-max metadata of each term, ordered by docid """
+        (termid, *columns) = self.fetch_arrays(f"""
+            SELECT termid, first_row, rows, min_docid, max_docid, {self.matcher}_max::BIGINT
+            FROM fts_main_documents.blocks
+            WHERE termid = ANY($1)
+            ORDER BY termid, block
+        """, [termids])
+        blocks = {}
+        for t in termids:
+            start = np.searchsorted(termid, t, side='left')
+            end = np.searchsorted(termid, t, side='right')
+            blocks[t] = Blocks(*(c[start:end] for c in columns))
+        return blocks
+
+    def postings(self, ranges):
+        """ Postings (docids, impacts) of each term in its row ranges,
+            ordered by docid. Ranges maps termids to (first, last) rowids.
+        """
+        sql = [f"""
+            SELECT {t} AS q, termid, docid, {self.matcher}_impact AS impact
+            FROM fts_main_documents.terms
+            WHERE rowid BETWEEN {first} AND {last}
+        """ for (t, term_ranges) in ranges.items() for (first, last) in term_ranges]
+        lists = {t: (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)) for t in ranges}
+        if not sql:
+            return lists
+        (q, termid, docid, impact) = self.fetch_arrays(" UNION ALL ".join(sql))
+        if np.any(q != termid):
+            raise ValueError("Blocks do not match terms, use vacuum --cluster to recreate them.")
+        order = np.lexsort((docid, q))
+        (q, docid, impact) = (q[order], docid[order], impact[order].astype(np.int64))
+        new = np.concatenate(([True], (q[1:] != q[:-1]) | (docid[1:] != docid[:-1])))
+        if not new.all():  # postings of a term in several fields of a document
+            impact = np.add.reduceat(impact, np.flatnonzero(new))
+            (q, docid) = (q[new], docid[new])
+        for t in ranges:
+            start = np.searchsorted(q, t, side='left')
+            end = np.searchsorted(q, t, side='right')
+            lists[t] = (docid[start:end], impact[start:end])
+        return lists
+
+    def scores(self, docids, impacts):
+        """ Scores of documents from the sum of their impacts; an upper
+            bound if impacts is the sum of the impacts that may follow
+        """
+        if self.prior is None:
+            return impacts * self.scale
+        return self.prior[docids] + impacts * self.scale
+
+    def names(self, docids):
+        (docid, name) = self.fetch_arrays("""
+            SELECT docid, name FROM fts_main_documents.docs WHERE docid = ANY($1)
+        """, [docids.tolist()])
+        return dict(zip(docid.tolist(), name.tolist()))
+
+
+def block_ranges(selected):
+    """ Runs (first, last) of the selected block numbers, joining runs
+        that are at most MAX_GAP blocks apart
+    """
+    if len(selected) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(selected) > MAX_GAP + 1)
+    firsts = np.concatenate(([selected[0]], selected[breaks + 1]))
+    lasts = np.concatenate((selected[breaks], [selected[-1]]))
+    return list(zip(firsts.tolist(), lasts.tolist()))
+
+
+def find_blocks(blocks, docids):
+    """ For each docid, the number of the block that may contain it,
+        and whether such a block exists
+    """
+    pos = np.searchsorted(blocks.max_docid, docids)
+    found = pos < len(blocks.max_docid)
+    pos[~found] = 0
+    if len(blocks.max_docid):
+        found &= blocks.min_docid[pos] <= docids
+    return pos, found
+
+
+def block_max(blocks, docids):
+    """ Maximum impact of the term in each document: its block maximum """
+    (pos, found) = find_blocks(blocks, docids)
+    if not found.any():
+        return np.zeros(len(docids), dtype=np.int64)
+    return np.where(found, blocks.max_impact[pos], 0)
+
+
+def candidate_blocks(blocks, docids):
+    """ The blocks that may contain the docids """
+    (pos, found) = find_blocks(blocks, docids)
+    return np.unique(pos[found])
+
+
+def live_blocks(index, blocks, lists, theta):
+    """ The blocks of each of lists that overlap a docid range in which the
+        sum of the block maxima of all query terms (blocks) may reach theta
+    """
+    starts = np.concatenate([b.min_docid for b in blocks])
+    ends = np.concatenate([b.max_docid + 1 for b in blocks])
+    maxima = np.concatenate([b.max_impact for b in blocks])
+    events = np.concatenate((starts, ends))
+    order = np.argsort(events, kind='stable')
+    events = events[order]
+    level = np.cumsum(np.concatenate((maxima, -maxima))[order])
+    last = np.concatenate((events[1:] != events[:-1], [True]))
+    (events, level) = (events[last], level[last])
+    live = index.prior_max + level[:-1] * index.scale >= theta
+    (live_starts, live_ends) = (events[:-1][live], events[1:][live])
+    selection = []
+    for b in lists:
+        pos = np.searchsorted(live_ends, b.min_docid, side='right')
+        overlap = pos < len(live_ends)
+        pos[~overlap] = 0
+        if len(live_ends):
+            overlap &= live_starts[pos] <= b.max_docid
+        selection.append(np.flatnonzero(overlap))
+    return selection
+
+
+class QueryPostings:
+    """ The blocks of the query terms, and their postings fetched so far;
+        every block is fetched at most once per query, and cost counts the
+        postings (rows of the terms table) fetched
+    """
+
+    def __init__(self, index, termids):
+        self.index = index
+        self.blocks = index.blocks(termids)
+        self.fetched = {t: np.zeros(len(b.first_row), dtype=bool) for (t, b) in self.blocks.items()}
+        self.lists = {t: (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)) for t in termids}
+        self.cost = 0
+
+    def all_blocks(self, t):
+        return np.arange(len(self.blocks[t].first_row))
+
+    def fetch(self, selection):
+        """ Postings (docids, impacts) in the selected blocks of each term """
+        ranges = {}
+        for (t, selected) in selection.items():
+            blocks = self.blocks[t]
+            runs = block_ranges(selected[~self.fetched[t][selected]])
+            for (first, last) in runs:
+                self.fetched[t][first:last + 1] = True
+            ranges[t] = [(blocks.first_row[first], blocks.first_row[last] + blocks.rows[last] - 1)
+                         for (first, last) in runs]
+            self.cost += sum(int(last - first) + 1 for (first, last) in ranges[t])
+        new = self.index.postings(ranges)
+        result = {}
+        for (t, selected) in selection.items():
+            if len(new[t][0]):
+                docids = np.concatenate((self.lists[t][0], new[t][0]))
+                impacts = np.concatenate((self.lists[t][1], new[t][1]))
+                order = np.argsort(docids, kind='stable')
+                self.lists[t] = (docids[order], impacts[order])
+            (docids, impacts) = self.lists[t]
+            (pos, _) = find_blocks(self.blocks[t], docids)
+            keep = np.isin(pos, selected)
+            result[t] = (docids[keep], impacts[keep])
+        return result
+
+
+def lookup(docids, impacts, postings):
+    """ Add the impacts in postings of docids; skips by binary search """
+    (pdocids, pimpacts) = postings
+    if len(pdocids) == 0 or len(docids) == 0:
+        return impacts
+    pos = np.searchsorted(pdocids, docids)
+    pos[pos == len(pdocids)] = 0
+    found = pdocids[pos] == docids
+    return impacts + np.where(found, pimpacts[pos], 0)
+
+
+def accumulate(postings):
+    """ Sum the impacts per docid of all postings lists (docids, impacts).
+        Returns the docids and their impacts.
+    """
+    docids = np.concatenate([d for (d, _) in postings] + [np.zeros(0, dtype=np.int64)])
+    impacts = np.concatenate([i for (_, i) in postings] + [np.zeros(0, dtype=np.int64)])
+    (unique, inverse) = np.unique(docids, return_inverse=True)
+    impacts = np.bincount(inverse, weights=impacts, minlength=len(unique)).astype(np.int64)
+    return unique, impacts
+
+
+def complete(index, postings, docids, impacts, termids, theta):
+    """ MaxScore: complete the impacts of candidates by looking them up in
+        the non-essential lists, from the highest maximum impact down,
+        dropping candidates whose upper bound, using block maxima, falls
+        below theta. Only the blocks of candidates are fetched.
+    """
+    rest = np.zeros(len(docids), dtype=np.int64)
+    for t in termids:
+        rest += block_max(postings.blocks[t], docids)
+    for t in reversed(termids):
+        keep = index.scores(docids, impacts + rest) >= theta
+        (docids, impacts, rest) = (docids[keep], impacts[keep], rest[keep])
+        rest -= block_max(postings.blocks[t], docids)
+        selected = candidate_blocks(postings.blocks[t], docids)
+        impacts = lookup(docids, impacts, postings.fetch({t: selected})[t])
+    return docids, impacts
+
+
+def kth_score(scores, k):
+    return np.partition(scores, -k)[-k] if len(scores) >= k else -np.inf
+
+
+def top_k(index, query, limit):
+    """ Top-k (docids, scores) of query, and the number of postings read.
+        Every posting is read at most once, as part of the block that holds
+        it, whether it is accumulated or only looked up for a candidate.
+    """
+    terms = index.query_terms(query)
+    if not terms or limit <= 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0), 0
+    termids = [t for (t, _) in terms]
+    max_prefix = np.cumsum([0] + [m for (_, m) in terms])
+    postings = QueryPostings(index, termids)
+
+    # Threshold: the k-th score of the documents of the terms with the highest maximum impacts
+    seed = len(termids)
+    docids = []
+    while seed > 0 and (seed == len(termids) or len(docids) < limit):
+        seed -= 1
+        (docids, impacts) = accumulate([postings.fetch({t: postings.all_blocks(t)})[t]
+                                        for t in termids[seed:]])
+    theta = kth_score(index.scores(docids, impacts), limit)  # partial scores are a lower bound
+    (docids, impacts) = complete(index, postings, docids, impacts, termids[:seed], theta)
+    scores = index.scores(docids, impacts)
+    theta = kth_score(scores, limit)
+
+    # Essential lists: documents in none of them score below the threshold;
+    # skip their blocks in docid ranges where the block maxima stay below it
+    essential = 0
+    while essential < seed and index.prior_max + max_prefix[essential + 1] * index.scale < theta:
+        essential += 1
+    selection = live_blocks(index, [postings.blocks[t] for t in termids],
+                            [postings.blocks[t] for t in termids[essential:seed]], theta)
+    fetched = postings.fetch(dict(zip(termids[essential:seed], selection)))
+    (cdocids, cimpacts) = accumulate(list(fetched.values()))
+    new = ~np.isin(cdocids, docids, assume_unique=True)
+    (cdocids, cimpacts) = complete(index, postings, cdocids[new], cimpacts[new],
+                                   termids[:essential], theta)
+
+    docids = np.concatenate((docids, cdocids))
+    scores = np.concatenate((scores, index.scores(cdocids, cimpacts)))
+    order = np.lexsort((docids, -scores))[:limit]
+    return docids[order], scores[order], postings.cost
+
+
+def search(index, query, limit):
+    """ Hits (docname, score, postings_cost) like ze_search.duckdb_search_lm """
+    (docids, scores, cost) = top_k(index, query, limit)
+    names = index.names(docids)
+    return [(names[d], s, cost) for (d, s) in zip(docids.tolist(), scores.tolist())]
@@ -0,0 +1,277 @@
+"""
+Zoekeend search server: the index is opened once, read-only, and queries
+are answered over HTTP with JSON, by an asyncio server on localhost:
+
+  GET /search?q=...&top=10&matcher=lm   (or POST /search with a JSON object)
+      {"query": ..., "matcher": ..., "top": ..., "ms": ...,
+       "hits": [{"docname": ..., "score": ..., "postings_cost": ...}, ...]}
+  GET /stats
+      requests per status, searches in progress, rejected requests,
+      latency histograms (in ms) per matcher and the cache counts
+
+Searches run the match macros (engine duckdb) on a pool of threads, each
+with its own cursor on the connection; at most concurrency searches run
+at once, and requests are rejected (status 503) if max_pending searches
+are waiting. Parameters b and k apply to matcher bm25, with the defaults
+of zoekeend search (b=0.4, k=0.9).
+"""
+
+import asyncio
+import bisect
+import concurrent.futures
+import json
+import signal
+import sys
+import threading
+import time
+import urllib.parse
+
+import duckdb
+
+import ze_search
+
+
+LATENCY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+
+class LatencyHistogram:
+    """ Counts of latencies (ms) per bucket of LATENCY_BUCKETS """
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        (self.count, self.total, self.max) = (0, 0.0, 0.0)
+
+    def add(self, ms):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def percentile(self, p):
+        """ Upper bound of the bucket of the p-th percentile """
+        rank = p / 100 * self.count
+        seen = 0
+        for (bound, count) in zip(LATENCY_BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def as_dict(self):
+        buckets = {f"<={bound}": count for (bound, count) in zip(LATENCY_BUCKETS, self.counts)}
+        buckets[f">{LATENCY_BUCKETS[-1]}"] = self.counts[-1]
+        return {'count': self.count,
+                'mean_ms': self.total / self.count if self.count else None,
+                'max_ms': self.max,
+                'p50_ms': self.percentile(50) if self.count else None,
+                'p95_ms': self.percentile(95) if self.count else None,
+                'p99_ms': self.percentile(99) if self.count else None,
+                'buckets': buckets}
+
+
+def search_params(fields, top, max_top):
+    """ Query and parameters of a search request, with defaults """
+    query = fields.get('q')
+    if not query or not isinstance(query, str):
+        raise ValueError("Parameter q (the query) is missing.")
+    matcher = fields.get('matcher', 'lm')
+    if matcher not in ('lm', 'bm25'):
+        raise ValueError(f"Unknown match function: {matcher}")
+    top = int(fields.get('top', top))
+    if not 1 <= top <= max_top:
+        raise ValueError(f"Parameter top must be between 1 and {max_top}, not {top}.")
+    return {'query': query, 'matcher': matcher, 'top': top,
+            'b': float(fields.get('b', 0.4)), 'k': float(fields.get('k', 0.9))}
+
+
+class SearchServer:
+    """ Index db_name, searched by HTTP requests (see the module) """
+
+    def __init__(self, db_name, concurrency=4, max_pending=64, top=10, max_top=1000, cache=None):
+        if concurrency < 1:
+            raise ValueError(f"Concurrency must be positive, not {concurrency}.")
+        (self.concurrency, self.max_pending, self.top, self.max_top) = (concurrency, max_pending, top, max_top)
+        self.con = duckdb.connect(db_name, read_only=True)
+        self.cache = cache
+        if cache:
+            cache.check_index(db_name)
+        self.cache_lock = threading.Lock()
+        self.local = threading.local()
+        self.cursors = []
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+        self.semaphore = None
+        self.server = None
+        self.pending = 0
+        self.rejected = 0
+        self.statuses = {}
+        self.latency = {'lm': LatencyHistogram(), 'bm25': LatencyHistogram()}
+        self.started = time.time()
+
+    def cursor(self):
+        """ The cursor of the current thread of the executor """
+        if not hasattr(self.local, 'con'):
+            self.local.con = self.con.cursor()
+            self.cursors.append(self.local.con)
+        return self.local.con
+
+    def search(self, params):
+        """ Hits of a search request, in a thread of the executor """
+        con = self.cursor()
+        if self.cache:
+            cache_params = {'matcher': params['matcher'], 'engine': 'duckdb', 'limit': params['top']}
+            if params['matcher'] == 'bm25':
+                cache_params.update(b=params['b'], k=params['k'])
+            key = ze_search.query_key(con, params['query'], cache_params)
+            with self.cache_lock:
+                hits = self.cache.get(key)
+            if hits is not None:
+                return hits
+        if params['matcher'] == 'lm':
+            hits = ze_search.duckdb_search_lm(con, params['query'], params['top'])
+        else:
+            hits = ze_search.duckdb_search_bm25(con, params['query'], params['top'], params['b'], params['k'])
+        if self.cache:
+            with self.cache_lock:
+                self.cache.put(key, hits)
+        return hits
+
+    async def handle_search(self, fields):
+        params = search_params(fields, self.top, self.max_top)
+        if self.pending >= self.concurrency + self.max_pending:
+            self.rejected += 1
+            return 503, {'error': "Too many pending searches, try again later."}
+        start = time.perf_counter()
+        self.pending += 1
+        try:
+            async with self.semaphore:
+                hits = await asyncio.get_running_loop().run_in_executor(self.executor, self.search, params)
+        finally:
+            self.pending -= 1
+        ms = 1000 * (time.perf_counter() - start)
+        self.latency[params['matcher']].add(ms)
+        return 200, {'query': params['query'], 'matcher': params['matcher'], 'top': params['top'], 'ms': ms,
+                     'hits': [dict(zip(('docname', 'score', 'postings_cost'), hit)) for hit in hits]}
+
+    def stats(self):
+        return {'uptime_s': time.time() - self.started,
+                'concurrency': self.concurrency,
+                'searching': self.pending,
+                'rejected': self.rejected,
+                'requests': self.statuses,
+                'latency': {matcher: histogram.as_dict() for (matcher, histogram) in self.latency.items()},
+                'cache': self.cache and {'hits': self.cache.hits + self.cache.disk_hits,
+                                         'disk_hits': self.cache.disk_hits, 'misses': self.cache.misses}}
+
+    async def respond(self, method, target, body):
+        """ Status and JSON object of a request """
+        url = urllib.parse.urlsplit(target)
+        if url.path not in ('/search', '/stats'):
+            return 404, {'error': f"Unknown path {url.path}, use /search or /stats."}
+        if url.path == '/stats':
+            return (200, self.stats()) if method == 'GET' else (405, {'error': "Use GET."})
+        if method == 'GET':
+            fields = dict(urllib.parse.parse_qsl(url.query))
+        elif method == 'POST':
+            fields = json.loads(body or b'{}')
+            if not isinstance(fields, dict):
+                raise ValueError("Request body must be a JSON object.")
+        else:
+            return 405, {'error': "Use GET or POST."}
+        return await self.handle_search(fields)
+
+    async def read_request(self, reader, line):
+        """ Method, target, version, headers and body of the request that
+            starts with request line
+        """
+        request = line.decode('latin-1').split()
+        if len(request) != 3:
+            raise ValueError("Malformed request line, use: METHOD target HTTP/1.1")
+        headers = {}
+        line = await reader.readline()
+        while line.strip():
+            if b':' not in line:
+                raise ValueError("Malformed header line.")
+            (name, value) = line.decode('latin-1').split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+            line = await reader.readline()
+        length = headers.get('content-length', '0')
+        if not length.isdigit():
+            raise ValueError(f"Malformed Content-Length: {length}")
+        body = await reader.readexactly(int(length))
+        return (*request, headers, body)
+
+    async def handle(self, reader, writer):
+        """ The HTTP/1.1 requests of a connection; a malformed request is
+            answered with status 400, and closes the connection
+        """
+        try:
+            while True:
+                line = await reader.readline()
+                if not line.strip():
+                    break
+                try:
+                    (method, target, version, headers, body) = await self.read_request(reader, line)
+                except ValueError as e:
+                    (status, result, close) = (400, {'error': str(e)}, True)
+                else:
+                    try:
+                        (status, result) = await self.respond(method, target, body)
+                    except (TypeError, ValueError) as e:  # also json.JSONDecodeError
+                        (status, result) = (400, {'error': str(e)})
+                    except duckdb.Error as e:
+                        (status, result) = (500, {'error': str(e)})
+                    close = version == 'HTTP/1.0' or headers.get('connection', '').lower() == 'close'
+                self.statuses[status] = self.statuses.get(status, 0) + 1
+                data = json.dumps(result).encode('utf-8')
+                writer.write(f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+                             f"Content-Type: application/json\r\n"
+                             f"Content-Length: {len(data)}\r\n"
+                             f"{'Connection: close' if close else 'Connection: keep-alive'}\r\n\r\n".encode('latin-1')
+                             + data)
+                await writer.drain()
+                if close:
+                    break
+        except (ValueError, ConnectionError, asyncio.IncompleteReadError):
+            pass  # line over the limit of the reader, or closed connection
+        finally:
+            writer.close()
+
+    async def start(self, host='127.0.0.1', port=8000):
+        """ Listen on host and port (0: any free port), returns the port """
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.server = await asyncio.start_server(self.handle, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def serve(self, host='127.0.0.1', port=8000):
+        """ Serve until SIGINT or SIGTERM """
+        port = await self.start(host, port)
+        stop = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            asyncio.get_running_loop().add_signal_handler(signum, stop.set)
+        print(f"Serving on http://{host}:{port}/search", file=sys.stderr, flush=True)
+        async with self.server:
+            await stop.wait()
+
+    def close(self):
+        if self.server:
+            self.server.close()
+        self.executor.shutdown()
+        for cursor in self.cursors:
+            cursor.close()
+        self.con.close()
+
+
+def serve(db_name, host='127.0.0.1', port=8000, concurrency=4, max_pending=64, top=10, cache=None):
+    """ Serve index db_name until SIGINT or SIGTERM """
+    server = SearchServer(db_name, concurrency=concurrency, max_pending=max_pending, top=top, cache=cache)
+    try:
+        asyncio.run(server.serve(host, port))
+    finally:
+        server.close()
+
+
+if __name__ == "__main__":
+    serve('cran.db')
@@ -1,13 +1,66 @@
+import concurrent.futures
 import duckdb
+import fcntl
 import pathlib
+import shutil
 
 
-def copy_file_force(name_in, name_out):
+FICLONE = 0x40049409  # Linux ioctl: share the extents of another file
+
+
+def copy_file(name_in, name_out, force=False):
+    """ Copy index name_in to name_out without reading it into memory: as
+        a copy-on-write clone (reflink) if the file system supports it
+        (Btrfs, XFS), else by a copy in the kernel (see shutil.copyfile).
+    """
     path1 = pathlib.Path(name_in)
     if not(path1.is_file()):
         raise ValueError(f"File {name_in} does not exist.")
     path2 = pathlib.Path(name_out)
-    path2.write_bytes(path1.read_bytes())
+    if path2.is_file() and not force:
+        raise ValueError(f"File {name_out} already exists.")
+    with open(path1, 'rb') as file1, open(path2, 'wb') as file2:
+        try:
+            fcntl.ioctl(file2.fileno(), FICLONE, file1.fileno())
+            return
+        except OSError:
+            pass
+    shutil.copyfile(path1, path2)
+
+
+def check_tf_postings(con, name="Index", doclen=False):
+    """ The terms table must have a term frequency column tf, not a row per
+        term occurrence; with doclen, the docs table must have a len column
+    """
+    try:
+        con.sql("SELECT tf FROM fts_main_documents.terms LIMIT 0")
+    except duckdb.duckdb.BinderException:
+        raise ValueError(f"{name} has a row per term occurrence; rebuild it, "
+                         "or convert it with index_export and index_import.")
+    if doclen:
+        try:
+            con.sql("SELECT len FROM fts_main_documents.docs LIMIT 0")
+        except duckdb.duckdb.BinderException:
+            raise ValueError(f"{name} has no document lengths (len column of docs).")
+
+
+def check_tf_file(name, doclen=False):
+    """ check_tf_postings for index file name """
+    with duckdb.connect(name, read_only=True) as con:
+        check_tf_postings(con, name, doclen=doclen)
+
+
+def get_doc_prior(con):
+    """ The prior column of ze_reindex_prior if present, else the length """
+    try:
+        con.sql("SELECT prior FROM fts_main_documents.docs LIMIT 0")
+        return "prior"
+    except duckdb.duckdb.BinderException:
+        return "len"
+
+
+def copy_file_force(name_in, name_out):
+    copy_file(name_in, name_out, force=True)
 
 
 def rm_file(name):
@@ -28,6 +81,43 @@ def cluster_index(con):
         DROP TABLE docs;
         ALTER TABLE docs_new RENAME TO docs;
     """)
+    tables = con.sql("SELECT table_name FROM duckdb_tables() WHERE schema_name = 'fts_main_documents'").fetchall()
+    if ('blocks',) in tables:
+        create_blocks(con, block_size=get_block_size(con))
+
+
+def get_block_size(con):
+    """ The block size of ze_reindex_impact, 128 for indexes that predate it """
+    try:
+        return con.sql("SELECT block_size FROM fts_main_documents.stats").fetchall()[0][0]
+    except duckdb.duckdb.BinderException:
+        return 128
+
+
+def create_blocks(con, block_size=128):
+    """
+    Block-max metadata of the impact postings (see ze_reindex_impact): for
+    each block of {block_size} documents of a term, its docid range, its
+    rows in the terms table, and its maximum LM and BM25 impacts. A search
+    engine can fetch single blocks by rowid range, and skip blocks that
+    cannot contribute to the top-k. Rows are only contiguous if the
+    terms table is clustered on termid, docid, as cluster_index does.
+    """
+    con.sql(f"""
+        CREATE OR REPLACE TABLE fts_main_documents.blocks AS
+        SELECT termid, block, MIN(docid) AS min_docid, MAX(docid) AS max_docid,
+          MIN(first_row) AS first_row, SUM(rows)::BIGINT AS rows,
+          MAX(lm)::INTEGER AS lm_max, MAX(bm25)::INTEGER AS bm25_max
+        FROM (
+          SELECT termid, docid, MIN(rowid) AS first_row, COUNT(*) AS rows,
+            SUM(lm_impact) AS lm, SUM(bm25_impact) AS bm25,
+            (ROW_NUMBER() OVER (PARTITION BY termid ORDER BY docid) - 1) // {block_size} AS block
+          FROM fts_main_documents.terms
+          GROUP BY termid, docid
+        )
+        GROUP BY termid, block
+        ORDER BY termid, block
+    """)
 
  
 def reclaim_disk_space(name, cluster=True):
@@ -47,3 +137,21 @@ def reclaim_disk_space(name, cluster=True):
     con.close()
     rm_file(tmpname)
 
+
+def ordered_map(function, items, workers, queue_depth=2):
+    """
+    Generator for function(item) of each item in order, computed by
+    worker processes if workers > 1. At most queue_depth items per worker
+    are in flight, which bounds memory use for large files.
+    """
+    if workers <= 1:
+        yield from map(function, items)
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = []
+        for item in items:
+            pending.append(pool.submit(function, item))
+            if len(pending) >= workers * queue_depth:
+                yield pending.pop(0).result()
+        for future in pending:
+            yield future.result()